@@ -11,6 +11,69 @@ from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
 from ldm.util import instantiate_from_config
 
 
+def tile_positions(length, tile_size, tile_overlap):
+    """Start offsets of tiles of tile_size covering length, overlapping by at least tile_overlap."""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, tile_size - tile_overlap)
+    return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+
+def tile_blend_ramp(size, ramp, ramp_start, ramp_end, device):
+    """1D blending weights for one side of a tile: rises over the first ramp values and falls over the last."""
+    weight = torch.ones(size, device=device)
+    ramp = min(ramp, size // 2)
+    if ramp > 0:
+        # strictly positive so every output pixel ends up with some weight
+        rise = torch.linspace(0, 1, ramp + 2, device=device)[1:-1]
+        if ramp_start:
+            weight[:ramp] = rise
+        if ramp_end:
+            weight[-ramp:] = rise.flip(0)
+    return weight
+
+
+def tiled_apply(fn, x, tile_size, tile_overlap, scale, tile_batch_size):
+    """
+    Apply fn to overlapping tile_size x tile_size tiles of x and blend the results back together.
+    fn maps (n, c, h, w) to (n, c', h * scale, w * scale). Tiles are passed to fn tile_batch_size at a time,
+    so memory is bounded by the tile batch rather than the image, and seams are hidden by linearly
+    cross-fading over the overlap.
+    """
+    b, _, h, w = x.shape
+    ys = tile_positions(h, tile_size, tile_overlap)
+    xs = tile_positions(w, tile_size, tile_overlap)
+    if len(ys) == 1 and len(xs) == 1:
+        return fn(x)
+
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    out_tile_h, out_tile_w = int(tile_h * scale), int(tile_w * scale)
+    ramp = int(tile_overlap * scale)
+    coords = [(y, x0) for y in ys for x0 in xs]
+    output = None
+    weights = None
+
+    for start in range(0, len(coords), tile_batch_size):
+        batch_coords = coords[start:start + tile_batch_size]
+        tiles = torch.cat([x[:, :, y:y + tile_h, x0:x0 + tile_w] for y, x0 in batch_coords])
+        decoded_tiles = fn(tiles)
+        if output is None:
+            output = torch.zeros(b, decoded_tiles.shape[1], int(h * scale), int(w * scale),
+                                 device=decoded_tiles.device, dtype=decoded_tiles.dtype)
+            weights = torch.zeros(1, 1, int(h * scale), int(w * scale), device=decoded_tiles.device,
+                                  dtype=decoded_tiles.dtype)
+
+        for k, (y, x0) in enumerate(batch_coords):
+            weight_y = tile_blend_ramp(out_tile_h, ramp, y > 0, y + tile_h < h, decoded_tiles.device)
+            weight_x = tile_blend_ramp(out_tile_w, ramp, x0 > 0, x0 + tile_w < w, decoded_tiles.device)
+            weight = (weight_y[:, None] * weight_x[None, :]).to(decoded_tiles.dtype)
+            out_y, out_x = int(y * scale), int(x0 * scale)
+            output[:, :, out_y:out_y + out_tile_h, out_x:out_x + out_tile_w] += decoded_tiles[k * b:(k + 1) * b] * weight
+            weights[:, :, out_y:out_y + out_tile_h, out_x:out_x + out_tile_w] += weight
+
+    return output / weights
+
+
 class VQModel(pl.LightningModule):
     def __init__(self,
                  ddconfig,
@@ -292,6 +355,9 @@ class AutoencoderKL(pl.LightningModule):
                  image_key="image",
                  colorize_nlabels=None,
                  monitor=None,
+                 tile_size=None,
+                 tile_overlap=8,
+                 tile_batch_size=4,
                  ):
         super().__init__()
         self.image_key = image_key
@@ -302,6 +368,8 @@ class AutoencoderKL(pl.LightningModule):
         self.quant_conv = torch.nn.Conv2d(2*ddconfig["z_channels"], 2*embed_dim, 1)
         self.post_quant_conv = torch.nn.Conv2d(embed_dim, ddconfig["z_channels"], 1)
         self.embed_dim = embed_dim
+        self.downsampling_factor = 2 ** (len(ddconfig["ch_mult"]) - 1)
+        self.enable_tiling(tile_size, tile_overlap, tile_batch_size)
         if colorize_nlabels is not None:
             assert type(colorize_nlabels)==int
             self.register_buffer("colorize", torch.randn(3, colorize_nlabels, 1, 1))
@@ -321,13 +389,33 @@ class AutoencoderKL(pl.LightningModule):
         self.load_state_dict(sd, strict=False)
         print(f"Restored from {path}")
 
+    def enable_tiling(self, tile_size=64, tile_overlap=8, tile_batch_size=4):
+        """
+        Encode and decode latents larger than tile_size (in latent pixels) as overlapping tiles, blended
+        over tile_overlap latent pixels and run tile_batch_size tiles at a time. tile_size=None disables tiling.
+        """
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+
+    def disable_tiling(self):
+        self.tile_size = None
+
     def encode(self, x):
-        h = self.encoder(x)
-        moments = self.quant_conv(h)
+        if self.tile_size is not None:
+            f = self.downsampling_factor
+            moments = tiled_apply(lambda tiles: self.quant_conv(self.encoder(tiles)), x, self.tile_size * f,
+                                  self.tile_overlap * f, 1. / f, self.tile_batch_size)
+        else:
+            h = self.encoder(x)
+            moments = self.quant_conv(h)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
     def decode(self, z):
+        if self.tile_size is not None:
+            return tiled_apply(lambda tiles: self.decoder(self.post_quant_conv(tiles)), z, self.tile_size,
+                               self.tile_overlap, self.downsampling_factor, self.tile_batch_size)
         z = self.post_quant_conv(z)
         dec = self.decoder(z)
         return dec
@@ -0,0 +1,39 @@
+"""SAMPLING ONLY."""
+
+import math
+from tqdm import tqdm
+
+from ldm.models.diffusion.solver_base import SolverSampler
+
+
+class DPMSolverSampler(SolverSampler):
+    """
+    DPM-Solver++(2M) (Lu et al., 2022): a second order multistep solver of the diffusion ODE in its x_0
+    prediction form. One model evaluation per step, and it is stable with classifier-free guidance at 15-20 steps.
+    """
+    name = 'DPM-Solver++(2M)'
+
+    def solve(self, x, timesteps, get_model_output, callback=None, img_callback=None, eta=0., generators=None):
+        total_steps = len(timesteps) - 1
+        old_x0 = None
+        h_last = None
+        for i in tqdm(range(total_steps), desc='DPM-Solver++ Sampler', total=total_steps):
+            t, t_next = timesteps[i], timesteps[i + 1]
+            alpha_t, sigma_t = self.marginals(t)
+            alpha_next, sigma_next = self.marginals(t_next)
+            h = self.log_snr(t_next) - self.log_snr(t)
+
+            e_t = get_model_output(x, t, i)
+            pred_x0 = (x - sigma_t * e_t) / alpha_t
+            if old_x0 is None or (i == total_steps - 1 and total_steps < 15):
+                # first order (DDIM) for the first step, and for the last one when there are few steps
+                d = pred_x0
+            else:
+                r = h_last / h
+                d = (1 + 1 / (2 * r)) * pred_x0 - (1 / (2 * r)) * old_x0
+            x = (sigma_next / sigma_t) * x - (alpha_next * math.expm1(-h)) * d
+
+            old_x0, h_last = pred_x0, h
+            if callback: callback(i)
+            if img_callback: img_callback(pred_x0, i)
+        return x
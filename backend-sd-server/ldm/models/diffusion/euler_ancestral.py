@@ -0,0 +1,35 @@
+"""SAMPLING ONLY."""
+
+import math
+from tqdm import tqdm
+
+from ldm.models.diffusion.solver_base import SolverSampler
+
+
+class EulerAncestralSampler(SolverSampler):
+    """
+    Euler ancestral (Karras et al., 2022, as in k-diffusion): Euler steps in sigma = sigma_t / alpha_t space,
+    with eta scaling the fresh noise added after each step. eta = 0 is the plain (deterministic) Euler method.
+    """
+    name = 'Euler ancestral'
+    stochastic = True
+
+    def solve(self, x, timesteps, get_model_output, callback=None, img_callback=None, eta=0., generators=None):
+        total_steps = len(timesteps) - 1
+        # the last step goes all the way to sigma = 0, the clean image
+        sigmas = [sigma_t / alpha_t for alpha_t, sigma_t in map(self.marginals, timesteps[:-1])] + [0.]
+        x = x * math.sqrt(1. + sigmas[0] ** 2)
+        for i in tqdm(range(total_steps), desc='Euler Ancestral Sampler', total=total_steps):
+            sigma, sigma_next = sigmas[i], sigmas[i + 1]
+            e_t = get_model_output(x / math.sqrt(1. + sigma ** 2), timesteps[i], i)
+            pred_x0 = x - sigma * e_t
+
+            sigma_up = min(sigma_next, eta * math.sqrt(sigma_next ** 2 * (sigma ** 2 - sigma_next ** 2) / sigma ** 2))
+            sigma_down = math.sqrt(sigma_next ** 2 - sigma_up ** 2)
+            x = x + e_t * (sigma_down - sigma)
+            if sigma_up > 0:
+                x = x + self.noise(x, generators) * sigma_up
+
+            if callback: callback(i)
+            if img_callback: img_callback(pred_x0, i)
+        return x
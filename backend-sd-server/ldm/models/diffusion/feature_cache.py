@@ -0,0 +1,43 @@
+"""SAMPLING ONLY."""
+
+from contextlib import contextmanager
+
+
+class FeatureCacheSchedule(object):
+    """
+    Which steps of a sampling run refresh the UNet's feature cache (see UNetModel.set_feature_cache). Every
+    `interval`th step, starting with the first, runs the whole UNet; the steps in between reuse its deep features
+    and recompute only the shallow blocks down to input block `branch`. The deep features change slowly from one
+    step to the next, so an interval of 2-3 costs little quality; larger intervals are faster and blurrier.
+    """
+    def __init__(self, interval=3, branch=0):
+        if interval < 1:
+            raise ValueError('feature cache interval must be at least 1')
+        self.interval = interval
+        self.branch = branch
+
+    def refresh_at(self, i, total_steps):
+        # whether step i (counting from 0) of total_steps runs the whole UNet
+        return i % self.interval == 0
+
+    def step(self, model, i, total_steps):
+        # called by the sampler before the model evaluations of step i
+        model.model.diffusion_model.cache_refresh = self.refresh_at(i, total_steps)
+
+    def __repr__(self):
+        return f'FeatureCacheSchedule(interval={self.interval}, branch={self.branch})'
+
+
+@contextmanager
+def feature_cache_scope(model, feature_cache):
+    # turns the UNet's feature cache on for one sampling run, and off again (freeing the cached features)
+    # however the run ends
+    if feature_cache is None or feature_cache.interval == 1:
+        yield
+        return
+    unet = model.model.diffusion_model
+    unet.set_feature_cache(feature_cache.branch)
+    try:
+        yield
+    finally:
+        unet.set_feature_cache(None)
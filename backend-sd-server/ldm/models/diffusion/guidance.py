@@ -0,0 +1,37 @@
+"""SAMPLING ONLY."""
+
+import math
+
+GUIDANCE_DECAYS = ('none', 'linear', 'cosine')
+
+
+class GuidanceSchedule(object):
+    """
+    How much classifier-free guidance each step of a sampling run gets. Guidance is applied only from the
+    fraction `start` to the fraction `end` of the run, and the scale can decay towards 1 (no guidance) as the
+    run goes on. A step whose scale is 1 runs only the conditional branch of the model, halving its UNet batch -
+    the late steps mostly refine detail, so ending guidance at 50-70% of the run changes little.
+    """
+    def __init__(self, scale, start=0., end=1., decay='none'):
+        if decay not in GUIDANCE_DECAYS:
+            raise ValueError(f'guidance decay must be one of {GUIDANCE_DECAYS}')
+        self.scale = scale
+        self.start = start
+        self.end = end
+        self.decay = decay
+
+    def scale_at(self, i, total_steps):
+        # the guidance scale of step i (counting from 0) of total_steps
+        progress = i / total_steps
+        if self.scale == 1. or not self.start <= progress < self.end:
+            return 1.
+        if self.decay == 'linear':
+            weight = 1. - progress
+        elif self.decay == 'cosine':
+            weight = 0.5 * (1. + math.cos(math.pi * progress))
+        else:
+            weight = 1.
+        return 1. + (self.scale - 1.) * weight
+
+    def __repr__(self):
+        return f'GuidanceSchedule(scale={self.scale}, start={self.start}, end={self.end}, decay={self.decay!r})'
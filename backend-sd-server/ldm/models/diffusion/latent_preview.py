@@ -0,0 +1,24 @@
+"""SAMPLING ONLY."""
+
+import torch
+
+# Least squares fit from the 4 latent channels of the Stable Diffusion v1 autoencoder (as sampled, i.e. already
+# multiplied by the scale factor) to RGB in [-1, 1]. Good enough to see the composition and colours emerge.
+SD_V1_LATENT_RGB_FACTORS = [
+    #   R        G        B
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+def latent_to_rgb(latents, factors=SD_V1_LATENT_RGB_FACTORS):
+    """
+    Approximate RGB for a batch of latents (b, 4, h, w) with a linear projection instead of the VAE decoder.
+    Returns a uint8 tensor (b, h, w, 3) on the CPU, at latent resolution.
+    """
+    factors = torch.tensor(factors, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum('bchw,cr->bhwr', latents.float(), factors)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255)
+    return rgb.to(torch.uint8).cpu()
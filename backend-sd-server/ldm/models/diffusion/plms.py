@@ -1,10 +1,53 @@
 """SAMPLING ONLY."""
 
+import math
 import torch
 import numpy as np
+from collections import OrderedDict
 from tqdm import tqdm
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.diffusionmodules.util import noise_like
+from ldm.models.diffusion.schedule_cache import schedule_cache
+from ldm.models.diffusion.feature_cache import feature_cache_scope
+
+
+class PLMSStepBuffers(object):
+    """
+    What p_sample_plms needs at every step that doesn't change during a sampling run, made once per run: the
+    timestep tensors and the doubled classifier-free guidance inputs, which are filled in place at each step,
+    and the schedule's coefficients for each index as host scalars.
+    """
+    def __init__(self, x, c, unconditional_conditioning, unconditional_guidance_scale, alphas, alphas_prev,
+                 sqrt_one_minus_alphas, sigmas):
+        b = x.shape[0]
+        self.ts = torch.empty((b,), device=x.device, dtype=torch.long)
+        self.ts_next = torch.empty((b,), device=x.device, dtype=torch.long)
+        self.guided = unconditional_conditioning is not None and unconditional_guidance_scale != 1.
+        if self.guided:
+            self.x_in = torch.empty((2 * b,) + tuple(x.shape[1:]), device=x.device, dtype=x.dtype)
+            self.t_in = torch.empty((2 * b,), device=x.device, dtype=torch.long)
+            self.c_in = torch.cat([unconditional_conditioning, c])
+
+        self.sqrt_alphas = [math.sqrt(a) for a in to_floats(alphas)]
+        self.sqrt_alphas_prev = [math.sqrt(a) for a in to_floats(alphas_prev)]
+        self.sqrt_one_minus_alphas = to_floats(sqrt_one_minus_alphas)
+        self.sigmas = to_floats(sigmas)
+        # the coefficient of e_t in the direction pointing to x_t
+        self.dir_xt = [math.sqrt(max(1. - a_prev - sigma ** 2, 0.))
+                       for a_prev, sigma in zip(to_floats(alphas_prev), self.sigmas)]
+
+    def guided_inputs(self, x, t):
+        b = x.shape[0]
+        self.x_in[:b].copy_(x)
+        self.x_in[b:].copy_(x)
+        self.t_in[:b].copy_(t)
+        self.t_in[b:].copy_(t)
+        return self.x_in, self.t_in, self.c_in
+
+
+def to_floats(values):
+    # a schedule buffer (tensor or numpy array, on any device) as a list of python floats
+    return [float(v) for v in values.tolist()]
 
 
 class PLMSSampler(object):
@@ -23,35 +66,11 @@ class PLMSSampler(object):
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
         if ddim_eta != 0:
             raise ValueError('ddim_eta must be 0 for PLMS')
-        self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
-                                                  num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
-        alphas_cumprod = self.model.alphas_cumprod
-        assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
-
-        self.register_buffer('betas', to_torch(self.model.betas))
-        self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
-        self.register_buffer('alphas_cumprod_prev', to_torch(self.model.alphas_cumprod_prev))
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod.cpu())))
-        self.register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu())))
-        self.register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod.cpu() - 1)))
-
-        # ddim sampling parameters
-        ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
-                                                                                   ddim_timesteps=self.ddim_timesteps,
-                                                                                   eta=ddim_eta,verbose=verbose)
-        self.register_buffer('ddim_sigmas', ddim_sigmas)
-        self.register_buffer('ddim_alphas', ddim_alphas)
-        self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
-        self.register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
-            (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
-                        1 - self.alphas_cumprod / self.alphas_cumprod_prev))
-        self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        # the buffers only depend on the model and the arguments, so they are built once and shared
+        schedule = schedule_cache.get(self.model, ddim_num_steps, ddim_discretize=ddim_discretize,
+                                      ddim_eta=ddim_eta, verbose=verbose)
+        for name, attr in schedule.items():
+            setattr(self, name, attr)
 
     @torch.no_grad()
     def sample(self,
@@ -76,6 +95,9 @@ class PLMSSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               ddim_discretize="uniform",
+               guidance_schedule=None,
+               feature_cache=None,
                **kwargs
                ):
         if conditioning is not None:
@@ -87,38 +109,212 @@ class PLMSSampler(object):
                 if conditioning.shape[0] != batch_size:
                     print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
 
-        self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+        self.make_schedule(ddim_num_steps=S, ddim_discretize=ddim_discretize, ddim_eta=eta, verbose=verbose)
         # sampling
         C, H, W = shape
         size = (batch_size, C, H, W)
         print(f'Data shape for PLMS sampling is {size}')
 
-        samples, intermediates = self.plms_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    )
+        with feature_cache_scope(self.model, feature_cache):
+            samples, intermediates = self.plms_sampling(conditioning, size,
+                                                        callback=callback,
+                                                        img_callback=img_callback,
+                                                        quantize_denoised=quantize_x0,
+                                                        mask=mask, x0=x0,
+                                                        ddim_use_original_steps=False,
+                                                        noise_dropout=noise_dropout,
+                                                        temperature=temperature,
+                                                        score_corrector=score_corrector,
+                                                        corrector_kwargs=corrector_kwargs,
+                                                        x_T=x_T,
+                                                        log_every_t=log_every_t,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        unconditional_conditioning=unconditional_conditioning,
+                                                        guidance_schedule=guidance_schedule,
+                                                        feature_cache=feature_cache,
+                                                        )
         return samples, intermediates
 
+    @torch.no_grad()
+    def sample_sweep(self,
+                     step_counts,
+                     shape,
+                     conditioning,
+                     x_T,
+                     source_ids=None,
+                     callback=None,
+                     eta=0.,
+                     ddim_discretize="uniform",
+                     max_batch_size=None,
+                     verbose=True,
+                     unconditional_guidance_scale=1.,
+                     unconditional_conditioning=None,
+                     guidance_schedule=None,
+                     ):
+        """
+        Sample several trajectories in lockstep, trajectory j taking step_counts[j] steps from x_T[j] with
+        conditioning[j]. Trajectories with the same source id (i.e. the same x_T and conditioning) share a model
+        evaluation whenever they are in the same state at the same timestep with the same guidance scale, and fork
+        on the timestep they step to - so the saving depends on how many leading timesteps the step counts have in
+        common under ddim_discretize ('trailing' always starts at the last timestep, 'uniform' rarely shares any).
+        Every evaluation of a step goes through the model in the same batch, split into chunks of max_batch_size.
+        Returns the samples in the order of step_counts.
+        """
+        if eta != 0:
+            raise ValueError('ddim_eta must be 0 for PLMS')
+        n = len(step_counts)
+        if source_ids is None:
+            source_ids = list(range(n))
+        C, H, W = shape
+        assert x_T.shape[0] == n, 'need one x_T per trajectory'
+        device = self.model.betas.device
+        alphas_cumprod = self.model.alphas_cumprod.cpu().to(torch.float32)
+        max_batch_size = max_batch_size or n
+
+        # each trajectory's timesteps in sampling order, followed by 0 which stands for alphas_cumprod[0],
+        # the alpha the final step lands on
+        extended = []
+        for S in step_counts:
+            ddim_timesteps = schedule_cache.get(self.model, S, ddim_discretize=ddim_discretize, ddim_eta=eta,
+                                                verbose=verbose)['ddim_timesteps']
+            extended.append([int(t) for t in np.flip(ddim_timesteps)] + [0])
+        total_steps = max(len(ext) - 1 for ext in extended)
+
+        # a group is a set of trajectories whose state is identical so far: [members, img, old_eps]
+        groups = []
+        for source_id in OrderedDict.fromkeys(source_ids):
+            members = [j for j in range(n) if source_ids[j] == source_id]
+            groups.append([members, x_T[members[0]:members[0] + 1].to(device), []])
+
+        results = [None] * n
+        model_evaluations = 0
+        print(f"Running PLMS sweep over {n} trajectories of up to {total_steps} timesteps")
+
+        def get_model_output(x, t, c, uc, scales):
+            # scales holds each row's guidance scale - only the rows whose scale isn't 1 need the unconditional branch
+            e_t_chunks = []
+            for start in range(0, x.shape[0], max_batch_size):
+                x_chunk, t_chunk, c_chunk = (v[start:start + max_batch_size] for v in (x, t, c))
+                chunk_scales = scales[start:start + max_batch_size]
+                guided = [k for k, scale in enumerate(chunk_scales) if scale != 1.] if uc is not None else []
+                if len(guided) == 0:
+                    e_t = self.model.apply_model(x_chunk, t_chunk, c_chunk)
+                elif len(guided) == len(chunk_scales) and len(set(chunk_scales)) == 1:
+                    x_in = torch.cat([x_chunk] * 2)
+                    t_in = torch.cat([t_chunk] * 2)
+                    c_in = torch.cat([uc[start:start + max_batch_size], c_chunk])
+                    e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+                    e_t = e_t_uncond + chunk_scales[0] * (e_t - e_t_uncond)
+                else:
+                    n = x_chunk.shape[0]
+                    x_in = torch.cat([x_chunk, x_chunk[guided]])
+                    t_in = torch.cat([t_chunk, t_chunk[guided]])
+                    c_in = torch.cat([c_chunk, uc[start:start + max_batch_size][guided]])
+                    model_output = self.model.apply_model(x_in, t_in, c_in)
+                    e_t, e_t_uncond = model_output[:n].clone(), model_output[n:]
+                    weights = torch.tensor([chunk_scales[k] for k in guided], device=e_t.device,
+                                           dtype=e_t.dtype).view(-1, 1, 1, 1)
+                    e_t[guided] = e_t_uncond + weights * (e_t[guided] - e_t_uncond)
+                e_t_chunks.append(e_t)
+            return torch.cat(e_t_chunks)
+
+        def scale_of(j, i):
+            if guidance_schedule is None:
+                return unconditional_guidance_scale
+            return guidance_schedule.scale_at(i, len(extended[j]) - 1)
+
+        for i in tqdm(range(total_steps), desc='PLMS Sweep Sampler', total=total_steps):
+            # retire the trajectories that have taken all their steps. The rest of a group share this step's model
+            # evaluation as long as they are at the same timestep with the same guidance scale:
+            # an evaluation is [members, img, old_eps, t_now, scale]
+            evaluations = []
+            for members, img, old_eps in groups:
+                shared = OrderedDict()
+                for j in members:
+                    if len(extended[j]) - 1 == i:
+                        results[j] = img
+                    else:
+                        shared.setdefault((extended[j][i], scale_of(j, i)), []).append(j)
+                for (t_now, scale), shared_members in shared.items():
+                    evaluations.append([shared_members, img, old_eps, t_now, scale])
+
+            representatives = [members[0] for members, _, _, _, _ in evaluations]
+            model_evaluations += len(evaluations)
+            x = torch.cat([img for _, img, _, _, _ in evaluations])
+            c = conditioning[representatives]
+            uc = unconditional_conditioning[representatives] if unconditional_conditioning is not None else None
+            scales = [scale for _, _, _, _, scale in evaluations]
+            ts = torch.tensor([t_now for _, _, _, t_now, _ in evaluations], device=device, dtype=torch.long)
+            e_t = get_model_output(x, ts, c, uc, scales)
+
+            # fork each evaluation's trajectories on the timestep they step to - and on a first step, where PLMS
+            # evaluates the model a second time, on the timestep of that evaluation, which for a trajectory on its
+            # last step (a single step one) is its own timestep again, as plms_sampling does
+            first_step = len(evaluations[0][2]) == 0
+            forks = []  # [members, index of the evaluation forked from, t_prev, t_next]
+            for k, (members, _, _, t_now, _) in enumerate(evaluations):
+                by_next = OrderedDict()
+                for j in members:
+                    t_next = (t_now if len(extended[j]) - 2 == i else extended[j][i + 1]) if first_step else None
+                    by_next.setdefault((extended[j][i + 1], t_next), []).append(j)
+                for (t_prev, t_next), fork_members in by_next.items():
+                    forks.append([fork_members, k, t_prev, t_next])
+
+            rows = [k for _, k, _, _ in forks]
+            b = len(forks)
+            x, e_t, c, scales = x[rows], e_t[rows], c[rows], [scales[k] for k in rows]
+            uc = uc[rows] if uc is not None else None
+            t_now = [evaluations[k][3] for k in rows]
+            t_prev = [t for _, _, t, _ in forks]
+            a_t = alphas_cumprod[t_now].view(b, 1, 1, 1).to(device)
+            a_prev = alphas_cumprod[t_prev].view(b, 1, 1, 1).to(device)
+            sqrt_one_minus_at = (1. - alphas_cumprod[t_now]).sqrt().view(b, 1, 1, 1).to(device)
+
+            def get_x_prev_and_pred_x0(e_t):
+                pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+                dir_xt = (1. - a_prev).sqrt() * e_t
+                return a_prev.sqrt() * pred_x0 + dir_xt, pred_x0
+
+            old_eps = [torch.cat([evaluations[k][2][m] for k in rows]) for m in range(len(evaluations[0][2]))]
+            if first_step:
+                # Pseudo Improved Euler (2nd order)
+                x_prev, _ = get_x_prev_and_pred_x0(e_t)
+                ts_next = torch.tensor([t for _, _, _, t in forks], device=device, dtype=torch.long)
+                e_t_next = get_model_output(x_prev, ts_next, c, uc, scales)
+                model_evaluations += b
+                e_t_prime = (e_t + e_t_next) / 2
+            elif len(old_eps) == 1:
+                e_t_prime = (3 * e_t - old_eps[-1]) / 2
+            elif len(old_eps) == 2:
+                e_t_prime = (23 * e_t - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
+            else:
+                e_t_prime = (55 * e_t - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+
+            x_prev, _ = get_x_prev_and_pred_x0(e_t_prime)
+            groups = []
+            for q, (members, k, _, _) in enumerate(forks):
+                group_eps = evaluations[k][2] + [e_t[q:q + 1]]
+                groups.append([members, x_prev[q:q + 1], group_eps[-3:]])
+            if callback: callback(i)
+
+        for members, img, _ in groups:
+            for j in members:
+                results[j] = img
+
+        independent_evaluations = sum(len(ext) for ext in extended)
+        print(f"PLMS sweep used {model_evaluations} trajectory model evaluations "
+              f"instead of {independent_evaluations} for independent runs")
+        return torch.cat(results)
+
     @torch.no_grad()
     def plms_sampling(self, cond, shape,
                       x_T=None, ddim_use_original_steps=False,
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None,):
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, guidance_schedule=None,
+                      feature_cache=None):
         device = self.model.betas.device
-        b = shape[0]
         if x_T is None:
             img = torch.randn(shape, device=device)
         else:
@@ -137,11 +333,15 @@ class PLMSSampler(object):
 
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
+        buffers = self.make_step_buffers(img, cond, unconditional_conditioning, unconditional_guidance_scale,
+                                         ddim_use_original_steps)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-            ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
+            if feature_cache is not None:
+                feature_cache.step(self.model, i, total_steps)
+            ts = buffers.ts.fill_(int(step))
+            ts_next = buffers.ts_next.fill_(int(time_range[min(i + 1, len(time_range) - 1)]))
 
             if mask is not None:
                 assert x0 is not None
@@ -154,7 +354,8 @@ class PLMSSampler(object):
                                       corrector_kwargs=corrector_kwargs,
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
-                                      old_eps=old_eps, t_next=ts_next)
+                                      old_eps=old_eps, t_next=ts_next, buffers=buffers,
+                                      guidance_schedule=guidance_schedule, guidance_step=(i, total_steps))
             img, pred_x0, e_t = outs
             old_eps.append(e_t)
             if len(old_eps) >= 4:
@@ -168,21 +369,41 @@ class PLMSSampler(object):
 
         return img, intermediates
 
+    def make_step_buffers(self, x, c, unconditional_conditioning, unconditional_guidance_scale,
+                          use_original_steps=False):
+        if use_original_steps:
+            return PLMSStepBuffers(x, c, unconditional_conditioning, unconditional_guidance_scale,
+                                   self.model.alphas_cumprod, self.model.alphas_cumprod_prev,
+                                   self.model.sqrt_one_minus_alphas_cumprod,
+                                   self.model.ddim_sigmas_for_original_num_steps)
+        return PLMSStepBuffers(x, c, unconditional_conditioning, unconditional_guidance_scale, self.ddim_alphas,
+                               self.ddim_alphas_prev, self.ddim_sqrt_one_minus_alphas, self.ddim_sigmas)
+
     @torch.no_grad()
     def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
-                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
-        b, *_, device = *x.shape, x.device
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None,
+                      buffers=None, guidance_schedule=None, guidance_step=None):
+        device = x.device
+        if buffers is None:
+            buffers = self.make_step_buffers(x, c, unconditional_conditioning, unconditional_guidance_scale,
+                                             use_original_steps)
+
+        # a guidance schedule can lower this step's scale, down to 1 where only the conditional branch is run.
+        # guidance_step is (step, steps in the run), by default worked out from the index
+        scale = unconditional_guidance_scale
+        if guidance_schedule is not None:
+            total_steps = len(buffers.sigmas)
+            scale = guidance_schedule.scale_at(*(guidance_step or (total_steps - index - 1, total_steps)))
 
         def get_model_output(x, t):
-            if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            if not buffers.guided or scale == 1.:
                 e_t = self.model.apply_model(x, t, c)
             else:
-                x_in = torch.cat([x] * 2)
-                t_in = torch.cat([t] * 2)
-                c_in = torch.cat([unconditional_conditioning, c])
+                x_in, t_in, c_in = buffers.guided_inputs(x, t)
                 e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-                e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+                # e_t_uncond + scale * (e_t - e_t_uncond) in one kernel
+                e_t = torch.lerp(e_t_uncond, e_t, scale)
 
             if score_corrector is not None:
                 assert self.model.parameterization == "eps"
@@ -190,28 +411,21 @@ class PLMSSampler(object):
 
             return e_t
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-
         def get_x_prev_and_pred_x0(e_t, index):
-            # select parameters corresponding to the currently considered timestep
-            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+            # the parameters corresponding to the currently considered timestep, as host scalars
+            sigma_t = buffers.sigmas[index]
 
             # current prediction for x_0
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+            pred_x0 = torch.add(x, e_t, alpha=-buffers.sqrt_one_minus_alphas[index]).div_(buffers.sqrt_alphas[index])
             if quantize_denoised:
                 pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-            # direction pointing to x_t
-            dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+            # direction pointing to x_t, plus the previous x_0 estimate
+            x_prev = torch.add(e_t * buffers.dir_xt[index], pred_x0, alpha=buffers.sqrt_alphas_prev[index])
+            if sigma_t != 0.:
+                noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+                if noise_dropout > 0.:
+                    noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+                x_prev += noise
             return x_prev, pred_x0
 
         e_t = get_model_output(x, t)
@@ -0,0 +1,17 @@
+"""SAMPLING ONLY."""
+
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.models.diffusion.euler_ancestral import EulerAncestralSampler
+from ldm.models.diffusion.unipc import UniPCSampler
+
+# The txt2img samplers by the name a request or a script chooses them with. The fast solvers give good images in
+# 15-20 steps where plms and ddim need around 40. Only plms can sweep several ddim step counts in one pass.
+SAMPLERS = {
+    'plms': PLMSSampler,
+    'ddim': DDIMSampler,
+    'dpm++2m': DPMSolverSampler,
+    'euler_a': EulerAncestralSampler,
+    'unipc': UniPCSampler,
+}
@@ -0,0 +1,91 @@
+"""SAMPLING ONLY."""
+
+import torch
+import numpy as np
+
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps
+
+
+def make_sampler_schedule(model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+    """
+    Build the buffers a DDIM-style sampler needs for `ddim_num_steps` steps of `model`.
+    Returns a dict of attribute name -> buffer that the sampler sets on itself.
+    """
+    device = model.betas.device
+    ddpm_num_timesteps = model.num_timesteps
+    schedule = {}
+
+    def register_buffer(name, attr):
+        if type(attr) == torch.Tensor:
+            if attr.device != device:
+                attr = attr.to(device)
+        schedule[name] = attr
+
+    alphas_cumprod = model.alphas_cumprod
+    assert alphas_cumprod.shape[0] == ddpm_num_timesteps, 'alphas have to be defined for each timestep'
+    to_torch = lambda x: x.clone().detach().to(torch.float32).to(model.device)
+    alphas_cumprod_cpu = alphas_cumprod.cpu()
+    ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
+                                         num_ddpm_timesteps=ddpm_num_timesteps, verbose=verbose,
+                                         alphas_cumprod=alphas_cumprod_cpu.to(torch.float64).numpy())
+    schedule['ddim_timesteps'] = ddim_timesteps
+
+    register_buffer('betas', to_torch(model.betas))
+    register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
+    register_buffer('alphas_cumprod_prev', to_torch(model.alphas_cumprod_prev))
+
+    # calculations for diffusion q(x_t | x_{t-1}) and others
+    register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod_cpu)))
+    register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod_cpu)))
+    register_buffer('log_one_minus_alphas_cumprod', to_torch(np.log(1. - alphas_cumprod_cpu)))
+    register_buffer('sqrt_recip_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod_cpu)))
+    register_buffer('sqrt_recipm1_alphas_cumprod', to_torch(np.sqrt(1. / alphas_cumprod_cpu - 1)))
+
+    # ddim sampling parameters
+    ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod_cpu,
+                                                                               ddim_timesteps=ddim_timesteps,
+                                                                               eta=ddim_eta, verbose=verbose)
+    register_buffer('ddim_sigmas', ddim_sigmas)
+    register_buffer('ddim_alphas', ddim_alphas)
+    register_buffer('ddim_alphas_prev', ddim_alphas_prev)
+    register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
+    sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
+        (1 - schedule['alphas_cumprod_prev']) / (1 - schedule['alphas_cumprod']) * (
+                1 - schedule['alphas_cumprod'] / schedule['alphas_cumprod_prev']))
+    register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+    return schedule
+
+
+class ScheduleCache(object):
+    """
+    Memoizes make_sampler_schedule() so that every sampler instance asking for the same
+    (model, num_steps, discretize, eta, device, dtype) reuses one set of buffers.
+    The cached buffers are shared between samplers, so they must be treated as read-only.
+    """
+    def __init__(self):
+        self.schedules = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (id(model), int(ddim_num_steps), ddim_discretize, float(ddim_eta), str(model.betas.device),
+               model.betas.dtype)
+        schedule = self.schedules.get(key)
+        if schedule is None:
+            self.misses += 1
+            schedule = make_sampler_schedule(model, ddim_num_steps, ddim_discretize=ddim_discretize,
+                                             ddim_eta=ddim_eta, verbose=verbose)
+            self.schedules[key] = schedule
+        else:
+            self.hits += 1
+        return schedule
+
+    def clear(self):
+        self.schedules.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'schedules': len(self.schedules)}
+
+
+# shared by PLMSSampler and DDIMSampler
+schedule_cache = ScheduleCache()
@@ -0,0 +1,111 @@
+"""SAMPLING ONLY."""
+
+import math
+import torch
+import numpy as np
+
+from ldm.modules.diffusionmodules.util import noise_from_generators
+from ldm.models.diffusion.schedule_cache import schedule_cache
+from ldm.models.diffusion.feature_cache import feature_cache_scope
+
+
+class SolverSampler(object):
+    """
+    Base for the fast samplers (DPM-Solver++, Euler ancestral and UniPC). They take the same sample() arguments
+    as PLMSSampler and DDIMSampler, use the same timesteps for a given number of steps and work straight from the
+    model's alphas_cumprod and apply_model(). Subclasses implement solve().
+    """
+    name = 'Solver'
+    stochastic = False  # True if eta > 0 is allowed, i.e. the sampler can add fresh noise at each step
+
+    def __init__(self, model, **kwargs):
+        super().__init__()
+        self.model = model
+        self.alphas_cumprod = None
+
+    def make_timesteps(self, ddim_num_steps, ddim_discretize="uniform", verbose=True):
+        # the timesteps the model is evaluated at, highest first, followed by 0 which the last step lands on
+        ddim_timesteps = schedule_cache.get(self.model, ddim_num_steps, ddim_discretize=ddim_discretize,
+                                            ddim_eta=0., verbose=verbose)['ddim_timesteps']
+        timesteps = [int(t) for t in np.flip(ddim_timesteps)]
+        if timesteps[-1] != 0:
+            timesteps.append(0)
+        return timesteps
+
+    def marginals(self, t):
+        # alpha_t and sigma_t of x_t = alpha_t * x_0 + sigma_t * noise
+        alpha_cumprod = float(self.alphas_cumprod[t])
+        return math.sqrt(alpha_cumprod), math.sqrt(1. - alpha_cumprod)
+
+    def log_snr(self, t):
+        # lambda_t = log(alpha_t / sigma_t), the "time" the DPM-Solver family steps in
+        alpha_t, sigma_t = self.marginals(t)
+        return math.log(alpha_t / sigma_t)
+
+    def noise(self, x, generators=None):
+        # fresh noise for stochastic samplers, from each image's own generator when given so that an image
+        # doesn't depend on whatever else is in its batch
+        if generators is None:
+            return torch.randn_like(x)
+        return noise_from_generators(x, generators)
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               img_callback=None,
+               eta=0.,
+               verbose=True,
+               x_T=None,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               ddim_discretize="uniform",
+               guidance_schedule=None,
+               feature_cache=None,
+               generators=None,
+               **kwargs
+               ):
+        if eta != 0 and not self.stochastic:
+            raise ValueError(f'ddim_eta must be 0 for {self.name}')
+        if conditioning is not None and conditioning.shape[0] != batch_size:
+            print(f"Warning: Got {conditioning.shape[0]} conditionings but batch-size is {batch_size}")
+
+        device = self.model.betas.device
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        print(f'Data shape for {self.name} sampling is {size}')
+        img = torch.randn(size, device=device) if x_T is None else x_T
+        self.alphas_cumprod = self.model.alphas_cumprod.detach().to(torch.float64).cpu()
+        timesteps = self.make_timesteps(S, ddim_discretize=ddim_discretize, verbose=verbose)
+        total_steps = len(timesteps) - 1
+
+        def get_model_output(x, t, i):
+            ts = torch.full((x.shape[0],), t, device=device, dtype=torch.long)
+            if feature_cache is not None:
+                feature_cache.step(self.model, i, total_steps)
+            scale = unconditional_guidance_scale
+            if guidance_schedule is not None:
+                scale = guidance_schedule.scale_at(i, total_steps)
+            if unconditional_conditioning is None or scale == 1.:
+                return self.model.apply_model(x, ts, conditioning)
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([ts] * 2)
+            c_in = torch.cat([unconditional_conditioning, conditioning])
+            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
+            return torch.lerp(e_t_uncond, e_t, scale)
+
+        with feature_cache_scope(self.model, feature_cache):
+            samples = self.solve(img, timesteps, get_model_output, callback=callback, img_callback=img_callback,
+                                 eta=eta, generators=generators)
+        return samples, {'x_inter': [img, samples], 'pred_x0': []}
+
+    def solve(self, x, timesteps, get_model_output, callback=None, img_callback=None, eta=0., generators=None):
+        """
+        Take x from timesteps[0] to timesteps[-1], calling get_model_output(x, t, i) (the guided noise prediction
+        at step i) once per step, callback(i) after each step and img_callback(pred_x0, i) with the step's x_0
+        estimate.
+        """
+        raise NotImplementedError()
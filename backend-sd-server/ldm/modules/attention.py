@@ -77,6 +77,51 @@ def Normalize(in_channels):
     return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
 
+# 'einsum' materializes the full (i x j) attention matrix, 'sliced' computes it attention_chunk_size queries at a
+# time to bound peak memory, 'sdpa' uses torch.nn.functional.scaled_dot_product_attention (PyTorch 2.0+)
+ATTENTION_BACKENDS = ['einsum', 'sliced', 'sdpa']
+
+
+def resolve_attention_backend(backend):
+    assert backend in ATTENTION_BACKENDS, f'attention backend {backend} unknown'
+    if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+        print("scaled_dot_product_attention needs PyTorch 2.0 or later - using 'sliced' attention instead")
+        return 'sliced'
+    return backend
+
+
+def attention(q, k, v, scale, mask=None, backend='einsum', chunk_size=1024):
+    """
+    Softmax attention of queries q (b, i, d) over keys k (b, j, d) and values v (b, j, e), returning (b, i, e).
+    mask, if given, is a boolean (b, 1, j) tensor which is True where attention is allowed.
+    All backends compute the same result; they differ in how much memory they need.
+    """
+    if backend == 'sdpa':
+        # the scale argument only exists from PyTorch 2.1, and is only needed if it is not the default 1/sqrt(d)
+        kwargs = {} if scale == q.shape[-1] ** -0.5 else {'scale': scale}
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, **kwargs)
+
+    if backend == 'sliced':
+        out = torch.empty(q.shape[0], q.shape[1], v.shape[-1], device=q.device, dtype=v.dtype)
+        for start in range(0, q.shape[1], chunk_size):
+            end = start + chunk_size
+            sim = einsum('b i d, b j d -> b i j', q[:, start:end], k) * scale
+            if exists(mask):
+                sim.masked_fill_(~mask, max_neg_value(sim))
+            out[:, start:end] = einsum('b i j, b j d -> b i d', sim.softmax(dim=-1), v)
+        return out
+
+    sim = einsum('b i d, b j d -> b i j', q, k) * scale
+
+    if exists(mask):
+        sim.masked_fill_(~mask, max_neg_value(sim))
+
+    # attention, what we cannot get enough of
+    attn = sim.softmax(dim=-1)
+
+    return einsum('b i j, b j d -> b i d', attn, v)
+
+
 class LinearAttention(nn.Module):
     def __init__(self, dim, heads=4, dim_head=32):
         super().__init__()
@@ -97,9 +142,11 @@ class LinearAttention(nn.Module):
 
 
 class SpatialSelfAttention(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, attention_backend='einsum', attention_chunk_size=1024):
         super().__init__()
         self.in_channels = in_channels
+        self.attention_backend = resolve_attention_backend(attention_backend)
+        self.attention_chunk_size = attention_chunk_size
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -132,31 +179,26 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
-
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+        h_ = attention(q, k, v, int(c)**(-0.5), backend=self.attention_backend,
+                       chunk_size=self.attention_chunk_size)
+        h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
         h_ = self.proj_out(h_)
 
         return x+h_
 
 
 class CrossAttention(nn.Module):
-    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
+    def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., attention_backend='einsum',
+                 attention_chunk_size=1024):
         super().__init__()
         inner_dim = dim_head * heads
         context_dim = default(context_dim, query_dim)
 
         self.scale = dim_head ** -0.5
         self.heads = heads
+        self.attention_backend = resolve_attention_backend(attention_backend)
+        self.attention_chunk_size = attention_chunk_size
 
         self.to_q = nn.Linear(query_dim, inner_dim, bias=False)
         self.to_k = nn.Linear(context_dim, inner_dim, bias=False)
@@ -177,29 +219,28 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
-
-        # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
 
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = attention(q, k, v, self.scale, mask=mask, backend=self.attention_backend,
+                        chunk_size=self.attention_chunk_size)
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
 
 class BasicTransformerBlock(nn.Module):
-    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
+    def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
+                 attention_backend='einsum', attention_chunk_size=1024):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
+        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    attention_backend=attention_backend,
+                                    attention_chunk_size=attention_chunk_size)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
         self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
+                                    heads=n_heads, dim_head=d_head, dropout=dropout,
+                                    attention_backend=attention_backend,
+                                    attention_chunk_size=attention_chunk_size)  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
@@ -224,7 +265,7 @@ class SpatialTransformer(nn.Module):
     Finally, reshape to image
     """
     def __init__(self, in_channels, n_heads, d_head,
-                 depth=1, dropout=0., context_dim=None):
+                 depth=1, dropout=0., context_dim=None, attention_backend='einsum', attention_chunk_size=1024):
         super().__init__()
         self.in_channels = in_channels
         inner_dim = n_heads * d_head
@@ -237,7 +278,8 @@ class SpatialTransformer(nn.Module):
                                  padding=0)
 
         self.transformer_blocks = nn.ModuleList(
-            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim)
+            [BasicTransformerBlock(inner_dim, n_heads, d_head, dropout=dropout, context_dim=context_dim,
+                                   attention_backend=attention_backend, attention_chunk_size=attention_chunk_size)
                 for d in range(depth)]
         )
 
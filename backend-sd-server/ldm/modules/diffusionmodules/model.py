@@ -6,7 +6,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, attention, resolve_attention_backend
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -148,9 +148,11 @@ class LinAttnBlock(LinearAttention):
 
 
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, attention_backend="einsum", attention_chunk_size=1024):
         super().__init__()
         self.in_channels = in_channels
+        self.attention_backend = resolve_attention_backend(attention_backend)
+        self.attention_chunk_size = attention_chunk_size
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -184,29 +186,35 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        if self.attention_backend == "einsum":
+            q = q.reshape(b,c,h*w)
+            q = q.permute(0,2,1)   # b,hw,c
+            k = k.reshape(b,c,h*w) # b,c,hw
+            w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
+            w_ = w_ * (int(c)**(-0.5))
+            w_ = torch.nn.functional.softmax(w_, dim=2)
+
+            # attend to values
+            v = v.reshape(b,c,h*w)
+            w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
+            h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
+            h_ = h_.reshape(b,c,h,w)
+        else:
+            q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+            h_ = attention(q, k, v, int(c)**(-0.5), backend=self.attention_backend,
+                           chunk_size=self.attention_chunk_size)
+            h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
 
         h_ = self.proj_out(h_)
 
         return x+h_
 
 
-def make_attn(in_channels, attn_type="vanilla"):
+def make_attn(in_channels, attn_type="vanilla", attention_backend="einsum", attention_chunk_size=1024):
     assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
-        return AttnBlock(in_channels)
+        return AttnBlock(in_channels, attention_backend=attention_backend, attention_chunk_size=attention_chunk_size)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
@@ -216,7 +224,8 @@ def make_attn(in_channels, attn_type="vanilla"):
 class Model(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla"):
+                 resolution, use_timestep=True, use_linear_attn=False, attn_type="vanilla",
+                 attention_backend="einsum", attention_chunk_size=1024):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -259,7 +268,8 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                          attention_chunk_size=attention_chunk_size))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -274,7 +284,8 @@ class Model(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                    attention_chunk_size=attention_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -296,7 +307,8 @@ class Model(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                          attention_chunk_size=attention_chunk_size))
             up = nn.Module()
             up.block = block
             up.attn = attn
@@ -369,7 +381,7 @@ class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, double_z=True, use_linear_attn=False, attn_type="vanilla",
-                 **ignore_kwargs):
+                 attention_backend="einsum", attention_chunk_size=1024, **ignore_kwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -402,7 +414,8 @@ class Encoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                          attention_chunk_size=attention_chunk_size))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -417,7 +430,8 @@ class Encoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                    attention_chunk_size=attention_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -463,7 +477,7 @@ class Decoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
                  resolution, z_channels, give_pre_end=False, tanh_out=False, use_linear_attn=False,
-                 attn_type="vanilla", **ignorekwargs):
+                 attn_type="vanilla", attention_backend="einsum", attention_chunk_size=1024, **ignorekwargs):
         super().__init__()
         if use_linear_attn: attn_type = "linear"
         self.ch = ch
@@ -496,7 +510,8 @@ class Decoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type)
+        self.mid.attn_1 = make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                    attention_chunk_size=attention_chunk_size)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -515,7 +530,8 @@ class Decoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(make_attn(block_in, attn_type=attn_type))
+                    attn.append(make_attn(block_in, attn_type=attn_type, attention_backend=attention_backend,
+                                          attention_chunk_size=attention_chunk_size))
             up = nn.Module()
             up.block = block
             up.attn = attn
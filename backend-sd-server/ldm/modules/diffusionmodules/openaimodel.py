@@ -298,6 +298,7 @@ class AttentionBlock(nn.Module):
             ), f"q,k,v channels {channels} is not divisible by num_head_channels {num_head_channels}"
             self.num_heads = channels // num_head_channels
         self.use_checkpoint = use_checkpoint
+        self.checkpoint = True  # always checkpointed when training; switched off by enable_inference_mode()
         self.norm = normalization(channels)
         self.qkv = conv_nd(1, channels, channels * 3, 1)
         if use_new_attention_order:
@@ -310,7 +311,7 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
+        return checkpoint(self._forward, (x,), self.parameters(), self.checkpoint)   # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
         #return pt_checkpoint(self._forward, x)  # pytorch
 
     def _forward(self, x):
@@ -436,6 +437,12 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: how the spatial transformers compute attention - 'einsum',
+                              'sliced' or 'sdpa' (see ldm.modules.attention.ATTENTION_BACKENDS).
+    :param attention_chunk_size: number of queries per slice for the 'sliced' backend.
+
+    The model can cache its deep features across sampling steps (DeepCache, Ma et al., 2023), see
+    set_feature_cache().
     """
 
     def __init__(
@@ -464,6 +471,8 @@ class UNetModel(nn.Module):
         context_dim=None,                 # custom transformer support
         n_embed=None,                     # custom support for prediction of discrete ids into codebook of first stage vq model
         legacy=True,
+        attention_backend='einsum',       # custom transformer support
+        attention_chunk_size=1024,        # custom transformer support
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -553,7 +562,8 @@ class UNetModel(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim,
+                            attention_backend=attention_backend, attention_chunk_size=attention_chunk_size
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -608,7 +618,8 @@ class UNetModel(nn.Module):
                 num_head_channels=dim_head,
                 use_new_attention_order=use_new_attention_order,
             ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim,
+                            attention_backend=attention_backend, attention_chunk_size=attention_chunk_size
                         ),
             ResBlock(
                 ch,
@@ -654,7 +665,8 @@ class UNetModel(nn.Module):
                             num_head_channels=dim_head,
                             use_new_attention_order=use_new_attention_order,
                         ) if not use_spatial_transformer else SpatialTransformer(
-                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim
+                            ch, num_heads, dim_head, depth=transformer_depth, context_dim=context_dim,
+                            attention_backend=attention_backend, attention_chunk_size=attention_chunk_size
                         )
                     )
                 if level and i == num_res_blocks:
@@ -689,6 +701,11 @@ class UNetModel(nn.Module):
             #nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
         )
 
+        self.cache_branch = None  # feature caching is off while this is None
+        self.cache_refresh = True
+        self.cached_features = None
+        self.cached_shape = None
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -705,6 +722,23 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def set_feature_cache(self, branch=None):
+        """
+        Turn feature caching on, or off with branch=None, and empty the cache.
+        While it is on, a forward pass with cache_refresh set runs the whole model and caches the input of the
+        output block paired with input block `branch` (the features coming up from everything deeper). A pass
+        with cache_refresh cleared runs only input blocks 0 to `branch` and their output blocks on top of the
+        cached features - branch 0 skips all but two of the model's 25 blocks. The sampler sets cache_refresh
+        before each step; a pass whose input shape differs from the cached one always runs the whole model.
+        :param branch: index of the deepest input block that is recomputed on cached passes.
+        """
+        if branch is not None and not 0 <= branch < len(self.input_blocks) - 1:
+            raise ValueError(f'feature cache branch must be between 0 and {len(self.input_blocks) - 2}')
+        self.cache_branch = branch
+        self.cache_refresh = True
+        self.cached_features = None
+        self.cached_shape = None
+
     def forward(self, x, timesteps=None, context=None, y=None,**kwargs):
         """
         Apply the model to an input batch.
@@ -725,12 +759,24 @@ class UNetModel(nn.Module):
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
+        branch = self.cache_branch
+        use_cache = (branch is not None and not self.cache_refresh and self.cached_features is not None
+                     and self.cached_shape == x.shape)
         h = x.type(self.dtype)
-        for module in self.input_blocks:
+        for module in (self.input_blocks[:branch + 1] if use_cache else self.input_blocks):
             h = module(h, emb, context)
             hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        if use_cache:
+            h = self.cached_features
+            output_blocks = self.output_blocks[len(self.output_blocks) - branch - 1:]
+        else:
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+        for k, module in enumerate(output_blocks):
+            if branch is not None and not use_cache and k == len(output_blocks) - branch - 1:
+                # the features coming up to the branch's output block, reused until the next refresh
+                self.cached_features = h
+                self.cached_shape = x.shape
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
@@ -42,18 +42,91 @@ def make_beta_schedule(schedule, n_timestep, linear_start=1e-4, linear_end=2e-2,
     return betas.numpy()
 
 
-def make_ddim_timesteps(ddim_discr_method, num_ddim_timesteps, num_ddpm_timesteps, verbose=True):
-    if ddim_discr_method == 'uniform':
-        c = num_ddpm_timesteps // num_ddim_timesteps
-        ddim_timesteps = np.asarray(list(range(0, num_ddpm_timesteps, c)))
-    elif ddim_discr_method == 'quad':
-        ddim_timesteps = ((np.linspace(0, np.sqrt(num_ddpm_timesteps * .8), num_ddim_timesteps)) ** 2).astype(int)
-    else:
-        raise NotImplementedError(f'There is no ddim discretization method called "{ddim_discr_method}"')
-
-    # assert ddim_timesteps.shape[0] == num_ddim_timesteps
+# Ways of choosing which of the DDPM timesteps a DDIM-style sampler visits. Each takes the number of steps wanted
+# (1 to the number of DDPM timesteps), the number of DDPM timesteps and the model's alphas_cumprod (as a numpy
+# array) and returns exactly that many distinct timesteps in ascending order, ready to index alphas_cumprod with.
+# Add more with @register_ddim_discretization.
+DDIM_DISCRETIZATIONS = {}
+
+
+def register_ddim_discretization(name):
+    def register(discretization):
+        DDIM_DISCRETIZATIONS[name] = discretization
+        return discretization
+    return register
+
+
+def make_timesteps_distinct(timesteps, num_ddpm_timesteps):
+    # Rounding puts neighbouring steps on the same timestep, or past the last one, when the steps are closer
+    # together than the DDPM timesteps - move them apart, up and then back down from the last timestep
+    timesteps = np.clip(np.asarray(timesteps, dtype=int), 0, num_ddpm_timesteps - 1)
+    for i in range(1, len(timesteps)):
+        timesteps[i] = max(timesteps[i], timesteps[i - 1] + 1)
+    timesteps[-1] = min(timesteps[-1], num_ddpm_timesteps - 1)
+    for i in range(len(timesteps) - 2, -1, -1):
+        timesteps[i] = min(timesteps[i], timesteps[i + 1] - 1)
+    return timesteps
+
+
+@register_ddim_discretization('uniform')
+def uniform_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None):
+    # the original spacing, cut to num_ddim_timesteps steps for step counts that don't divide num_ddpm_timesteps
+    c = num_ddpm_timesteps // num_ddim_timesteps
     # add one to get the final alpha values right (the ones from first scale to data during sampling)
-    steps_out = ddim_timesteps + 1
+    timesteps = np.asarray(list(range(0, num_ddpm_timesteps, c)))[:num_ddim_timesteps] + 1
+    return make_timesteps_distinct(timesteps, num_ddpm_timesteps)
+
+
+@register_ddim_discretization('quad')
+def quad_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None):
+    timesteps = ((np.linspace(0, np.sqrt(num_ddpm_timesteps * .8), num_ddim_timesteps)) ** 2).astype(int) + 1
+    return make_timesteps_distinct(timesteps, num_ddpm_timesteps)
+
+
+@register_ddim_discretization('uniform-exact')
+def uniform_exact_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None):
+    # exactly num_ddim_timesteps evenly spaced steps from timestep 1 up to the last, pure noise, timestep
+    timesteps = np.round(np.linspace(1, num_ddpm_timesteps - 1, num_ddim_timesteps)).astype(int)
+    return make_timesteps_distinct(timesteps, num_ddpm_timesteps)
+
+
+@register_ddim_discretization('leading')
+def leading_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None):
+    # the uniform spacing from timestep 1, but exactly num_ddim_timesteps of them
+    timesteps = np.arange(num_ddim_timesteps) * (num_ddpm_timesteps // num_ddim_timesteps) + 1
+    return make_timesteps_distinct(timesteps, num_ddpm_timesteps)
+
+
+@register_ddim_discretization('trailing')
+def trailing_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None):
+    # evenly spaced back from the last timestep, so sampling starts from pure noise (Lin et al., 2023)
+    timesteps = np.round(np.arange(num_ddpm_timesteps, 0, -num_ddpm_timesteps / num_ddim_timesteps)).astype(int) - 1
+    return make_timesteps_distinct(np.flip(timesteps[:num_ddim_timesteps]), num_ddpm_timesteps)
+
+
+@register_ddim_discretization('karras')
+def karras_discretization(num_ddim_timesteps, num_ddpm_timesteps, alphas_cumprod=None, rho=7.):
+    # Karras et al. (2022) spacing of the noise levels sigma = sqrt((1 - alpha) / alpha), rho = 7, between
+    # timesteps 1 and num_ddpm_timesteps - 1, each mapped to the timestep with the closest sigma. More steps are
+    # spent at low noise levels, where the image detail is decided.
+    assert alphas_cumprod is not None, 'the karras discretization needs the model\'s alphas_cumprod'
+    log_sigmas = 0.5 * np.log((1 - alphas_cumprod) / alphas_cumprod)
+    sigma_min, sigma_max = np.exp(log_sigmas[1]), np.exp(log_sigmas[num_ddpm_timesteps - 1])
+    ramp = np.linspace(0, 1, num_ddim_timesteps)
+    sigmas = (sigma_min ** (1 / rho) + ramp * (sigma_max ** (1 / rho) - sigma_min ** (1 / rho))) ** rho
+    timesteps = np.abs(np.log(sigmas)[:, None] - log_sigmas[None, :]).argmin(axis=1)
+    return make_timesteps_distinct(timesteps, num_ddpm_timesteps)
+
+
+def make_ddim_timesteps(ddim_discr_method, num_ddim_timesteps, num_ddpm_timesteps, verbose=True,
+                        alphas_cumprod=None):
+    if ddim_discr_method not in DDIM_DISCRETIZATIONS:
+        raise NotImplementedError(f'There is no ddim discretization method called "{ddim_discr_method}"')
+    if not 1 <= num_ddim_timesteps <= num_ddpm_timesteps:
+        raise ValueError(f'ddim steps must be between 1 and {num_ddpm_timesteps}, not {num_ddim_timesteps}')
+    steps_out = DDIM_DISCRETIZATIONS[ddim_discr_method](num_ddim_timesteps, num_ddpm_timesteps,
+                                                        alphas_cumprod=alphas_cumprod)
+    assert steps_out.max() < num_ddpm_timesteps, f'too many steps for the "{ddim_discr_method}" discretization'
     if verbose:
         print(f'Selected timesteps for ddim sampler: {steps_out}')
     return steps_out
@@ -98,6 +171,19 @@ def extract_into_tensor(a, t, x_shape):
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
 
+def disable_checkpointing(model):
+    """
+    Turn off gradient checkpointing in every block of `model`. Checkpointing only saves memory
+    when training; at inference it costs a CheckpointFunction call per block per step.
+    """
+    for module in model.modules():
+        if hasattr(module, 'use_checkpoint'):
+            module.use_checkpoint = False
+        if isinstance(getattr(module, 'checkpoint', None), bool):
+            module.checkpoint = False
+    return model
+
+
 def checkpoint(func, inputs, params, flag):
     """
     Evaluate a function without caching intermediate activations, allowing for
@@ -263,4 +349,10 @@ class HybridConditioner(nn.Module):
 def noise_like(shape, device, repeat=False):
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
-    return repeat_noise() if repeat else noise()
\ No newline at end of file
+    return repeat_noise() if repeat else noise()
+
+
+def noise_from_generators(x, generators):
+    # noise like x with each row drawn from its own (CPU) generator, so a row's noise doesn't depend on what else
+    # is in the batch or on the device
+    return torch.stack([torch.randn(x.shape[1:], generator=generator) for generator in generators]).to(x)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from functools import partial
 import clip
 from einops import repeat
@@ -134,14 +135,67 @@ class SpatialRescaler(nn.Module):
     def encode(self, x):
         return self(x)
 
+class ConditioningCache(object):
+    """
+    LRU cache of per-prompt text embeddings, bounded by the number of bytes the cached tensors hold.
+    Pinned entries (e.g. the unconditional embedding) are never evicted and do not count towards the budget.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.pinned:
+            self.hits += 1
+            return self.pinned[key]
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, z, pin=False):
+        if pin:
+            self.pinned[key] = z
+            return
+        size = z.numel() * z.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= self.entries[key].numel() * self.entries[key].element_size()
+        self.entries[key] = z
+        self.entries.move_to_end(key)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                'pinned': len(self.pinned), 'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+
 class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77,
+                 cache_max_bytes=64 * 1024 * 1024):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
+        # embeddings are cached by token ids - set cache_max_bytes to 0 to switch the cache off
+        self.cache = ConditioningCache(cache_max_bytes) if cache_max_bytes > 0 else None
+        self.unconditional_tokens = None
         self.freeze()
 
     def freeze(self):
@@ -149,14 +203,41 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
-    def forward(self, text):
+    def tokenize(self, text):
         batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
                                         return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
-        tokens = batch_encoding["input_ids"].to(self.device)
-        outputs = self.transformer(input_ids=tokens)
+        return batch_encoding["input_ids"]
 
-        z = outputs.last_hidden_state
-        return z
+    def forward(self, text):
+        tokens = self.tokenize(text)
+        if self.cache is None:
+            outputs = self.transformer(input_ids=tokens.to(self.device))
+            z = outputs.last_hidden_state
+            return z
+
+        if self.unconditional_tokens is None:
+            self.unconditional_tokens = tuple(self.tokenize([""])[0].tolist())
+
+        # the autocast flag is part of the key as it changes the dtype of the embedding
+        autocast_enabled = torch.is_autocast_enabled()
+        keys = [(tuple(row.tolist()), autocast_enabled) for row in tokens]
+        embeddings = [self.cache.get(key) for key in keys]
+
+        # run the transformer once over the distinct prompts that missed the cache
+        missing_keys = list(OrderedDict.fromkeys(key for key, z in zip(keys, embeddings) if z is None))
+        if len(missing_keys) > 0:
+            missing_tokens = torch.tensor([key[0] for key in missing_keys], dtype=tokens.dtype)
+            with torch.no_grad():
+                outputs = self.transformer(input_ids=missing_tokens.to(self.device))
+            for key, z in zip(missing_keys, outputs.last_hidden_state):
+                self.cache.put(key, z.clone(), pin=key[0] == self.unconditional_tokens)
+            computed = dict(zip(missing_keys, outputs.last_hidden_state))
+            embeddings = [computed[key] if z is None else z for key, z in zip(keys, embeddings)]
+
+        return torch.stack(embeddings)
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {}
 
     def encode(self, text):
         return self(text)
@@ -5,6 +5,7 @@ import numpy as np
 from collections import abc
 from einops import rearrange
 from functools import partial
+from contextlib import contextmanager
 
 import multiprocessing as mp
 from threading import Thread
@@ -85,6 +86,31 @@ def instantiate_from_config(config):
     return get_obj_from_str(config["target"])(**config.get("params", dict()))
 
 
+@contextmanager
+def skip_weight_init():
+    """
+    Build modules without running their random weight initialisation, for when every weight is about
+    to be overwritten from a checkpoint anyway. Parameters are left allocated but uninitialised.
+    """
+    layers = [torch.nn.Linear, torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d, torch.nn.Embedding,
+              torch.nn.GroupNorm, torch.nn.LayerNorm]
+    saved_reset_parameters = [(layer, layer.reset_parameters) for layer in layers]
+    init_names = ['uniform_', 'normal_', 'constant_', 'zeros_', 'ones_', 'xavier_uniform_', 'xavier_normal_',
+                  'kaiming_uniform_', 'kaiming_normal_', 'trunc_normal_']
+    saved_init = [(name, getattr(torch.nn.init, name)) for name in init_names]
+    try:
+        for layer in layers:
+            layer.reset_parameters = lambda self: None
+        for name in init_names:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for layer, reset_parameters in saved_reset_parameters:
+            layer.reset_parameters = reset_parameters
+        for name, init in saved_init:
+            setattr(torch.nn.init, name, init)
+
+
 def get_obj_from_str(string, reload=False):
     module, cls = string.rsplit(".", 1)
     if reload:
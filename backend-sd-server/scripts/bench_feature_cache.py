@@ -0,0 +1,84 @@
+"""
+Speed / quality benchmark for UNet feature caching (see FeatureCacheSchedule). Each sampler samples the same
+prompts from the same starting noise with the whole UNet on every step, then with the feature cache refreshed
+every N steps. Reports the time per image, the speedup and the PSNR of the cached images against the uncached
+ones - above about 30 dB the difference is hard to see.
+
+    python3 scripts/bench_feature_cache.py --ckpt models/ldm/stable-diffusion-v1/model.ckpt --intervals 2 3 5
+
+On a machine without a GPU, run it with --precision full and fewer, smaller images, e.g. --H 256 --W 256.
+"""
+import argparse, time
+import torch
+from omegaconf import OmegaConf
+from contextlib import nullcontext
+
+from ldm.models.diffusion.feature_cache import FeatureCacheSchedule
+from ldm.models.diffusion.samplers import SAMPLERS
+from scripts.bench_util import PROMPTS, load_model, synchronize, psnr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt")
+    parser.add_argument("--samplers", nargs="+", default=['plms', 'dpm++2m'], choices=list(SAMPLERS))
+    parser.add_argument("--steps", type=int, default=None,
+                        help="steps per image - 40 for plms and ddim and 20 for the other samplers if not given")
+    parser.add_argument("--intervals", nargs="+", type=int, default=[2, 3, 5],
+                        help="run the whole UNet every this many steps")
+    parser.add_argument("--branches", nargs="+", type=int, default=[0],
+                        help="deepest UNet input block recomputed on the cached steps")
+    parser.add_argument("--n_prompts", type=int, default=len(PROMPTS))
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    model = load_model(OmegaConf.load(opt.config), opt.ckpt, device)
+    prompts = PROMPTS[:opt.n_prompts]
+    shape = [4, opt.H // 8, opt.W // 8]
+    batch_size = len(prompts)
+    x_T = torch.randn([batch_size] + shape, generator=torch.Generator().manual_seed(opt.seed)).to(device)
+    precision_scope = torch.autocast if opt.precision == "autocast" else nullcontext
+
+    with torch.inference_mode(), precision_scope(device.type), model.ema_scope():
+        c = model.get_learned_conditioning(prompts)
+        uc = model.get_learned_conditioning(batch_size * [""])
+
+        def run(sampler_name, steps, feature_cache=None):
+            sampler = SAMPLERS[sampler_name](model)
+            synchronize(device)
+            tic = time.perf_counter()
+            samples, _ = sampler.sample(S=steps, batch_size=batch_size, shape=shape, conditioning=c,
+                                        unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc,
+                                        eta=0., x_T=x_T.clone(), feature_cache=feature_cache, verbose=False,
+                                        generators=[torch.Generator().manual_seed(opt.seed + k)
+                                                    for k in range(batch_size)])
+            synchronize(device)
+            seconds = (time.perf_counter() - tic) / batch_size
+            return model.decode_first_stage(samples).float(), seconds
+
+        results = []
+        for sampler_name in opt.samplers:
+            steps = opt.steps or (40 if sampler_name in ('plms', 'ddim') else 20)
+            reference, reference_seconds = run(sampler_name, steps)
+            results.append((sampler_name, steps, 1, '-', reference_seconds, 1.0, float('inf')))
+            for branch in opt.branches:
+                for interval in opt.intervals:
+                    images, seconds = run(sampler_name, steps, FeatureCacheSchedule(interval, branch))
+                    results.append((sampler_name, steps, interval, branch, seconds, reference_seconds / seconds,
+                                    psnr(images, reference)))
+
+    print(f"\n{'sampler':<10} {'steps':>6} {'interval':>9} {'branch':>7} {'s/image':>9} {'speedup':>8} {'PSNR dB':>9}")
+    for sampler_name, steps, interval, branch, seconds, speedup, quality in results:
+        print(f"{sampler_name:<10} {steps:>6} {interval:>9} {branch:>7} {seconds:>9.2f} {speedup:>7.2f}x "
+              f"{quality:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Times the UNet forward pass the way the samplers call it (a classifier-free guidance batch of
+conditional + unconditional latents) with gradient checkpointing under torch.no_grad(), against
+checkpointing switched off under torch.inference_mode().
+
+The UNet is built from the inference config with random weights, so no checkpoint is needed.
+"""
+import argparse, time
+import torch
+from omegaconf import OmegaConf
+from contextlib import nullcontext
+
+from ldm.util import instantiate_from_config
+from ldm.modules.diffusionmodules.util import disable_checkpointing
+from scripts.bench_util import synchronize
+
+
+def time_unet(unet, grad_scope, x, t, context, steps, warmup):
+    with grad_scope():
+        for _ in range(warmup):
+            unet(x, t, context=context)
+        synchronize(x.device)
+        tic = time.perf_counter()
+        for _ in range(steps):
+            unet(x, t, context=context)
+        synchronize(x.device)
+    return (time.perf_counter() - tic) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--n_samples", type=int, default=1, help="images per batch, doubled for guidance")
+    parser.add_argument("--steps", type=int, default=20, help="timed UNet evaluations per mode")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    opt = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    config = OmegaConf.load(opt.config)
+    unet_config = config.model.params.unet_config
+    unet = instantiate_from_config(unet_config).to(device).eval()
+
+    batch_size = 2 * opt.n_samples
+    x = torch.randn(batch_size, unet_config.params.in_channels, opt.H // 8, opt.W // 8, device=device)
+    t = torch.full((batch_size,), 500, device=device, dtype=torch.long)
+    context = torch.randn(batch_size, 77, unet_config.params.context_dim, device=device)
+
+    precision_scope = torch.autocast if opt.precision == "autocast" else nullcontext
+    results = []
+    for name, grad_scope in (("checkpointing + no_grad", torch.no_grad),
+                             ("no checkpointing + inference_mode", torch.inference_mode)):
+        if grad_scope is torch.inference_mode:
+            disable_checkpointing(unet)
+        with precision_scope(device.type):
+            seconds = time_unet(unet, grad_scope, x, t, context, opt.steps, opt.warmup)
+        results.append(seconds)
+        print(f"{name:>36}: {seconds * 1000:8.2f} ms per UNet evaluation")
+
+    print(f"speedup: {results[0] / results[1]:.3f}x "
+          f"({(results[0] - results[1]) * opt.steps * 1000:.1f} ms saved over {opt.steps} steps)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Microbenchmark of the PLMS step overhead: the time and the number of tensor allocations per step of
+PLMSSampler.p_sample_plms with its preallocated step buffers, against the previous implementation (kept below as
+legacy_p_sample_plms) which concatenated the guidance inputs and built its coefficients with torch.full every step.
+
+By default the model is a stand-in (one 3x3 convolution) so the step's own overhead isn't hidden behind the UNet.
+--unet uses the real UNet from the inference config with random weights instead. Allocations are counted with the
+CUDA caching allocator's statistics, so they are only reported on a GPU.
+"""
+import argparse, time
+import torch
+from omegaconf import OmegaConf
+from contextlib import nullcontext
+
+from ldm.util import instantiate_from_config
+from ldm.modules.diffusionmodules.util import make_beta_schedule, noise_like
+from ldm.models.diffusion.plms import PLMSSampler
+
+
+class StandInModel(torch.nn.Module):
+    """Just enough of LatentDiffusion for PLMSSampler: the noise schedule and a cheap apply_model()."""
+    def __init__(self, unet=None, channels=4, num_timesteps=1000):
+        super().__init__()
+        betas = torch.tensor(make_beta_schedule("linear", num_timesteps, linear_start=0.00085, linear_end=0.012))
+        alphas_cumprod = torch.cumprod(1. - betas, dim=0)
+        self.num_timesteps = num_timesteps
+        self.register_buffer('betas', betas.float())
+        self.register_buffer('alphas_cumprod', alphas_cumprod.float())
+        self.register_buffer('alphas_cumprod_prev', torch.cat([torch.ones(1), alphas_cumprod[:-1]]).float())
+        self.register_buffer('sqrt_one_minus_alphas_cumprod', (1. - alphas_cumprod).sqrt().float())
+        self.unet = unet
+        self.conv = torch.nn.Conv2d(channels, channels, 3, padding=1)
+
+    @property
+    def device(self):
+        return self.betas.device
+
+    def apply_model(self, x, t, c):
+        if self.unet is not None:
+            return self.unet(x, t, context=c)
+        return self.conv(x)
+
+
+def legacy_p_sample_plms(sampler, x, c, t, index, unconditional_guidance_scale=1., unconditional_conditioning=None,
+                         old_eps=None, t_next=None):
+    # p_sample_plms as it was, without the options the benchmark doesn't use
+    b, *_, device = *x.shape, x.device
+
+    def get_model_output(x, t):
+        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            e_t = sampler.model.apply_model(x, t, c)
+        else:
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([t] * 2)
+            c_in = torch.cat([unconditional_conditioning, c])
+            e_t_uncond, e_t = sampler.model.apply_model(x_in, t_in, c_in).chunk(2)
+            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        return e_t
+
+    def get_x_prev_and_pred_x0(e_t, index):
+        a_t = torch.full((b, 1, 1, 1), sampler.ddim_alphas[index], device=device)
+        a_prev = torch.full((b, 1, 1, 1), sampler.ddim_alphas_prev[index], device=device)
+        sigma_t = torch.full((b, 1, 1, 1), sampler.ddim_sigmas[index], device=device)
+        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sampler.ddim_sqrt_one_minus_alphas[index], device=device)
+        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        dir_xt = (1. - a_prev - sigma_t ** 2).sqrt() * e_t
+        noise = sigma_t * noise_like(x.shape, device, False)
+        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        return x_prev, pred_x0
+
+    e_t = get_model_output(x, t)
+    if len(old_eps) == 0:
+        x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t, index)
+        e_t_next = get_model_output(x_prev, t_next)
+        e_t_prime = (e_t + e_t_next) / 2
+    elif len(old_eps) == 1:
+        e_t_prime = (3 * e_t - old_eps[-1]) / 2
+    elif len(old_eps) == 2:
+        e_t_prime = (23 * e_t - 16 * old_eps[-1] + 5 * old_eps[-2]) / 12
+    else:
+        e_t_prime = (55 * e_t - 59 * old_eps[-1] + 37 * old_eps[-2] - 9 * old_eps[-3]) / 24
+    x_prev, pred_x0 = get_x_prev_and_pred_x0(e_t_prime, index)
+    return x_prev, pred_x0, e_t
+
+
+def allocations(device):
+    if device.type != "cuda":
+        return 0
+    torch.cuda.synchronize()
+    return torch.cuda.memory_stats(device)["allocation.all.allocated"]
+
+
+def run_steps(sampler, legacy, x, c, uc, scale, steps):
+    # the steps of one sampling run, with the tensors the sampling loop itself makes (the timesteps) made the
+    # way each version's loop makes them
+    device = x.device
+    b = x.shape[0]
+    time_range = list(reversed(sampler.ddim_timesteps.tolist()))[:steps]
+    buffers = None if legacy else sampler.make_step_buffers(x, c, uc, scale)
+    old_eps = []
+    for i, step in enumerate(time_range):
+        index = len(sampler.ddim_timesteps) - i - 1
+        step_next = time_range[min(i + 1, len(time_range) - 1)]
+        if legacy:
+            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            ts_next = torch.full((b,), step_next, device=device, dtype=torch.long)
+            x, _, e_t = legacy_p_sample_plms(sampler, x, c, ts, index, unconditional_guidance_scale=scale,
+                                             unconditional_conditioning=uc, old_eps=old_eps, t_next=ts_next)
+        else:
+            ts = buffers.ts.fill_(step)
+            ts_next = buffers.ts_next.fill_(step_next)
+            x, _, e_t = sampler.p_sample_plms(x, c, ts, index, unconditional_guidance_scale=scale,
+                                              unconditional_conditioning=uc, old_eps=old_eps, t_next=ts_next,
+                                              buffers=buffers)
+        old_eps.append(e_t)
+        if len(old_eps) >= 4:
+            old_eps.pop(0)
+    return x
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--unet", action="store_true", help="use the real UNet (random weights) as the model")
+    parser.add_argument("--H", type=int, default=512, help="image height, in pixel space")
+    parser.add_argument("--W", type=int, default=512, help="image width, in pixel space")
+    parser.add_argument("--n_samples", type=int, default=4, help="images per batch")
+    parser.add_argument("--steps", type=int, default=40, help="PLMS steps per run")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    opt = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    context_dim = 768
+    unet = None
+    if opt.unet:
+        unet_config = OmegaConf.load(opt.config).model.params.unet_config
+        context_dim = unet_config.params.context_dim
+        unet = instantiate_from_config(unet_config)
+    model = StandInModel(unet).to(device).eval()
+    sampler = PLMSSampler(model)
+    sampler.make_schedule(ddim_num_steps=opt.steps, verbose=False)
+
+    x_T = torch.randn(opt.n_samples, 4, opt.H // 8, opt.W // 8, device=device)
+    c = torch.randn(opt.n_samples, 77, context_dim, device=device)
+    uc = torch.randn(opt.n_samples, 77, context_dim, device=device)
+    precision_scope = torch.autocast if opt.precision == "autocast" else nullcontext
+
+    results = {}
+    with torch.inference_mode(), precision_scope(device.type):
+        for name, legacy in (("before (cat + torch.full)", True), ("after (step buffers)", False)):
+            run_steps(sampler, legacy, x_T, c, uc, opt.scale, opt.steps)  # warm up
+            start_allocations = allocations(device)
+            tic = time.perf_counter()
+            for _ in range(opt.runs):
+                samples = run_steps(sampler, legacy, x_T, c, uc, opt.scale, opt.steps)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            total_steps = opt.runs * opt.steps
+            results[name] = samples
+            seconds = (time.perf_counter() - tic) / total_steps
+            allocated = (allocations(device) - start_allocations) / total_steps
+            print(f"{name:>28}: {seconds * 1000:8.3f} ms per step"
+                  + (f", {allocated:6.1f} allocations per step" if device.type == "cuda" else ""))
+
+    before, after = results.values()
+    print(f"largest difference between the samples: {(before - after).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Step count / quality benchmark for the txt2img samplers. Every sampler samples the same prompts from the same
+starting noise at each step count, and each image is compared with a reference made by DDIM with many steps
+(which is close to the exact solution of the diffusion ODE). Reports the time per image and the PSNR against
+the reference - the step count where a sampler's PSNR levels off is as many steps as it needs.
+
+euler_a adds fresh noise at every step so it converges to a different image - it is run with eta 0 here
+(plain Euler) to be comparable.
+
+    python3 scripts/bench_samplers.py --ckpt models/ldm/stable-diffusion-v1/model.ckpt --steps 10 15 20 30 40
+"""
+import argparse, time
+import torch
+from omegaconf import OmegaConf
+from contextlib import nullcontext
+
+from ldm.modules.diffusionmodules.util import DDIM_DISCRETIZATIONS
+from ldm.models.diffusion.samplers import SAMPLERS
+from scripts.bench_util import PROMPTS, load_model, synchronize, psnr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml")
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt")
+    parser.add_argument("--samplers", nargs="+", default=list(SAMPLERS), choices=list(SAMPLERS))
+    parser.add_argument("--steps", nargs="+", type=int, default=[10, 15, 20, 30, 40])
+    parser.add_argument("--discretize", type=str, default="uniform", choices=list(DDIM_DISCRETIZATIONS),
+                        help="timestep spacing of the samplers being compared")
+    parser.add_argument("--reference_steps", type=int, default=250, help="DDIM steps for the reference images")
+    parser.add_argument("--H", type=int, default=512)
+    parser.add_argument("--W", type=int, default=512)
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--precision", type=str, choices=["full", "autocast"], default="autocast")
+    opt = parser.parse_args()
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    model = load_model(OmegaConf.load(opt.config), opt.ckpt, device)
+    shape = [4, opt.H // 8, opt.W // 8]
+    batch_size = len(PROMPTS)
+    x_T = torch.randn([batch_size] + shape, generator=torch.Generator().manual_seed(opt.seed)).to(device)
+    precision_scope = torch.autocast if opt.precision == "autocast" else nullcontext
+
+    with torch.inference_mode(), precision_scope(device.type), model.ema_scope():
+        c = model.get_learned_conditioning(PROMPTS)
+        uc = model.get_learned_conditioning(batch_size * [""])
+
+        def run(sampler_name, steps, discretize=opt.discretize):
+            sampler = SAMPLERS[sampler_name](model)
+            synchronize(device)
+            tic = time.perf_counter()
+            samples, _ = sampler.sample(S=steps, batch_size=batch_size, shape=shape, conditioning=c,
+                                        unconditional_guidance_scale=opt.scale, unconditional_conditioning=uc,
+                                        eta=0., ddim_discretize=discretize, x_T=x_T.clone(), verbose=False)
+            synchronize(device)
+            seconds = (time.perf_counter() - tic) / batch_size
+            return model.decode_first_stage(samples).float(), seconds
+
+        print(f"Reference: DDIM with {opt.reference_steps} steps")
+        reference, _ = run('ddim', opt.reference_steps, discretize='uniform-exact')
+
+        results = {}
+        for sampler_name in opt.samplers:
+            for steps in opt.steps:
+                images, seconds = run(sampler_name, steps)
+                results[sampler_name, steps] = (psnr(images, reference), seconds)
+
+    print(f"\n{'sampler':<10} {'steps':>6} {'s/image':>9} {'PSNR dB':>9}")
+    for (sampler_name, steps), (quality, seconds) in results.items():
+        print(f"{sampler_name:<10} {steps:>6} {seconds:>9.2f} {quality:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+What the sampling benchmarks in this directory share: the prompts they sample, loading the model and timing and
+comparing the images.
+"""
+import torch
+
+from ldm.util import instantiate_from_config
+
+PROMPTS = [
+    "a photograph of an astronaut riding a horse",
+    "a watercolour painting of a lighthouse on a cliff at sunset",
+    "a close up portrait of an old fisherman, detailed, 50mm",
+    "an isometric illustration of a tiny city on a floating island",
+]
+
+
+def load_model(config, ckpt, device):
+    print(f"Loading model from {ckpt}")
+    pl_sd = torch.load(ckpt, map_location="cpu")
+    model = instantiate_from_config(config.model)
+    model.load_state_dict(pl_sd["state_dict"], strict=False)
+    return model.to(device).eval()
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def psnr(images, reference):
+    # images in [-1, 1] as decoded by the VAE
+    mse = torch.mean(((images - reference) / 2.0) ** 2, dim=(1, 2, 3)).clamp(min=1e-10)
+    return (10 * torch.log10(1.0 / mse)).mean().item()
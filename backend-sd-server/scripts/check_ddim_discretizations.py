@@ -0,0 +1,51 @@
+"""
+Checks that every registered ddim discretization (see DDIM_DISCRETIZATIONS) gives exactly the number of steps asked
+for, as strictly increasing timesteps within the model's DDPM timesteps, for every step count from 1 to the number
+of DDPM timesteps. The alphas_cumprod used by 'karras' come from the linear beta schedule of
+configs/stable-diffusion/v1-inference.yaml. Exits with status 1 if any step count fails.
+
+    python3 scripts/check_ddim_discretizations.py --discretize karras uniform
+"""
+import argparse, sys
+import numpy as np
+
+from ldm.modules.diffusionmodules.util import DDIM_DISCRETIZATIONS, make_beta_schedule, make_ddim_timesteps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--discretize", nargs="+", default=list(DDIM_DISCRETIZATIONS),
+                        choices=list(DDIM_DISCRETIZATIONS))
+    parser.add_argument("--timesteps", type=int, default=1000, help="the model's number of DDPM timesteps")
+    parser.add_argument("--linear_start", type=float, default=0.00085)
+    parser.add_argument("--linear_end", type=float, default=0.0120)
+    opt = parser.parse_args()
+
+    betas = make_beta_schedule("linear", opt.timesteps, linear_start=opt.linear_start, linear_end=opt.linear_end)
+    alphas_cumprod = np.cumprod(1. - betas)
+
+    failures = 0
+    for discretize in opt.discretize:
+        failed = []
+        for S in range(1, opt.timesteps + 1):
+            try:
+                timesteps = make_ddim_timesteps(discretize, S, opt.timesteps, verbose=False,
+                                                alphas_cumprod=alphas_cumprod)
+            except Exception as e:
+                failed.append(f'{S} ({type(e).__name__}: {e})')
+                continue
+            if len(timesteps) != S:
+                failed.append(f'{S} ({len(timesteps)} timesteps)')
+            elif timesteps.min() < 0 or timesteps.max() >= opt.timesteps:
+                failed.append(f'{S} (timesteps {timesteps.min()} to {timesteps.max()})')
+            elif S > 1 and np.diff(timesteps).min() <= 0:
+                failed.append(f'{S} (not strictly increasing)')
+        failures += len(failed)
+        print(f"{discretize:<14} {opt.timesteps - len(failed):>5} of {opt.timesteps} step counts correct"
+              + (f" - failed: {', '.join(failed[:10])}" if failed else ""))
+
+    sys.exit(0 if failures == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Checks that PLMSSampler.sample_sweep() gives the same samples as separate PLMSSampler.sample() runs, one per
+step count, for each timestep spacing. The model is a stand-in (see bench_plms_step.py) whose output depends on
+the timestep and the conditioning, so a sweep that evaluates a trajectory at the wrong timestep or with another
+trajectory's conditioning shows up as a difference. The guidance scale decays over each run, so it differs
+between step counts at the same step. Differences are relative to the largest value of the separately sampled
+image; exits with status 1 if any is more than --tolerance.
+
+    python3 scripts/check_plms_sweep.py --steps 1 2 5 10 20
+"""
+import argparse, sys
+import torch
+
+from ldm.models.diffusion.guidance import GuidanceSchedule, GUIDANCE_DECAYS
+from ldm.models.diffusion.plms import PLMSSampler
+from scripts.bench_plms_step import StandInModel
+
+
+class ConditionedStandInModel(StandInModel):
+    """StandInModel with an apply_model() that depends on the timestep and the conditioning too."""
+    def apply_model(self, x, t, c):
+        timestep_weight = 1. + t.to(x.dtype).view(-1, 1, 1, 1) / self.num_timesteps
+        return self.conv(x) * timestep_weight + c.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", nargs="+", type=int, default=[1, 2, 5, 10, 20])
+    parser.add_argument("--discretize", nargs="+", default=["uniform", "uniform-exact", "trailing", "karras"])
+    parser.add_argument("--sources", type=int, default=2, help="distinct starting noises and conditionings")
+    parser.add_argument("--max_batch_size", type=int, default=3, help="small, so the sweep is split into chunks")
+    parser.add_argument("--scale", type=float, default=7.5)
+    parser.add_argument("--guidance_end", type=float, default=1.)
+    parser.add_argument("--guidance_decay", type=str, default="linear", choices=GUIDANCE_DECAYS)
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="relative to the image's largest value")
+    parser.add_argument("--seed", type=int, default=42)
+    opt = parser.parse_args()
+
+    torch.manual_seed(opt.seed)
+    model = ConditionedStandInModel().eval()
+    sampler = PLMSSampler(model)
+    shape = (4, 8, 8)
+    # every source at every step count, in the order the backend submits a request's jobs
+    source_ids = [source for source in range(opt.sources) for _ in opt.steps]
+    step_counts = [steps for _ in range(opt.sources) for steps in opt.steps]
+    x_T = torch.randn(opt.sources, *shape)[source_ids]
+    c = torch.randn(opt.sources, 77, 16)[source_ids]
+    uc = torch.randn(1, 77, 16).expand(len(source_ids), -1, -1)
+    guidance_schedule = GuidanceSchedule(opt.scale, end=opt.guidance_end, decay=opt.guidance_decay)
+
+    worst = 0.
+    with torch.inference_mode():
+        for discretize in opt.discretize:
+            swept = sampler.sample_sweep(step_counts, shape=shape, conditioning=c, x_T=x_T, source_ids=source_ids,
+                                         ddim_discretize=discretize, max_batch_size=opt.max_batch_size,
+                                         verbose=False, unconditional_guidance_scale=opt.scale,
+                                         unconditional_conditioning=uc, guidance_schedule=guidance_schedule)
+            for j, steps in enumerate(step_counts):
+                separate, _ = sampler.sample(S=steps, batch_size=1, shape=shape, conditioning=c[j:j + 1],
+                                             x_T=x_T[j:j + 1], ddim_discretize=discretize, verbose=False,
+                                             unconditional_guidance_scale=opt.scale,
+                                             unconditional_conditioning=uc[j:j + 1],
+                                             guidance_schedule=guidance_schedule)
+                difference = ((swept[j:j + 1] - separate).abs().max() / separate.abs().max()).item()
+                worst = max(worst, difference)
+                print(f"{discretize:<14} {steps:>4} steps, source {source_ids[j]}: largest difference {difference:.2e}")
+
+    print(f"largest difference overall: {worst:.2e} (tolerance {opt.tolerance:.0e})")
+    sys.exit(0 if worst <= opt.tolerance else 1)
+
+
+if __name__ == "__main__":
+    main()
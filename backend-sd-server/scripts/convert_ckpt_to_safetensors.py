@@ -0,0 +1,33 @@
+"""
+Converts a Stable Diffusion .ckpt into a .safetensors file next to it. The backend server prefers the
+.safetensors file when it exists because it is memory-mapped rather than unpickled at start up.
+"""
+import argparse, os
+import torch
+from safetensors.torch import save_file
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt",
+                        help="checkpoint to convert")
+    parser.add_argument("--out", type=str, default=None,
+                        help="output file, defaults to the checkpoint path with a .safetensors suffix")
+    opt = parser.parse_args()
+    out = opt.out or os.path.splitext(opt.ckpt)[0] + '.safetensors'
+
+    print(f"Loading {opt.ckpt}")
+    pl_sd = torch.load(opt.ckpt, map_location="cpu")
+    metadata = {}
+    if "global_step" in pl_sd:
+        metadata['global_step'] = str(pl_sd['global_step'])
+
+    # safetensors stores each tensor on its own, so break any shared storage and drop non-tensor entries
+    state_dict = {k: v.detach().clone().contiguous() for k, v in pl_sd["state_dict"].items()
+                  if isinstance(v, torch.Tensor)}
+    save_file(state_dict, out, metadata=metadata)
+    print(f"Wrote {len(state_dict)} tensors to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import base64
 import gzip
+import io
 import os
 import random
 import urllib.request
@@ -9,33 +10,39 @@ import numpy as np
 from omegaconf import OmegaConf
 import PIL
 from PIL import Image, ImageDraw
+from PIL.PngImagePlugin import PngInfo
 from tqdm import tqdm, trange
-from imwatermark import WatermarkEncoder
 from itertools import islice
-from einops import rearrange, repeat
+from einops import repeat
 import time
 from pytorch_lightning import seed_everything
 from torch import autocast
-from contextlib import nullcontext
+from contextlib import contextmanager, nullcontext
 
-from ldm.util import instantiate_from_config
-from ldm.models.diffusion.plms import PLMSSampler
+from ldm.util import instantiate_from_config, skip_weight_init
+from ldm.modules.diffusionmodules.util import DDIM_DISCRETIZATIONS
 from ldm.models.diffusion.ddim import DDIMSampler
-
-from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-from transformers import AutoFeatureExtractor
+from ldm.models.diffusion.samplers import SAMPLERS
+from ldm.models.diffusion.guidance import GuidanceSchedule, GUIDANCE_DECAYS
+from ldm.models.diffusion.feature_cache import FeatureCacheSchedule
+from ldm.models.diffusion.schedule_cache import schedule_cache
+from ldm.models.diffusion.latent_preview import latent_to_rgb
 
 import uuid
 import json
 import sys
 import signal
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import unquote
 
-# load safety model
+# safety model - loaded by load_safety_checker() only when SAFETY_FLAG is on
 safety_model_id = "CompVis/stable-diffusion-safety-checker"
-safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
-safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+safety_feature_extractor = None
+safety_checker = None
 
 # GLOBAL CONSTS
 # Notes from https://github.com/pesser/stable-diffusion/blob/main/README.md
@@ -55,19 +62,218 @@ SAMPLE_THIS_OFTEN = 1  # was opt.n_iter
 MODEL_PATH = 'models/ldm/stable-diffusion-v1/model.ckpt'
 SCALE = 7.5  # was opt.scale#
 DDIM_STEPS = 40  # was opt.ddim_steps (number of ddim sampling steps)
+MAX_DDIM_STEPS = 1000  # the model's number of DDPM timesteps - a sampler can't take more steps than there are
 DDIM_ETA = 0.0  # was opt.ddim_eta  (ddim eta (eta=0.0 corresponds to deterministic sampling)
 N_SAMPLES = 1  # was opt.n_samples (how many samples to produce for each given prompt. A.k.a. batch size)
 PRECISION = "autocast"  # can be "autocast" or "full"
+SAMPLER = "plms"  # txt2img sampler unless the request asks for another - see SAMPLERS
+DDIM_DISCRETIZE = "uniform"  # which timesteps the sampler visits: one of DDIM_DISCRETIZATIONS, e.g. "karras"
+GUIDANCE_START = 0.0  # classifier-free guidance is applied from this fraction of the sampling steps...
+GUIDANCE_END = 1.0  # ...up to this one - the steps after it run the UNet on half the batch. 0.6 is barely visible
+GUIDANCE_DECAY = "none"  # how the guidance scale falls towards 1 over the steps: "none", "linear" or "cosine"
+FEATURE_CACHE_INTERVAL = 1  # run the whole UNet every this many steps and reuse its deep features in between. 1 is off
+FEATURE_CACHE_MAX_INTERVAL = 10
+FEATURE_CACHE_BRANCH = 0  # the deepest UNet input block recomputed on the cached steps - higher is slower but closer
+INFERENCE_MODE = True  # no gradient checkpointing and torch.inference_mode() instead of torch.no_grad()
 STRENGTH = 0.75  # was opt.strength - used when processing an image - 0 means no change through 0.999 means full change
 OUTPUT_PATH = '/library'
 PORT = 8080
 WATERMARK_FLAG = False  # set to True to enable watermarking
 SAFETY_FLAG = False  # set to True to enable safety checking
+MAX_BATCH_SIZE = 4  # most images (from one or more compatible requests) sampled together in one PLMS pass
+MAX_BATCH_WAIT = 0.1  # seconds the micro-batch engine waits for compatible images before sampling a partial batch
+ATTENTION_BACKEND = "sliced"  # "einsum" (original), "sliced" (bounded memory) or "sdpa" (PyTorch 2 fused attention)
+ATTENTION_CHUNK_SIZE = 1024  # queries per slice when ATTENTION_BACKEND is "sliced"
+VAE_TILE_SIZE = 64  # latent pixels (x DOWNSAMPLING_FACTOR = 512px) - larger images are VAE encoded/decoded in tiles
+VAE_TILE_OVERLAP = 8  # latent pixels of overlap blended between neighbouring VAE tiles
+VAE_TILE_BATCH_SIZE = 4  # VAE tiles processed together
+IMAGE_METADATA_KEY = 'sd-metadata'  # keyword of the PNG iTXt chunk each image's metadata is saved in
+JOB_EVENTS_FLAG = True  # publish each request's progress to redis for the frontend to relay to the browser
+REDIS_HOST = 'scheduler'  # the redis server the job events are published to...
+REDIS_PORT = 6379
+REDIS_PASSWORD = 'hellothere'
+JOB_EVENTS_RETRY_DELAY = 10  # ...and seconds to stop trying for after it couldn't be reached
+PREVIEW_EVERY_N_STEPS = 5  # publish a rough preview of each image every this many sampling steps (0 to disable)
+PREVIEW_QUALITY = 40  # JPEG quality of the previews
+CANCEL_CHECK_INTERVAL = 0.5  # most often, in seconds, redis is asked whether a request has been cancelled
+IMAGE_WRITER_THREADS = 2  # background threads watermarking, PNG encoding and writing images while sampling goes on
+IMAGE_WRITER_MAX_PENDING = 8  # images waiting to be written before sampling is held up for the writer to catch up
+PNG_COMPRESS_LEVEL = 3  # 0 (no compression, fastest) to 9 (smallest, slowest) - PIL's default is 6
+
+# a request chooses its txt2img sampler by name with its 'sampler' field - see SAMPLERS
+SAMPLER_DEFAULT_ETA = {'euler_a': 1.0}  # eta for requests that don't give one, where it isn't DDIM_ETA
+
+class JobEventPublisher(object):
+    """
+    Publishes a request's progress (started, sampling steps, each image saved and finished) as JSON messages to
+    the redis channel 'events:<queue_id>', which the frontend relays to the browser as server-sent events.
+    Publishing is best effort - events are dropped while redis can't be reached rather than holding up sampling.
+    """
+    def __init__(self, enabled):
+        self.redis = None
+        self.retry_after = 0.0
+        if enabled:
+            try:
+                import redis
+                self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, password=REDIS_PASSWORD,
+                                         socket_connect_timeout=1, socket_timeout=1)
+            except ImportError:
+                print('Note: redis is not installed so job progress events are disabled')
+
+    def is_active(self):
+        return self.redis is not None and time.time() >= self.retry_after
+
+    def publish(self, queue_id, event, data=None):
+        if queue_id is None or not self.is_active():
+            return
+        message = dict(data or {}, event=event, queue_id=queue_id)
+        try:
+            self.redis.publish('events:' + queue_id, json.dumps(message))
+        except Exception as e:
+            print('Could not publish job event, retrying in', JOB_EVENTS_RETRY_DELAY, 'seconds:', e)
+            self.retry_after = time.time() + JOB_EVENTS_RETRY_DELAY
+
+
+job_events = JobEventPublisher(JOB_EVENTS_FLAG)
+
+
+class JobCancelled(Exception):
+    def __str__(self):
+        return 'cancelled'
+
+
+class JobCancellation(object):
+    """
+    Tells the backend whether a request has been cancelled - the frontend sets the redis key 'cancel:<queue_id>'.
+    Redis is asked at most every CANCEL_CHECK_INTERVAL seconds per request, so this is cheap enough to call
+    from the sampler callback on every step.
+    """
+    def __init__(self, enabled):
+        self.redis = None
+        self.lock = threading.Lock()
+        self.last_checked = {}  # queue_id -> when redis was last asked
+        self.cancelled = set()
+        if enabled:
+            try:
+                import redis
+                self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, password=REDIS_PASSWORD,
+                                         socket_connect_timeout=1, socket_timeout=1)
+            except ImportError:
+                print('Note: redis is not installed so requests cannot be cancelled')
+
+    def is_cancelled(self, queue_id):
+        if self.redis is None or queue_id is None:
+            return False
+        with self.lock:
+            if queue_id in self.cancelled:
+                return True
+            now = time.time()
+            if now - self.last_checked.get(queue_id, 0.0) < CANCEL_CHECK_INTERVAL:
+                return False
+            self.last_checked[queue_id] = now
+        try:
+            cancelled = self.redis.exists('cancel:' + queue_id) > 0
+        except Exception as e:
+            print('Could not check for cancellation:', e)
+            return False
+        if cancelled:
+            with self.lock:
+                self.cancelled.add(queue_id)
+        return cancelled
+
+    def forget(self, queue_id):
+        # once a request has finished there's nothing left to cancel
+        with self.lock:
+            self.last_checked.pop(queue_id, None)
+            self.cancelled.discard(queue_id)
+
+
+job_cancellation = JobCancellation(JOB_EVENTS_FLAG)
+
+
+def save_png(img, image_path, pnginfo=None):
+    # written under a temporary name (which /imagelist doesn't list as it isn't a .png) and then renamed,
+    # so the library never serves a half written image - its files are cached by browsers as immutable
+    temporary_path = image_path + '.tmp'
+    try:
+        img.save(temporary_path, format='PNG', pnginfo=pnginfo, compress_level=PNG_COMPRESS_LEVEL)
+        os.replace(temporary_path, image_path)
+    except Exception:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+class ImageWriter(object):
+    """
+    Watermarks, PNG encodes and writes images on background threads so the sampler can get on with the next
+    image. At most IMAGE_WRITER_MAX_PENDING images are queued - beyond that submit() waits for the writer.
+    Writes are tracked per library directory so a request's index.json can wait for all of its images.
+    """
+    def __init__(self, threads=IMAGE_WRITER_THREADS, max_pending=IMAGE_WRITER_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='image-writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}  # library_dir_name -> futures of the images not yet waited for
+
+    def submit(self, library_dir_name, image_name, image_array, wm_encoder, pnginfo):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.write, library_dir_name, image_name, image_array, wm_encoder,
+                                          pnginfo)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.pending.setdefault(library_dir_name, []).append(future)
+        return future
+
+    def write(self, library_dir_name, image_name, image_array, wm_encoder, pnginfo):
+        img = Image.fromarray(put_watermark(image_array, wm_encoder))
+        save_png(img, os.path.join(library_dir_name, image_name), pnginfo)
+        queue_id = os.path.basename(library_dir_name)
+        job_events.publish(queue_id, 'image', {'image': '/library/' + queue_id + '/' + image_name})
+
+    def wait(self, library_dir_name):
+        # Wait for every image submitted for this directory to be written. Returns how many couldn't be written.
+        with self.lock:
+            futures = self.pending.pop(library_dir_name, [])
+        failed = 0
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                print('Could not write image to', library_dir_name + ':', error)
+                failed += 1
+        return failed
+
+
+image_writer = ImageWriter()
+
+
+def wants_preview(i, total_steps):
+    # a preview every PREVIEW_EVERY_N_STEPS steps, but not at the end when the real image is about to arrive
+    return PREVIEW_EVERY_N_STEPS > 0 and (i + 1) % PREVIEW_EVERY_N_STEPS == 0 and i + 1 < total_steps and \
+        job_events.is_active()
+
+
+def encode_previews(pred_x0):
+    # Rough previews of the images being sampled as small JPEG data URLs. The latents are projected straight to
+    # RGB at latent resolution rather than decoded by the VAE, so a preview costs a tiny fraction of a step.
+    previews = []
+    for rgb in latent_to_rgb(pred_x0).numpy():
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, format='JPEG', quality=PREVIEW_QUALITY)
+        previews.append('data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return previews
 
 # GLOBAL VARS
 global_device = None
 global_model = None
 global_wm_encoder = None
+global_batch_engine = None
+global_ddim_sampler = None
+model_lock = threading.Lock()  # only one sampling job (batched or img2img) uses the model at a time
 
 
 def chunk(it, size):
@@ -87,23 +293,90 @@ def numpy_to_pil(images):
     return pil_images
 
 
-def load_model_from_config(config, ckpt, verbose=False):
+def to_uint8_tensor(x_samples):
+    """
+    Convert a batch of decoded images (b, c, h, w) in [-1, 1] to one contiguous uint8 tensor (b, h, w, c) on the
+    same device. The safety checker works on it there, and only a quarter of the bytes of a float copy then cross
+    to the CPU, where the watermark encoder and PNG encoder share the one numpy buffer.
+    """
+    x_samples = torch.clamp((x_samples.float() + 1.0) / 2.0, min=0.0, max=1.0).mul_(255.0)
+    return x_samples.to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+
+
+class StartupTimer(object):
+    """
+    Times each phase of server start up, so a slow container restart can be pinned on a phase.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - tic))
+
+    def report(self):
+        print('Startup time by phase:')
+        for name, seconds in self.phases:
+            print(f"  {name:<20} {seconds:8.2f}s")
+        print(f"  {'total':<20} {time.perf_counter() - self.start:8.2f}s")
+
+
+def read_checkpoint(ckpt):
+    """
+    Read the model state dict without first copying the whole checkpoint into memory. A .safetensors file
+    next to the .ckpt (made by scripts/convert_ckpt_to_safetensors.py) is memory-mapped; otherwise the
+    pickle is loaded with mmap=True on torch versions that support it.
+    """
+    safetensors_path = os.path.splitext(ckpt)[0] + '.safetensors'
+    if os.path.exists(safetensors_path):
+        try:
+            from safetensors.torch import load_file
+            print(f"Loading model from {safetensors_path}")
+            return load_file(safetensors_path, device="cpu")
+        except ImportError:
+            print(f"safetensors is not installed so {safetensors_path} can't be used")
+
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
+    try:
+        pl_sd = torch.load(ckpt, map_location="cpu", mmap=True)
+    except TypeError:  # torch < 2.1 has no mmap option
+        pl_sd = torch.load(ckpt, map_location="cpu")
     if "global_step" in pl_sd:
         print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
+    return pl_sd["state_dict"]
+
+
+def load_model_from_config(config, ckpt, timer, verbose=False):
+    # every weight comes from the checkpoint, so don't spend time randomly initialising them first
+    with timer.phase('build model'):
+        with skip_weight_init():
+            model = instantiate_from_config(config.model)
+
+    with timer.phase('read checkpoint'):
+        sd = read_checkpoint(ckpt)
+
+    with timer.phase('load state dict'):
+        try:
+            # use the checkpoint's (memory-mapped) tensors as the parameters rather than copying them in
+            m, u = model.load_state_dict(sd, strict=False, assign=True)
+        except TypeError:  # torch < 2.1 has no assign option
+            m, u = model.load_state_dict(sd, strict=False)
+    if len(m) > 0:
+        # weights initialisation was skipped, so anything missing from the checkpoint is uninitialised
+        print("WARNING: missing keys:")
         print(m)
     if len(u) > 0 and verbose:
         print("unexpected keys:")
         print(u)
 
-    model.cuda()
-    model.eval()
+    with timer.phase('move to device'):
+        model.cuda()
+        model.eval()
     return model
 
 
@@ -163,183 +436,507 @@ def load_and_format_image(path, output_width, output_height):
     return new_image, processed_image
 
 
-def put_watermark(img, wm_encoder=None):
+def put_watermark(image_array, wm_encoder=None):
+    # takes and returns a uint8 RGB array (h, w, c)
     if WATERMARK_FLAG:
         if wm_encoder is not None:
-            img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+            img = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
             img = wm_encoder.encode(img, 'dwtDct')
-            img = Image.fromarray(img[:, :, ::-1])
-    return img
+            image_array = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return image_array
 
 
-def load_replacement(x):
+@lru_cache(maxsize=8)
+def load_replacement(height, width):
+    # the image shown instead of a flagged one - read from disk once per size. None if it can't be loaded
     try:
-        hwc = x.shape
-        y = Image.open("assets/rick.jpeg").convert("RGB").resize((hwc[1], hwc[0]))
-        y = (np.array(y) / 255.0).astype(x.dtype)
-        assert y.shape == x.shape
-        return y
+        y = Image.open("assets/rick.jpeg").convert("RGB").resize((width, height))
+        return np.array(y, dtype=np.uint8)
     except Exception:
-        return x
+        return None
 
 
-def check_safety(x_image):
-    safety_checker_input = safety_feature_extractor(numpy_to_pil(x_image), return_tensors="pt")
-    x_checked_image, has_nsfw_concept = safety_checker(images=x_image, clip_input=safety_checker_input.pixel_values)
+def load_safety_checker(device=None):
+    """
+    Load the safety checker the first time it's needed, so the diffusers import and the model download are
+    only paid for when SAFETY_FLAG is on.
+    """
+    global safety_feature_extractor, safety_checker
+    if safety_checker is None:
+        from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+        from transformers import AutoFeatureExtractor
+        safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
+        safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+        if device is not None:
+            safety_checker = safety_checker.to(device)
+        safety_checker.eval()
+    return safety_feature_extractor, safety_checker
+
+
+def feature_extractor_size(size, fallback):
+    # transformers has described sizes as an int and, more recently, as a dict
+    if isinstance(size, dict):
+        return size.get('shortest_edge') or size.get('height') or fallback
+    return size or fallback
+
+
+def safety_clip_input(images, feature_extractor, dtype):
+    """
+    The safety checker's CLIP input for a uint8 batch (b, h, w, c), prepared with torch ops on the images' own
+    device: the same shortest edge resize, centre crop and normalisation as the feature extractor does in Python.
+    """
+    size = feature_extractor_size(getattr(feature_extractor, 'size', None), 224)
+    crop = feature_extractor_size(getattr(feature_extractor, 'crop_size', None), size)
+    x = images.permute(0, 3, 1, 2).float() / 255.0
+    height, width = x.shape[-2:]
+    scale = size / min(height, width)
+    x = torch.nn.functional.interpolate(x, size=(max(size, round(height * scale)), max(size, round(width * scale))),
+                                        mode='bicubic', align_corners=False, antialias=True)
+    top, left = (x.shape[-2] - crop) // 2, (x.shape[-1] - crop) // 2
+    x = x[:, :, top:top + crop, left:left + crop]
+    mean = torch.tensor(feature_extractor.image_mean, device=x.device).view(1, -1, 1, 1)
+    std = torch.tensor(feature_extractor.image_std, device=x.device).view(1, -1, 1, 1)
+    return ((x - mean) / std).to(dtype)
+
+
+def check_safety(images):
+    """
+    Safety check a whole batch of uint8 images (b, h, w, c) still on the model's device. Returns the images as a
+    numpy array on the CPU with any flagged image swapped for the replacement, and the flags.
+    """
+    feature_extractor, checker = load_safety_checker(images.device)
+    clip_input = safety_clip_input(images, feature_extractor, next(checker.parameters()).dtype)
+    x_image = images.cpu().numpy()
+    x_checked_image, has_nsfw_concept = checker(images=x_image, clip_input=clip_input)
     assert x_checked_image.shape[0] == len(has_nsfw_concept)
     for i in range(len(has_nsfw_concept)):
         if has_nsfw_concept[i]:
-            x_checked_image[i] = load_replacement(x_checked_image[i])
+            replacement = load_replacement(x_checked_image.shape[1], x_checked_image.shape[2])
+            if replacement is not None:
+                x_checked_image[i] = replacement
     return x_checked_image, has_nsfw_concept
 
 
-def danger_will_robinson(x_image):
-    return x_image, []
+def danger_will_robinson(images):
+    return images.cpu().numpy(), []
 
 
-def setup():
+def setup(timer):
     print("Setting up model ready for inference")
 
     config = OmegaConf.load("configs/stable-diffusion/v1-inference.yaml")
-    model = load_model_from_config(config, 'models/ldm/stable-diffusion-v1/model.ckpt')
+    # the attention backend is chosen when the UNet and the VAE are built
+    for attention_params in (config.model.params.unet_config.params,
+                             config.model.params.first_stage_config.params.ddconfig):
+        attention_params.attention_backend = ATTENTION_BACKEND
+        attention_params.attention_chunk_size = ATTENTION_CHUNK_SIZE
+    # tiled VAE encode/decode keeps memory bounded for large images
+    config.model.params.first_stage_config.params.tile_size = VAE_TILE_SIZE
+    config.model.params.first_stage_config.params.tile_overlap = VAE_TILE_OVERLAP
+    config.model.params.first_stage_config.params.tile_batch_size = VAE_TILE_BATCH_SIZE
+    model = load_model_from_config(config, MODEL_PATH, timer)
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
     model = model.to(device)
+    if INFERENCE_MODE:
+        model.enable_inference_mode()
 
     os.makedirs(OUTPUT_PATH, exist_ok=True)
 
-    print("Creating invisible watermark encoder (see https://github.com/ShieldMnt/invisible-watermark)...")
-    wm = "StableDiffusionV1"
-    wm_encoder = WatermarkEncoder()
-    wm_encoder.set_watermark('bytes', wm.encode('utf-8'))
+    if SAFETY_FLAG:
+        with timer.phase('safety checker'):
+            load_safety_checker(device)
+
+    wm_encoder = None
+    if WATERMARK_FLAG:
+        with timer.phase('watermark encoder'):
+            from imwatermark import WatermarkEncoder
+            print("Creating invisible watermark encoder (see https://github.com/ShieldMnt/invisible-watermark)...")
+            wm = "StableDiffusionV1"
+            wm_encoder = WatermarkEncoder()
+            wm_encoder.set_watermark('bytes', wm.encode('utf-8'))
 
     return device, model, wm_encoder
 
 
-def process(text_prompt, device, model, wm_encoder, queue_id, num_images, options):
+class SamplingJob(object):
+    """
+    One image to be sampled by the MicroBatchEngine. Each job carries its own seed so the starting noise
+    (and any noise a stochastic sampler adds later) is the same whichever batch it ends up in.
+    """
+    def __init__(self, prompt, image_counter, seed, shape, ddim_steps, scale, ddim_eta, queue_id=None,
+                 sampler=SAMPLER, ddim_discretize=DDIM_DISCRETIZE,
+                 guidance=(GUIDANCE_START, GUIDANCE_END, GUIDANCE_DECAY),
+                 feature_cache_interval=FEATURE_CACHE_INTERVAL):
+        self.prompt = prompt
+        self.queue_id = queue_id
+        self.image_counter = image_counter
+        self.seed = seed
+        self.shape = shape
+        self.ddim_steps = ddim_steps
+        self.scale = scale
+        self.ddim_eta = ddim_eta
+        self.sampler = sampler
+        self.ddim_discretize = ddim_discretize
+        self.guidance = tuple(guidance)  # (start, end, decay) of the GuidanceSchedule
+        self.feature_cache_interval = feature_cache_interval
+        self.generator = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def batch_key(self):
+        # jobs can only share a sampler pass if they share the latent shape and the sampler settings.
+        # Different ddim step counts are fine for plms - they are sampled together in lockstep by sample_sweep(),
+        # which doesn't use the feature cache
+        settings = (tuple(self.shape), self.scale, self.ddim_eta, self.sampler, self.ddim_discretize, self.guidance,
+                    self.feature_cache_interval)
+        if self.sampler == 'plms' and self.feature_cache_interval == 1:
+            return settings
+        return settings + (self.ddim_steps,)
+
+    def source_id(self):
+        # jobs with the same prompt and seed start from the same noise, so their trajectories can be shared
+        return self.prompt, self.seed
+
+    def make_start_code(self, device):
+        # a CPU generator gives the same noise for a seed whatever the device and whatever else is in the batch
+        # The generator is kept for the noise an ancestral sampler adds at each step
+        self.generator = torch.Generator().manual_seed(self.seed)
+        return torch.randn(self.shape, generator=self.generator).to(device)
+
+    def wait(self):
+        self.done.wait()
+
+
+class MicroBatchEngine(object):
+    """
+    Collects SamplingJobs from one or more requests and runs compatible jobs (same height, width, scale, eta and sampler)
+    through a single sampler call, up to MAX_BATCH_SIZE images (each with all of its ddim step counts) at a time.
+    The first job in the queue waits at most MAX_BATCH_WAIT seconds for companions before it is run.
+    """
+    def __init__(self, model, device, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.samplers = {name: sampler_class(model) for name, sampler_class in SAMPLERS.items()}
+        self.pending = []
+        self.condition = threading.Condition()
+        self.worker = threading.Thread(target=self._run, name='micro-batch-engine', daemon=True)
+        self.worker.start()
+
+    def submit(self, jobs):
+        with self.condition:
+            self.pending.extend(jobs)
+            self.condition.notify()
+
+    def cancel(self, queue_id):
+        # drop a cancelled request's jobs that haven't started yet
+        with self.condition:
+            cancelled_jobs = [job for job in self.pending if job.queue_id == queue_id]
+            for job in cancelled_jobs:
+                self.pending.remove(job)
+        for job in cancelled_jobs:
+            job.error = JobCancelled()
+            job.done.set()
+
+    def _compatible_jobs(self, batch_key):
+        # every pending job with this batch key that belongs to one of the first max_batch_size images
+        batch = []
+        sources = set()
+        for job in self.pending:
+            if job.batch_key() != batch_key:
+                continue
+            if job.source_id() not in sources:
+                if len(sources) == self.max_batch_size:
+                    continue
+                sources.add(job.source_id())
+            batch.append(job)
+        return batch, len(sources)
+
+    def _next_batch(self):
+        with self.condition:
+            while len(self.pending) == 0:
+                self.condition.wait()
+
+            batch_key = self.pending[0].batch_key()
+            deadline = time.time() + self.max_wait
+            while True:
+                batch, num_sources = self._compatible_jobs(batch_key)
+                remaining_wait = deadline - time.time()
+                if num_sources >= self.max_batch_size or remaining_wait <= 0:
+                    break
+                self.condition.wait(remaining_wait)
+
+            for job in batch:
+                self.pending.remove(job)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = []
+            for job in self._next_batch():
+                if job_cancellation.is_cancelled(job.queue_id):
+                    job.error = JobCancelled()
+                    job.done.set()
+                else:
+                    batch.append(job)
+            if len(batch) == 0:
+                continue
+            try:
+                with model_lock:
+                    self.run_batch(batch)
+            except Exception as e:
+                print('Error in run_batch: ' + str(e))
+                for job in batch:
+                    job.error = e
+            finally:
+                for job in batch:
+                    job.done.set()
+
+    def run_batch(self, batch):
+        first_job = batch[0]
+        batch_size = len(batch)
+        step_counts = [job.ddim_steps for job in batch]
+        total_steps = max(step_counts)
+        # jobs with the same source (e.g. two requests for the same prompt with the home page's seed 0) come out
+        # the same, so a single step count batch samples each source once - _compatible_jobs allows up to
+        # max_batch_size of them - and source_rows[k] is the row of batch[k]'s sample
+        first_rows = OrderedDict()
+        for k, job in enumerate(batch):
+            first_rows.setdefault(job.source_id(), k)
+        rows = list(first_rows.values())
+        source_rows = [list(first_rows).index(job.source_id()) for job in batch]
+
+        # every request with images in this batch hears about each step
+        images_by_queue_id = OrderedDict()
+        for job in batch:
+            images_by_queue_id.setdefault(job.queue_id, []).append(job.image_counter + 1)
+
+        def progress_callback(i):
+            for queue_id, images in images_by_queue_id.items():
+                job_events.publish(queue_id, 'progress', {'step': i + 1, 'total_steps': total_steps, 'images': images})
+            # stop sampling once every request in the batch has been cancelled
+            if all(job_cancellation.is_cancelled(queue_id) for queue_id in images_by_queue_id):
+                raise JobCancelled()
+
+        preview_seconds = 0.0
+
+        def preview_callback(pred_x0, i):
+            nonlocal preview_seconds
+            if not wants_preview(i, total_steps):
+                return
+            tic = time.perf_counter()
+            previews = encode_previews(pred_x0)
+            for job, preview in zip(batch, (previews[row] for row in source_rows)):
+                job_events.publish(job.queue_id, 'preview', {'image': job.image_counter + 1, 'step': i + 1,
+                                                             'preview': preview})
+            preview_seconds += time.perf_counter() - tic
+
+        sampling_start = time.perf_counter()
+
+        precision_scope = autocast if PRECISION == "autocast" else nullcontext
+        inference_scope = torch.inference_mode if INFERENCE_MODE else torch.no_grad
+        with inference_scope():
+            with precision_scope("cuda"):
+                with self.model.ema_scope():
+                    unconditional_conditioning = None
+                    if first_job.scale != 1.0:
+                        unconditional_conditioning = self.model.get_learned_conditioning(batch_size * [""])
+                    conditioning = self.model.get_learned_conditioning([job.prompt for job in batch])
+                    start_code = torch.stack([job.make_start_code(self.device) for job in batch])
+                    guidance_schedule = GuidanceSchedule(first_job.scale, *first_job.guidance)
+                    feature_cache = FeatureCacheSchedule(first_job.feature_cache_interval, FEATURE_CACHE_BRANCH)
+
+                    if len(set(step_counts)) == 1:
+                        print(f'Sampling batch of {batch_size} image(s) from {len(rows)} distinct seed(s) and '
+                              f'prompt(s) with {first_job.ddim_steps} {first_job.sampler} steps')
+                        sampler = self.samplers[first_job.sampler]
+                        samples_ddim, _ = sampler.sample(S=first_job.ddim_steps,
+                                                         conditioning=conditioning[rows],
+                                                         batch_size=len(rows),
+                                                         shape=first_job.shape,
+                                                         verbose=False,
+                                                         unconditional_guidance_scale=first_job.scale,
+                                                         unconditional_conditioning=(
+                                                             unconditional_conditioning[rows]
+                                                             if unconditional_conditioning is not None else None),
+                                                         eta=first_job.ddim_eta,
+                                                         ddim_discretize=first_job.ddim_discretize,
+                                                         guidance_schedule=guidance_schedule,
+                                                         feature_cache=feature_cache,
+                                                         x_T=start_code[rows],
+                                                         generators=[batch[row].generator for row in rows],
+                                                         callback=progress_callback,
+                                                         img_callback=preview_callback)
+                        samples_ddim = samples_ddim[source_rows]
+                    else:
+                        # no feature caching here: a sweep's batch changes as its trajectories fork and finish,
+                        # and the UNet only reuses features computed for a batch of the same shape
+                        print(f'Sampling sweep of {batch_size} image(s) with {min(step_counts)} to '
+                              f'{max(step_counts)} ddim steps')
+                        plms_sampler = self.samplers['plms']
+                        samples_ddim = plms_sampler.sample_sweep(step_counts,
+                                                                 shape=first_job.shape,
+                                                                 conditioning=conditioning,
+                                                                 x_T=start_code,
+                                                                 source_ids=[job.source_id() for job in batch],
+                                                                 eta=first_job.ddim_eta,
+                                                                 ddim_discretize=first_job.ddim_discretize,
+                                                                 guidance_schedule=guidance_schedule,
+                                                                 max_batch_size=self.max_batch_size,
+                                                                 verbose=False,
+                                                                 unconditional_guidance_scale=first_job.scale,
+                                                                 unconditional_conditioning=unconditional_conditioning,
+                                                                 callback=progress_callback)
+
+                    # decode no more than max_batch_size latents at a time to bound the VAE's memory use,
+                    # then safety check the whole batch at once. Each job's result is a view of the batch's
+                    # uint8 buffer, not a copy
+                    x_samples = self.check_samples(torch.cat([
+                        self.decode_samples(samples_ddim[start:start + self.max_batch_size])
+                        for start in range(0, batch_size, self.max_batch_size)]))
+
+        if preview_seconds > 0:
+            print(f'Previews took {preview_seconds * 1000:.0f}ms, '
+                  f'{100 * preview_seconds / (time.perf_counter() - sampling_start):.2f}% of the batch time')
+
+        for job, x_sample in zip(batch, x_samples):
+            job.result = x_sample
+
+    def decode_samples(self, samples_ddim):
+        # returns the decoded images as uint8 (b, h, w, c), still on the device
+        return to_uint8_tensor(self.model.decode_first_stage(samples_ddim))
+
+    def check_samples(self, x_samples_ddim):
+        # returns the images as one uint8 numpy array (b, h, w, c)
+        if SAFETY_FLAG:
+            x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
+        else:
+            x_checked_image, has_nsfw_concept = danger_will_robinson(x_samples_ddim)
+
+        return x_checked_image
+
+
+def print_cache_stats(model):
+    if hasattr(model.cond_stage_model, 'cache_stats'):
+        print(f"Conditioning cache: {model.cond_stage_model.cache_stats()}")
+    print(f"Sampler schedule cache: {schedule_cache.stats()}")
+
+
+def process(text_prompt, batch_engine, wm_encoder, queue_id, num_images, options):
     print('Running Prompt Processing')
-    sampler = PLMSSampler(model)  # Uses PLMS model
     seed_everything(options['seed'])
     start = time.time()
     library_dir_name = os.path.join(OUTPUT_PATH, queue_id)
     os.makedirs(library_dir_name, exist_ok=True)
-    image_counter = 0
+    images_saved = 0
 
     try:
         assert text_prompt is not None
-        data = [N_SAMPLES * [text_prompt]]
-        start_code = None
-        fixed_code = False  # but these may be in  advanced input parameters in future
-        if fixed_code:
-            start_code = torch.randn(
-                [N_SAMPLES, LATENT_CHANNELS, options['height'] // options['downsampling_factor'],
-                 options['width'] // options['downsampling_factor']],
-                device=device)
-
-        precision_scope = autocast if PRECISION == "autocast" else nullcontext
-        with torch.no_grad():
-            with precision_scope("cuda"):
-                with model.ema_scope():
-                    for n in trange(int(num_images / N_SAMPLES), desc="Sampling"):
-                        for prompts in tqdm(data, desc="data"):
-                            unconditional_conditioning = None
-                            if SCALE != 1.0:
-                                unconditional_conditioning = model.get_learned_conditioning(N_SAMPLES * [""])
-                            if isinstance(prompts, tuple):
-                                prompts = list(prompts)
-                            conditioning = model.get_learned_conditioning(prompts)
-
-                            shape = [LATENT_CHANNELS, options['height'] // options['downsampling_factor'],
-                                     options['width'] // options['downsampling_factor']]
-
-                            max_ddim_steps = options['max_ddim_steps']
-                            min_ddim_steps = options['min_ddim_steps']
-                            for each_ddim_step in range(min_ddim_steps, max_ddim_steps + 1):
-
-                                # forces the seed back to the one requested, or we will get a seed for a
-                                # different image each time we execute run_sampling()
-                                if max_ddim_steps != min_ddim_steps:
-                                    seed_everything(options['seed'])
-
-                                run_sampling(image_counter,
-                                             conditioning,
-                                             each_ddim_step,
-                                             library_dir_name,
-                                             model,
-                                             options,
-                                             sampler,
-                                             shape,
-                                             start_code,
-                                             unconditional_conditioning,
-                                             wm_encoder)
-
-                            end = time.time()
-                            time_taken = end - start
-                            image_changed_flag = True
-                            image_counter += 1
-
+        shape = [LATENT_CHANNELS, options['height'] // options['downsampling_factor'],
+                 options['width'] // options['downsampling_factor']]
+
+        max_ddim_steps = options['max_ddim_steps']
+        min_ddim_steps = options['min_ddim_steps']
+
+        # One job per image per ddim step count. Image n is seeded with seed + n, so any image can be
+        # reproduced on its own by requesting its seed, and every ddim step count of that image starts
+        # from the same noise.
+        jobs = []
+        for image_counter in range(num_images):
+            for each_ddim_step in range(min_ddim_steps, max_ddim_steps + 1):
+                jobs.append(SamplingJob(text_prompt, image_counter, options['seed'] + image_counter, shape,
+                                        each_ddim_step, options['scale'], options['ddim_eta'], queue_id,
+                                        options['sampler'], options['ddim_discretize'], guidance_options(options),
+                                        options['feature_cache_interval']))
+        job_events.publish(queue_id, 'started', {'total_images': len(jobs)})
+        batch_engine.submit(jobs)
+        metadata = image_metadata(queue_id, text_prompt, options, '')
+
+        for job in tqdm(jobs, desc="Sampling"):
+            if job_cancellation.is_cancelled(queue_id):
+                batch_engine.cancel(queue_id)
+                raise JobCancelled()
+            job.wait()
+            if isinstance(job.error, JobCancelled):
+                batch_engine.cancel(queue_id)
+                raise job.error
+            if job.error is not None:
+                print('Error in run_sampling: ' + str(job.error))
+                continue
+            save_image_samples(job.ddim_steps, job.image_counter, library_dir_name, wm_encoder, job.result[None],
+                               job.seed, job.scale, metadata)
+            images_saved += 1
 
-                    save_metadata_file(num_images, library_dir_name, options, queue_id, text_prompt, time_taken, '', '')
+        end = time.time()
+        time_taken = end - start
+        save_metadata_file(num_images, library_dir_name, options, queue_id, text_prompt, time_taken, '', '')
+        print_cache_stats(batch_engine.model)
 
         return {'success': True, 'queue_id': queue_id}
 
+    except JobCancelled as jc:
+        # keep the images already made, with an index.json saying how far the request got
+        print('Request', queue_id, 'cancelled after', images_saved, 'image(s)')
+        time_taken = time.time() - start
+        save_metadata_file(images_saved, library_dir_name, options, queue_id, text_prompt, time_taken, str(jc), '')
+        return {'success': False, 'cancelled': True, 'queue_id': queue_id}
+
     except Exception as e:
         print(e)
         end = time.time()
         time_taken = end - start
         save_metadata_file(num_images, library_dir_name, options, queue_id, text_prompt, time_taken, str(e), '')
-        return {'success': False, 'error: ': 'error: ' + str(e), 'queue_id': queue_id}
-
-
-def run_sampling(image_counter, conditioning, ddim_steps, library_dir_name, model, options, sampler, shape, start_code,
-                 unconditional_conditioning, wm_encoder):
-    try:
-        samples_ddim, _ = sampler.sample(S=ddim_steps,
-                                         conditioning=conditioning,
-                                         batch_size=N_SAMPLES,
-                                         shape=shape,
-                                         verbose=False,
-                                         unconditional_guidance_scale=options['scale'],
-                                         unconditional_conditioning=unconditional_conditioning,
-                                         eta=options['ddim_eta'],
-                                         x_T=start_code)
-        x_samples_ddim = model.decode_first_stage(samples_ddim)
-        x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-        x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
-        # REPLACE WITH orig_check_safety() to re-enable the safety check
-        # x_checked_image, has_nsfw_concept = orig_check_safety(x_samples_ddim)
-        if SAFETY_FLAG:
-            x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
-        else:
-            x_checked_image, has_nsfw_concept = danger_will_robinson(x_samples_ddim)
-
-        x_samples = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
-
-        image_counter = save_image_samples(ddim_steps, image_counter, library_dir_name, wm_encoder, x_samples,
-                                           options['seed'], options['scale'])
-
-    except Exception as e:
-        print('Error in run_sampling: ' + str(e))
-
-    return image_counter
-
-
-def save_image_samples(ddim_steps, image_counter, library_dir_name, wm_encoder, x_samples, seed_value, scale):
+        return {'success': False, 'error': str(e), 'queue_id': queue_id}
+
+
+def guidance_options(options):
+    return options['guidance_start'], options['guidance_end'], options['guidance_decay']
+
+
+def image_metadata(queue_id, text_prompt, options, original_image_path):
+    # The request's details, saved in each of its images by save_image_samples()
+    return {
+        "text_prompt": text_prompt,
+        "queue_id": queue_id,
+        "height": options['height'],
+        "width": options['width'],
+        "ddim_eta": options['ddim_eta'],
+        "scale": options['scale'],
+        "sampler": options['sampler'],
+        "ddim_discretize": options['ddim_discretize'],
+        "guidance_start": options['guidance_start'],
+        "guidance_end": options['guidance_end'],
+        "guidance_decay": options['guidance_decay'],
+        "feature_cache_interval": options['feature_cache_interval'],
+        "downsampling_factor": options['downsampling_factor'],
+        "original_image_path": original_image_path,
+        "strength": options['strength'] if "strength" in options else -1  # -1 means not applicable
+    }
+
+
+def save_image_samples(ddim_steps, image_counter, library_dir_name, wm_encoder, x_samples, seed_value, scale,
+                       metadata=None):
     # Saves the image samples in format: <image_counter>_D<ddim_steps>_S<scale>_R<seed_value>-<random 8 characters>.png
+    # with the metadata (plus the image's own seed and ddim steps) in an iTXt chunk.
+    # x_samples are uint8 images (b, h, w, c) from to_uint8_tensor() - the image_writer does the rest in the background.
     for x_sample in x_samples:
-        x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-        img = Image.fromarray(x_sample.astype(np.uint8))
-        img = put_watermark(img, wm_encoder)
-        img.save(
-            os.path.join(library_dir_name,
-                         f"{image_counter + 1:02d}-D{ddim_steps:03d}-S{scale:.1f}-R{seed_value:0>4}-{str(uuid.uuid4())[:8]}.png"))
+        pnginfo = None
+        if metadata is not None:
+            pnginfo = PngInfo()
+            pnginfo.add_itxt(IMAGE_METADATA_KEY, json.dumps(dict(metadata, seed=seed_value, ddim_steps=ddim_steps),
+                                                            ensure_ascii=False))
+        image_name = f"{image_counter + 1:02d}-D{ddim_steps:03d}-S{scale:.1f}-R{seed_value:0>4}-{str(uuid.uuid4())[:8]}.png"
+        image_writer.submit(library_dir_name, image_name, x_sample, wm_encoder, pnginfo)
         image_counter += 1
     return image_counter
 
 
-def process_image(original_image_path, text_prompt, device, model, wm_encoder, queue_id, num_images, options):
+def process_image(original_image_path, text_prompt, device, model, sampler, wm_encoder, queue_id, num_images,
+                  options):
     print('Running Image Processing')
-    sampler = DDIMSampler(model)  # Uses DDIM model
     seed_everything(options['seed'])
     start = time.time()
     library_dir_name = os.path.join(OUTPUT_PATH, queue_id)
@@ -359,18 +956,41 @@ def process_image(original_image_path, text_prompt, device, model, wm_encoder, q
         init_image = repeat(init_image, '1 ... -> b ...', b=N_SAMPLES)
         init_latent = model.get_first_stage_encoding(model.encode_first_stage(init_image))  # move to latent space
 
-        sampler.make_schedule(ddim_num_steps=max_ddim_steps, ddim_eta=DDIM_ETA, verbose=False)
+        sampler.make_schedule(ddim_num_steps=max_ddim_steps, ddim_discretize=options['ddim_discretize'],
+                              ddim_eta=DDIM_ETA, verbose=False)
+        metadata = image_metadata(queue_id, text_prompt, options, original_image_path)
 
         assert 0. <= options['strength'] <= 1., 'can only work with strength in [0.0, 1.0]'
 
+        # save the resized original image, tagged with the request's metadata like the images made from it
+        original_pnginfo = PngInfo()
+        original_pnginfo.add_itxt(IMAGE_METADATA_KEY, json.dumps(metadata, ensure_ascii=False))
+        save_png(resized_image, os.path.join(library_dir_name, '00-original.png'), original_pnginfo)
+
         t_enc = int(options['strength'] * max_ddim_steps)
         print(f"target t_enc is {t_enc} steps")
+        job_events.publish(queue_id, 'started', {'total_images': num_images})
 
         precision_scope = autocast if PRECISION == "autocast" else nullcontext
-        with torch.no_grad():
+        inference_scope = torch.inference_mode if INFERENCE_MODE else torch.no_grad
+        with inference_scope():
             with precision_scope("cuda"):
                 with model.ema_scope():
                     for n in trange(int(num_images / N_SAMPLES), desc="Sampling"):
+                        images = list(range(n * N_SAMPLES + 1, (n + 1) * N_SAMPLES + 1))
+
+                        def progress_callback(i):
+                            job_events.publish(queue_id, 'progress', {'step': i + 1, 'total_steps': t_enc,
+                                                                      'images': images})
+                            if job_cancellation.is_cancelled(queue_id):
+                                raise JobCancelled()
+
+                        def preview_callback(pred_x0, i):
+                            if wants_preview(i, t_enc):
+                                for image, preview in zip(images, encode_previews(pred_x0)):
+                                    job_events.publish(queue_id, 'preview', {'image': image, 'step': i + 1,
+                                                                             'preview': preview})
+
                         for prompts in tqdm(data, desc="data"):
                             uc = None
                             if SCALE != 1.0:
@@ -383,34 +1003,49 @@ def process_image(original_image_path, text_prompt, device, model, wm_encoder, q
                             z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc] * N_SAMPLES).to(device))
                             # decode it
                             samples = sampler.decode(z_enc, c, t_enc, unconditional_guidance_scale=options['scale'],
-                                                     unconditional_conditioning=uc, )
-
-                            x_samples = model.decode_first_stage(samples)
-                            x_samples = torch.clamp((x_samples + 1.0) / 2.0, min=0.0, max=1.0)
+                                                     unconditional_conditioning=uc, callback=progress_callback,
+                                                     img_callback=preview_callback,
+                                                     guidance_schedule=GuidanceSchedule(options['scale'],
+                                                                                        *guidance_options(options)),
+                                                     feature_cache=FeatureCacheSchedule(
+                                                         options['feature_cache_interval'], FEATURE_CACHE_BRANCH))
+
+                            x_samples = to_uint8_tensor(model.decode_first_stage(samples))
+                            if SAFETY_FLAG:
+                                x_samples, _ = check_safety(x_samples)
+                            else:
+                                x_samples, _ = danger_will_robinson(x_samples)
 
                             # save the newly created images
                             image_counter = save_image_samples(max_ddim_steps, image_counter, library_dir_name,
                                                                wm_encoder,
-                                                               x_samples, options['seed'], options['scale'])
-
-                            # save the resized original image
-                            resized_image.save(os.path.join(library_dir_name, '00-original.png'))
+                                                               x_samples, options['seed'], options['scale'],
+                                                               metadata)
 
                             end = time.time()
                             time_taken = end - start
 
                     save_metadata_file(image_counter, library_dir_name, options, queue_id, text_prompt,
                                        time_taken, '', original_image_path)
+                    print_cache_stats(model)
 
             return {'success': True, 'queue_id': queue_id}
 
+    except JobCancelled as jc:
+        # keep the images already made, with an index.json saying how far the request got
+        print('Request', queue_id, 'cancelled after', image_counter, 'image(s)')
+        time_taken = time.time() - start
+        save_metadata_file(image_counter, library_dir_name, options, queue_id, text_prompt, time_taken, str(jc),
+                           original_image_path)
+        return {'success': False, 'cancelled': True, 'queue_id': queue_id}
+
     except Exception as e:
         print(e)
         end = time.time()
         time_taken = end - start
         save_metadata_file(image_counter, library_dir_name, options, queue_id, text_prompt, time_taken, str(e),
                            original_image_path)
-        return {'success': False, 'error: ': 'error: ' + str(e), 'queue_id': queue_id}
+        return {'success': False, 'error': str(e), 'queue_id': queue_id}
 
     # gzip a string then convert to base64
     def gzip_and_encode(self, string):
@@ -419,6 +1054,10 @@ def process_image(original_image_path, text_prompt, device, model, wm_encoder, q
 
 def save_metadata_file(num_images, library_dir_name, options, queue_id, text_prompt, time_taken, error,
                        original_image_path):
+    # the request's images are still being written in the background - index.json mustn't appear before them
+    failed_writes = image_writer.wait(library_dir_name)
+    if failed_writes and error == '':
+        error = f'{failed_writes} image(s) could not be written'
     with open(library_dir_name + '/index.json', 'w', encoding="utf8") as outfile:
         metadata = {
             "text_prompt": text_prompt,
@@ -432,12 +1071,20 @@ def save_metadata_file(num_images, library_dir_name, options, queue_id, text_pro
             "max_ddim_steps": options['max_ddim_steps'],
             "ddim_eta": options['ddim_eta'],
             "scale": options['scale'],
+            "sampler": options['sampler'],
+            "ddim_discretize": options['ddim_discretize'],
+            "guidance_start": options['guidance_start'],
+            "guidance_end": options['guidance_end'],
+            "guidance_decay": options['guidance_decay'],
+            "feature_cache_interval": options['feature_cache_interval'],
             "downsampling_factor": options['downsampling_factor'],
             "error": error,
             "original_image_path": original_image_path,
             "strength": options['strength'] if "strength" in options else -1  # -1 means not applicable
         }
         json.dump(metadata, outfile, indent=4, ensure_ascii=False)
+    # index.json is the last thing written for a request
+    job_events.publish(queue_id, 'finished', {'success': error == '', 'error': error})
 
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -485,6 +1132,12 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             'min_ddim_steps': DDIM_STEPS,
             'ddim_eta': DDIM_ETA,
             'scale': SCALE,
+            'sampler': SAMPLER,
+            'ddim_discretize': DDIM_DISCRETIZE,
+            'guidance_start': GUIDANCE_START,
+            'guidance_end': GUIDANCE_END,
+            'guidance_decay': GUIDANCE_DECAY,
+            'feature_cache_interval': FEATURE_CACHE_INTERVAL,
             'downsampling_factor': DOWNSAMPLING_FACTOR,
             'strength': STRENGTH
         }
@@ -509,6 +1162,33 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             options['scale'] = float(data['scale'])
         if 'downsampling_factor' in data:
             options['downsampling_factor'] = int(data['downsampling_factor'])
+        if 'sampler' in data:
+            if data['sampler'] in SAMPLERS:
+                options['sampler'] = data['sampler']
+            else:
+                print('Warning: "{}" is not a known sampler - using {}'.format(data['sampler'], SAMPLER))
+        if 'ddim_discretize' in data:
+            if data['ddim_discretize'] in DDIM_DISCRETIZATIONS:
+                options['ddim_discretize'] = data['ddim_discretize']
+            else:
+                print('Warning: "{}" is not a known ddim discretization - using {}'.format(data['ddim_discretize'],
+                                                                                          DDIM_DISCRETIZE))
+        # the guidance interval is clamped to fractions of the sampling steps
+        if 'guidance_start' in data:
+            options['guidance_start'] = min(max(float(data['guidance_start']), 0.0), 1.0)
+        if 'guidance_end' in data:
+            options['guidance_end'] = min(max(float(data['guidance_end']), 0.0), 1.0)
+        if 'guidance_decay' in data:
+            if data['guidance_decay'] in GUIDANCE_DECAYS:
+                options['guidance_decay'] = data['guidance_decay']
+            else:
+                print('Warning: "{}" is not a known guidance decay - using {}'.format(data['guidance_decay'],
+                                                                                    GUIDANCE_DECAY))
+        if 'feature_cache_interval' in data:
+            options['feature_cache_interval'] = min(max(int(data['feature_cache_interval']), 1),
+                                                    FEATURE_CACHE_MAX_INTERVAL)
+        if 'ddim_eta' not in data:
+            options['ddim_eta'] = SAMPLER_DEFAULT_ETA.get(options['sampler'], DDIM_ETA)
 
         if 'ddim_steps' in data:
             options['max_ddim_steps'] = int(data['ddim_steps'])
@@ -517,6 +1197,13 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         if 'min_ddim_steps' in data:
             options['min_ddim_steps'] = int(data['min_ddim_steps'])
 
+        for steps_option in ('min_ddim_steps', 'max_ddim_steps'):
+            if not 1 <= options[steps_option] <= MAX_DDIM_STEPS:
+                print('Warning: {} of {} is not between 1 and {} - using {}'.format(
+                    steps_option, options[steps_option], MAX_DDIM_STEPS,
+                    min(max(options[steps_option], 1), MAX_DDIM_STEPS)))
+                options[steps_option] = min(max(options[steps_option], 1), MAX_DDIM_STEPS)
+
         # safety feature - min_ddim_steps must be less than or equal to  max_ddim_steps
         # otherwise make them the same value
         if options['min_ddim_steps'] > options['max_ddim_steps']:
@@ -541,12 +1228,21 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                 original_image_path = ''
         # process!
         if original_image_path != '':
-            result = process_image(original_image_path, prompt, global_device, global_model,
-                                   global_wm_encoder, queue_id,
-                                   num_images, options)
+            options['sampler'] = 'ddim'  # img2img always uses DDIM
+            # img2img is not batched so it takes the model for the whole request
+            with model_lock:
+                result = process_image(original_image_path, prompt, global_device, global_model,
+                                       global_ddim_sampler, global_wm_encoder, queue_id,
+                                       num_images, options)
         else:
-            result = process(prompt, global_device, global_model, global_wm_encoder, queue_id,
+            if options['sampler'] == 'plms' and options['min_ddim_steps'] != options['max_ddim_steps'] and \
+                    options['feature_cache_interval'] != 1:
+                # several step counts are sampled together by sample_sweep, which runs the whole UNet every step
+                print('Warning: feature caching is not used when sweeping ddim steps - ignoring feature_cache_interval')
+                options['feature_cache_interval'] = 1
+            result = process(prompt, global_batch_engine, global_wm_encoder, queue_id,
                              num_images, options)
+        job_cancellation.forget(queue_id)
 
         # Send the response back to the calling request
         if result == 'X':
@@ -576,9 +1272,14 @@ if __name__ == "__main__":
     print('------------------------------------------')
     print('Starting backend server, please wait...')
     print('------------------------------------------\n\n')
-    global_device, global_model, global_wm_encoder = setup()
-
-    httpd = HTTPServer(('0.0.0.0', PORT), SimpleHTTPRequestHandler)
+    startup_timer = StartupTimer()
+    global_device, global_model, global_wm_encoder = setup(startup_timer)
+    with startup_timer.phase('samplers'):
+        global_batch_engine = MicroBatchEngine(global_model, global_device)
+        global_ddim_sampler = DDIMSampler(global_model)  # Uses DDIM model for img2img
+
+    httpd = ThreadingHTTPServer(('0.0.0.0', PORT), SimpleHTTPRequestHandler)
+    startup_timer.report()
     print('------------------------------------------')
     print('Backend Server ready for processing on port', PORT)
     print('------------------------------------------')
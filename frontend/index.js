@@ -4,6 +4,7 @@ let global_currentQueueId = '';
 let global_imagesRequested = 0;
 let global_countdownValue = 0;
 let global_countdownTimerIntervalId = null;
+let global_jobEventSource = null;
 
 /**
  * Send the text prompt to the AI and get a queue_id back in 'queue_id' which will be used to track the request.
@@ -69,6 +70,12 @@ const prepareRequestData = () =>
             data['scale'] = 7.5;
         }
 
+        data['sampler'] = document.getElementById("sampler").value;
+        data['ddim_discretize'] = document.getElementById("ddim_discretize").value;
+        data['guidance_end'] = parseFloat(document.getElementById("guidance_end").value) / 100;
+        data['guidance_decay'] = document.getElementById("guidance_decay").value;
+        data['feature_cache_interval'] = parseInt(document.getElementById("feature_cache_interval").value);
+
         data['original_image_path'] = document.getElementById("original_image_path").value;
 
         // Note that the strength slider represents a value fomo 0.01 - 99.9% whereas strength is a float from 0.0 to 0.999
@@ -127,6 +134,134 @@ const processPromptRequestResponse = async (rawResponse) =>
     document.getElementById('buttonGo').enabled = true;
 
     await createImagePlaceHolders();
+
+    // where the browser supports server-sent events, the server pushes progress and images to us as they happen
+    if (rawResponse.status === 200 && window.EventSource)
+    {
+        const maxDDIMSteps = document.getElementById("max_ddim_steps") ? parseInt(document.getElementById("max_ddim_steps").value) : 0;
+        const minDDIMSteps = document.getElementById("min_ddim_steps") ? parseInt(document.getElementById("min_ddim_steps").value) : 0;
+        followJobEvents(global_currentQueueId, global_imagesRequested * (maxDDIMSteps - minDDIMSteps + 1));
+    }
+}
+
+/**
+ * Follow our request's progress through the server-sent events on /events/<queue_id>: a list of the images
+ * created so far, then sampling progress, each image as it is saved, and finally the end of processing.
+ * @param queueId
+ * @param requestedImageCount
+ */
+const followJobEvents = (queueId, requestedImageCount) =>
+{
+    if (global_jobEventSource)
+    {
+        global_jobEventSource.close();
+    }
+    const status = document.getElementById("status");
+    const includesOriginalImage =  document.getElementById("original_image_path") && document.getElementById("original_image_path").value !== "";
+    let imageList = [];
+
+    const createdImageCount = () => includesOriginalImage ? Math.max(imageList.length - 1, 0) : imageList.length;
+
+    const jobEventSource = new EventSource(`/events/${queueId}`);
+    global_jobEventSource = jobEventSource;
+
+    jobEventSource.addEventListener('images', async (e) =>
+    {
+        imageList = JSON.parse(e.data)['images'];
+        if (imageList.length > 0)
+        {
+            await displayImages(imageList);
+        }
+    });
+
+    jobEventSource.addEventListener('progress', (e) =>
+    {
+        const progress = JSON.parse(e.data);
+        status.innerHTML = `<i>${createdImageCount()} of ${requestedImageCount} images created so far - step ${progress.step} of ${progress.total_steps}...</i>`;
+    });
+
+    jobEventSource.addEventListener('preview', (e) =>
+    {
+        // a rough preview of an image still being created goes in its placeholder until the real image arrives
+        const preview = JSON.parse(e.data);
+        const image = document.getElementById(`image_${(includesOriginalImage ? 1 : 0) + preview.image - 1}`);
+        if (image && (image.src.includes("blank.png") || image.src.startsWith("data:")))
+        {
+            image.src = preview.preview;
+        }
+    });
+
+    jobEventSource.addEventListener('image', async (e) =>
+    {
+        const image = JSON.parse(e.data)['image'];
+        if (!imageList.includes(image))    // it may already have been in the 'images' list we started with
+        {
+            imageList.push(image);
+        }
+        await displayImages(imageList);
+    });
+
+    jobEventSource.addEventListener('finished', async (e) =>
+    {
+        const finished = JSON.parse(e.data);
+        jobEventSource.close();
+        if (global_jobEventSource === jobEventSource)
+        {
+            global_jobEventSource = null;
+        }
+        status.innerText = finished.error === "cancelled" ? "Processing cancelled" : "Processing completed";
+        if (finished.error !== "cancelled" && (!finished.success || createdImageCount() < requestedImageCount))
+        {
+            status.innerText += " - some DDIM steps failed to process";
+        }
+        document.getElementById("buttonGo").innerText = "Click to send request";
+        document.getElementById("buttonGo").enabled = true;
+        await displayImages(imageList);
+    });
+}
+
+
+/**
+ * Cancel our current request. If it's still in the queue it is removed, and if the AI is working on it
+ * then it stops after the current sampling step, keeping any images already created.
+ * @returns {Promise<void>}
+ */
+const cancelRequest = async () =>
+{
+    if (global_currentQueueId === '')
+    {
+        return;
+    }
+    const rawResponse = await fetch('/cancel', {
+        method: 'POST',
+        headers: {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({queue_id: global_currentQueueId})
+    });
+
+    if (rawResponse.status === 200)
+    {
+        if (global_countdownTimerIntervalId)
+        {
+            clearInterval(global_countdownTimerIntervalId);
+            global_countdownTimerIntervalId = null;
+        }
+        if (global_jobEventSource)
+        {
+            global_jobEventSource.close();
+            global_jobEventSource = null;
+        }
+        global_currentQueueId = '';
+        document.getElementById('status').innerText = "Request cancelled";
+        document.getElementById("buttonGo").innerText = "Click to send request";
+        document.getElementById("buttonGo").enabled = true;
+    }
+    else
+    {
+        document.getElementById('status').innerText = `Sorry, an HTTP error ${rawResponse.status} occurred cancelling the request`;
+    }
 }
 
 
@@ -307,11 +442,11 @@ const authorDescriptionFromImageFileName = (imageFileName) =>
  */
 const displayImages = (imageList) =>
 {
-    const timestamp = new Date().getTime();    // used to force a reload of the image and not get a cached copy
+    // generated images never change once written (each has a unique file name) so the browser's cached copies are used
     const masterImage = document.getElementById("master_image");
     const masterImageCaption = document.getElementById("master_image_caption");
 
-    masterImage.src = imageList.length > 0 ? `${imageList[imageList.length - 1]}?timestamp=${timestamp}` : "/blank.png";
+    masterImage.src = imageList.length > 0 ? `${imageList[imageList.length - 1]}` : "/blank.png";
     if(!masterImage.src.includes("blank.png") && !masterImage.src.includes("original.png"))
     {
         masterImageCaption.innerText = authorDescriptionFromImageFileName(masterImage.src)
@@ -323,7 +458,7 @@ const displayImages = (imageList) =>
     for(let imageIndex = 0; imageIndex < imageList.length; imageIndex += 1)
     {
         const image = document.getElementById(`image_${imageIndex}`);
-        image.src = imageList[imageIndex] ? `${imageList[imageIndex]}?timestamp=${timestamp}` : "/blank.png";
+        image.src = imageList[imageIndex] ? `${imageList[imageIndex]}` : "/blank.png";
         image.width = image.height / widthHeightRatio;
     }
 }
@@ -584,6 +719,26 @@ const populateControlsFromHref = () =>
             document.getElementById('scale').value = params.get('scale');
             document.getElementById('scale_value').innerText = params.get('scale');
         }
+        if (params.has('sampler'))
+        {
+            document.getElementById('sampler').value = params.get('sampler');
+        }
+        if (params.has('ddim_discretize'))
+        {
+            document.getElementById('ddim_discretize').value = params.get('ddim_discretize');
+        }
+        if (params.has('guidance_end'))
+        {
+            document.getElementById('guidance_end').value = Math.round(parseFloat(params.get('guidance_end')) * 100);
+        }
+        if (params.has('guidance_decay'))
+        {
+            document.getElementById('guidance_decay').value = params.get('guidance_decay');
+        }
+        if (params.has('feature_cache_interval'))
+        {
+            document.getElementById('feature_cache_interval').value = params.get('feature_cache_interval');
+        }
         if (params.has('downsampling_factor'))
         {
             if (params.get('downsampling_factor') === "2")
@@ -729,8 +884,8 @@ const retrieveAndDisplayCurrentQueue = async () =>
         if(queueData.length > 0)
         {
             // if our queue_is is found at the top of the queue, the backend is processing our request so we
-            // need to start the countdown timer (unless it's already running)
-            if (queueData[0].queue_id === global_currentQueueId && !global_countdownTimerIntervalId)
+            // need to start the countdown timer (unless it's already running, or the server is pushing our progress)
+            if (queueData[0].queue_id === global_currentQueueId && !global_countdownTimerIntervalId && !global_jobEventSource)
             {
                 const maxDDIMSteps = queueData[0].max_ddim_steps ? queueData[0].max_ddim_steps : 0;
                 const minDDIMSteps = queueData[0].min_ddim_steps ? queueData[0].min_ddim_steps : 0;
@@ -739,4 +894,20 @@ const retrieveAndDisplayCurrentQueue = async () =>
         }
     }
 }
-setInterval(retrieveAndDisplayCurrentQueue, 2000);
+
+/**
+ * Where the browser supports server-sent events, the server pushes the queue to us each time it changes
+ * instead of it being polled.
+ */
+if (window.EventSource)
+{
+    const queueEventSource = new EventSource('/events/queue');
+    queueEventSource.addEventListener('queue', async (e) =>
+    {
+        await displayQueue(JSON.parse(e.data));
+    });
+}
+else
+{
+    setInterval(retrieveAndDisplayCurrentQueue, 2000);
+}
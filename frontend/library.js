@@ -174,6 +174,22 @@ const authorParametersListForWeb = (libraryItem) =>
     text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;Min DDIM Steps: ${libraryItem['min_ddim_steps']}`;
     text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;Max DDIM Steps: ${libraryItem['max_ddim_steps']}`;
     text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;scale: ${libraryItem['scale']}`;
+    if ('sampler' in libraryItem)
+    {
+        text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;sampler: ${libraryItem['sampler']}`;
+    }
+    if ('ddim_discretize' in libraryItem)
+    {
+        text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;timestep spacing: ${libraryItem['ddim_discretize']}`;
+    }
+    if ('guidance_end' in libraryItem)
+    {
+        text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;guidance: ${libraryItem['guidance_start']} to ${libraryItem['guidance_end']}, decay ${libraryItem['guidance_decay']}`;
+    }
+    if ('feature_cache_interval' in libraryItem && libraryItem['feature_cache_interval'] > 1)
+    {
+        text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;feature caching: full UNet every ${libraryItem['feature_cache_interval']} steps`;
+    }
     text += `<br>&nbsp;&nbsp;&nbsp;&nbsp;downsampling factor: ${libraryItem['downsampling_factor']}`;
     if (libraryItem['original_image_path'] !== '')
     {
@@ -191,7 +207,7 @@ const createLinkToAdvancedPage = (image_src, libraryItem) =>
 {
     const urlencoded_image_src = encodeURIComponent(image_src);
     const urlEncodedPrompt = encodeURIComponent(libraryItem['text_prompt']);
-    const link = `advanced.html?original_image_path=${urlencoded_image_src}&prompt=${urlEncodedPrompt}&seed=${libraryItem['seed']}&height=${libraryItem['height']}&width=${libraryItem['width']}&min_ddim_steps=${libraryItem['min_ddim_steps']}&max_ddim_steps=${libraryItem['max_ddim_steps']}&ddim_eta=${libraryItem['ddim_eta']}&scale=${libraryItem['scale']}&downsampling_factor=${libraryItem['downsampling_factor']}`;
+    const link = `advanced.html?original_image_path=${urlencoded_image_src}&prompt=${urlEncodedPrompt}&seed=${libraryItem['seed']}&height=${libraryItem['height']}&width=${libraryItem['width']}&min_ddim_steps=${libraryItem['min_ddim_steps']}&max_ddim_steps=${libraryItem['max_ddim_steps']}&ddim_eta=${libraryItem['ddim_eta']}&scale=${libraryItem['scale']}&sampler=${libraryItem['sampler'] || 'plms'}&ddim_discretize=${libraryItem['ddim_discretize'] || 'uniform'}&guidance_end=${libraryItem['guidance_end'] ?? 1}&guidance_decay=${libraryItem['guidance_decay'] || 'none'}&feature_cache_interval=${libraryItem['feature_cache_interval'] || 1}&downsampling_factor=${libraryItem['downsampling_factor']}`;
     return link;
 }
 
@@ -0,0 +1,88 @@
+"""
+Load benchmark for the frontend relay: many simulated clients hit a mix of static UI files and API calls at once,
+and the p50/p99 latency of each is reported.
+
+    python3 load_benchmark.py --url http://localhost:8000 --clients 20 --requests 50
+"""
+import argparse
+import random
+import threading
+import time
+import urllib.request
+import urllib.error
+
+# (path, weight) - roughly what a handful of open tabs do: poll the queue every 2 seconds, load the library,
+# and fetch the UI files and images
+TRAFFIC_MIX = [
+    ('/queue_status', 6),
+    ('/getlibrary', 1),
+    ('/', 1),
+    ('/index.js', 1),
+    ('/library.js', 1),
+    ('/favicon-32x32.png', 1),
+    ('/android-chrome-512x512.png', 1),
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_client(base_url, num_requests, paths, weights, timings, errors, lock):
+    for _ in range(num_requests):
+        path = random.choices(paths, weights=weights)[0]
+        tic = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base_url + path, timeout=30) as response:
+                response.read()
+            elapsed = time.perf_counter() - tic
+            with lock:
+                timings.setdefault(path, []).append(elapsed)
+        except (urllib.error.URLError, OSError) as e:
+            with lock:
+                errors.append((path, str(e)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://localhost:8000', help='the frontend to test')
+    parser.add_argument('--clients', type=int, default=20, help='clients sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=50, help='requests sent by each client')
+    opt = parser.parse_args()
+
+    paths = [path for path, _ in TRAFFIC_MIX]
+    weights = [weight for _, weight in TRAFFIC_MIX]
+    timings = {}
+    errors = []
+    lock = threading.Lock()
+
+    clients = [threading.Thread(target=run_client,
+                                args=(opt.url.rstrip('/'), opt.requests, paths, weights, timings, errors, lock))
+               for _ in range(opt.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    wall_time = time.perf_counter() - start
+
+    print(f"{'path':<30} {'count':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    all_timings = []
+    for path in paths:
+        path_timings = sorted(timings.get(path, []))
+        all_timings.extend(path_timings)
+        print(f"{path:<30} {len(path_timings):>6} {percentile(path_timings, 0.5) * 1000:>9.1f} "
+              f"{percentile(path_timings, 0.99) * 1000:>9.1f}")
+    all_timings.sort()
+    print(f"{'all':<30} {len(all_timings):>6} {percentile(all_timings, 0.5) * 1000:>9.1f} "
+          f"{percentile(all_timings, 0.99) * 1000:>9.1f}")
+    print(f"{len(all_timings) / wall_time:.1f} requests/s with {opt.clients} clients, {len(errors)} errors")
+    for path, error in errors[:10]:
+        print('  error:', path, error)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,231 @@ import sys
 import redis
 import uuid
 import base64
+import threading
+import queue
+import time
+import email.utils
+from collections import OrderedDict
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LIBRARY_SNAPSHOT_PATH = '/app/library/library.json'  # the library catalogue written by the scheduler...
+LIBRARY_LOG_PATH = '/app/library/library.jsonl'  # ...and the entries it has appended since
+
+STATIC_CACHE_MAX_BYTES = 32 * 1024 * 1024  # memory held by the static file cache...
+STATIC_CACHE_MAX_FILE_SIZE = 512 * 1024  # ...for UI files up to this size - the rest are streamed with sendfile
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # generated images never change once written
+REVALIDATE_CACHE_CONTROL = 'no-cache'  # everything else may change so is checked with the ETag on each use
+
+QUEUE_EVENTS_CHANNEL = 'queue_events'  # published to by the scheduler (and here) whenever the queue changes
+JOB_EVENTS_PATTERN = 'events:*'  # the backend publishes each request's progress to 'events:<queue_id>'
+EVENTS_KEEPALIVE = 15  # seconds between keep-alive comments on an otherwise quiet event stream
+CANCEL_KEY_EXPIRY = 24 * 60 * 60  # seconds a request's 'cancel:<queue_id>' key is kept for the scheduler and backend
+
+# one pool of connections to redis shared by all the request handling threads
+redis_pool = redis.ConnectionPool(host='scheduler', port=6379, db=0, password='hellothere')
+
+
+def read_queue():
+    # The queue, next to be processed first. Requests the scheduler is working on sit in 'processing',
+    # ahead of those still waiting in 'queue'
+    try:
+        r = redis.Redis(connection_pool=redis_pool)
+        queue_list = []
+        queued, processing = r.pipeline().lrange('queue', 0, -1).lrange('processing', 0, -1).execute()
+        queue_data = queued + processing
+        for queue_item in queue_data:
+            queue_list.append(json.loads(queue_item.decode()))
+        queue_list.reverse()
+        return queue_list
+    except Exception as e:
+        print("\nFRONTEND: read_queue Error:", e)
+        return []
+
+
+class EventHub(object):
+    """
+    Relays the job events the backend publishes to redis to the browsers following a request on /events/<queue_id>,
+    and sends the queue to the browsers on /events/queue each time it changes. A single redis subscription serves
+    every connected browser, and the queue is read once per change however many browsers are watching it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = {}  # channel -> set of queue.Queue, one per connected browser
+        self.thread = None
+
+    def listen(self, channel):
+        listener = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.listeners.setdefault(channel, set()).add(listener)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self.thread.start()
+        return listener
+
+    def stop_listening(self, channel, listener):
+        with self.lock:
+            channel_listeners = self.listeners.get(channel, set())
+            channel_listeners.discard(listener)
+            if len(channel_listeners) == 0:
+                self.listeners.pop(channel, None)
+
+    def _dispatch(self, channel, event, data):
+        with self.lock:
+            channel_listeners = list(self.listeners.get(channel, ()))
+        for listener in channel_listeners:
+            try:
+                listener.put_nowait((event, data))
+            except queue.Full:
+                pass  # that browser has stopped reading
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = redis.Redis(connection_pool=redis_pool).pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(JOB_EVENTS_PATTERN)
+                pubsub.subscribe(QUEUE_EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    channel = message['channel'].decode()
+                    if channel == QUEUE_EVENTS_CHANNEL:
+                        if QUEUE_EVENTS_CHANNEL in self.listeners:
+                            self._dispatch(channel, 'queue', json.dumps(read_queue()))
+                    else:
+                        data = message['data'].decode('utf-8')
+                        try:
+                            event = json.loads(data)['event']
+                        except (ValueError, KeyError):
+                            continue
+                        self._dispatch(channel, event, data)
+            except Exception as e:
+                print("\nFRONTEND: EventHub Error:", e)
+                time.sleep(1)
+
+
+event_hub = EventHub()
+
+
+class LibraryCatalogueReader(object):
+    """
+    Serves the scheduler's library catalogue: the library.json snapshot merged with the library.jsonl log of entries
+    added since, later entries replacing earlier ones with the same queue_id. The snapshot is only re-read when it
+    changes and the log is read on from where the last read stopped.
+    """
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.snapshot_stat = None
+        self.snapshot_entries = {}
+        self.log_offset = 0
+        self.log_entries = {}
+        self.response = None
+
+    def get_library_json(self):
+        with self.lock:
+            changed = self.read_snapshot()
+            if changed:
+                # a new snapshot means the log has been, or is about to be, started again
+                self.log_offset = 0
+                self.log_entries = {}
+            changed = self.read_log() or changed
+            if changed or self.response is None:
+                library = dict(self.snapshot_entries)
+                library.update(self.log_entries)
+                self.response = json.dumps(list(library.values())).encode()
+            return self.response
+
+    def read_snapshot(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            stat = None
+        snapshot_stat = None if stat is None else (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if snapshot_stat == self.snapshot_stat:
+            return False
+
+        self.snapshot_entries = {}
+        if stat is not None:
+            try:
+                with open(self.snapshot_path, 'r', encoding='utf8') as snapshot_file:
+                    for library_entry in json.load(snapshot_file):
+                        self.snapshot_entries[library_entry['queue_id']] = library_entry
+            except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+                print("\nFRONTEND: read_snapshot Error:", e)
+                return False
+        self.snapshot_stat = snapshot_stat
+        return True
+
+    def read_log(self):
+        try:
+            log_size = os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            log_size = 0
+        changed = False
+        if log_size < self.log_offset:
+            # the scheduler has folded the log into the snapshot and started it again
+            self.log_offset = 0
+            self.log_entries = {}
+            changed = True
+        if log_size == self.log_offset:
+            return changed
+
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(self.log_offset)
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break  # still being written, pick it up next time
+                self.log_offset += len(line)
+                try:
+                    library_entry = json.loads(line.decode('utf-8'))
+                except json.decoder.JSONDecodeError:
+                    continue
+                self.log_entries[library_entry['queue_id']] = library_entry
+        return True
+
+
+library_catalogue_reader = LibraryCatalogueReader(LIBRARY_SNAPSHOT_PATH, LIBRARY_LOG_PATH)
+
+
+class StaticFileCache(object):
+    """
+    Holds the contents of small files (the UI's html, js, css and icons) in memory, least recently used first out
+    once max_bytes is reached. An entry is only used while the file's modification time and size still match.
+    """
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # file path -> ((mtime_ns, size), data)
+        self.bytes = 0
+
+    def get(self, file_path, stat):
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None:
+                if entry[0] == key:
+                    self.entries.move_to_end(file_path)
+                    return entry[1]
+                self.bytes -= len(entry[1])
+                del self.entries[file_path]
+
+        with open(file_path, 'rb') as data_file:
+            data = data_file.read()
+        if len(data) == stat.st_size:  # don't cache a file caught part way through being written
+            with self.lock:
+                old_entry = self.entries.pop(file_path, None)
+                if old_entry is not None:
+                    self.bytes -= len(old_entry[1])
+                self.entries[file_path] = (key, data)
+                self.bytes += len(data)
+                while self.bytes > self.max_bytes:
+                    _, (_, evicted_data) = self.entries.popitem(last=False)
+                    self.bytes -= len(evicted_data)
+        return data
+
+
+static_file_cache = StaticFileCache(STATIC_CACHE_MAX_BYTES, STATIC_CACHE_MAX_FILE_SIZE)
 
 
 class RelayServer(BaseHTTPRequestHandler):
@@ -28,7 +251,10 @@ class RelayServer(BaseHTTPRequestHandler):
             self.process_ui('/index.html')
 
         elif api_command.endswith('/getlibrary'):
-            self.process_ui('/library/library.json')
+            self.process_getlibrary()
+
+        elif api_command.startswith('/events/'):
+            self.process_events(api_command[len('/events/'):])
 
         elif api_command.endswith('.html') or \
                 'advanced.html?' in api_command or \
@@ -82,6 +308,18 @@ class RelayServer(BaseHTTPRequestHandler):
                 response_body = '{"queue_id": "' + result + '"}'
                 self.wfile.write(response_body.encode())
 
+        elif api_command == '/cancel':
+            if 'queue_id' in data and self.cancel_queue_request(data['queue_id']):
+                self.send_response(200)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"success": true}')
+            else:
+                self.send_response(400)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"success": false}')
+
         elif api_command == '/deleteimage':
             if self.process_deleteimage(data):
                 self.send_response(200)
@@ -151,18 +389,37 @@ class RelayServer(BaseHTTPRequestHandler):
 
     def queue_request_to_redis(self, data):
         try:
-            r = redis.Redis(host='scheduler', port=6379, db=0, password='hellothere')
+            r = redis.Redis(connection_pool=redis_pool)
             data['queue_id'] = str(uuid.uuid4())
             data['num_images'] = int(data['num_images'])
             data['seed'] = int(data['seed'])
 
             r.lpush('queue', json.dumps(data))
+            r.publish(QUEUE_EVENTS_CHANNEL, 'changed')
             print("\nFRONTEND: Request queued to redis with queue_id:", data['queue_id'])
             return data['queue_id']
         except Exception as e:
             print("\nFRONTEND: queue_request_to_redis Error:", e)
             return 'X'
 
+    def cancel_queue_request(self, queue_id):
+        # Marks the request cancelled - the backend checks for this between sampling steps and stops, and the
+        # scheduler drops the request if it hasn't started. If it's still waiting in the queue it is taken out now.
+        try:
+            queue_id = str(uuid.UUID(queue_id))
+            r = redis.Redis(connection_pool=redis_pool)
+            r.set('cancel:' + queue_id, 1, ex=CANCEL_KEY_EXPIRY)
+            for queue_item in r.lrange('queue', 0, -1):
+                if json.loads(queue_item.decode())['queue_id'] == queue_id:
+                    r.lrem('queue', 1, queue_item)
+                    r.publish(QUEUE_EVENTS_CHANNEL, 'changed')
+                    break
+            print("\nFRONTEND: Request cancelled with queue_id:", queue_id)
+            return True
+        except Exception as e:
+            print("\nFRONTEND: cancel_queue_request Error:", e)
+            return False
+
     def get_image_list(self, queue_id):
         image_data = {
             'completed': False,
@@ -179,17 +436,57 @@ class RelayServer(BaseHTTPRequestHandler):
         return image_data
 
     def check_queue_request(self):
+        return read_queue()
+
+    def process_events(self, stream_id):
+        # Server-sent events: /events/queue streams the queue each time it changes and /events/<queue_id> streams
+        # that request's progress, images and finish. Each starts with the current state so nothing is missed.
+        if stream_id == 'queue':
+            channel = QUEUE_EVENTS_CHANNEL
+        else:
+            try:
+                stream_id = str(uuid.UUID(stream_id))
+            except ValueError:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            channel = 'events:' + stream_id
+
+        listener = event_hub.listen(channel)
         try:
-            r = redis.Redis(host='scheduler', port=6379, db=0, password='hellothere')
-            queue_list = []
-            queue_data = r.lrange('queue', 0, -1)
-            for queue_item in queue_data:
-                queue_list.append(json.loads(queue_item.decode()))
-            queue_list.reverse()
-            return queue_list
-        except Exception as e:
-            print("\nFRONTEND: check_queue_request Error:", e)
-            return []
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            self.end_headers()
+
+            if stream_id == 'queue':
+                self.write_event('queue', json.dumps(read_queue()))
+            else:
+                image_data = self.get_image_list(stream_id)
+                self.write_event('images', json.dumps(image_data))
+                if image_data['completed']:
+                    self.write_event('finished', json.dumps({'queue_id': stream_id, 'success': True, 'error': ''}))
+                    return
+
+            while True:
+                try:
+                    event, data = listener.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                    continue
+                self.write_event(event, data)
+                if event == 'finished':
+                    return
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the browser has gone
+        finally:
+            event_hub.stop_listening(channel, listener)
+
+    def write_event(self, event, data):
+        self.wfile.write(('event: ' + event + '\ndata: ' + data + '\n\n').encode('utf-8'))
 
     def process_deleteimage(self, data):
         try:
@@ -201,6 +498,13 @@ class RelayServer(BaseHTTPRequestHandler):
             return False
         return True
 
+    def process_getlibrary(self):
+        response_body = library_catalogue_reader.get_library_json()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(response_body)
+
     def process_ui(self, path):
         print('\nFRONTEND: Serving UI file:', path)
         if path.endswith('.html'):
@@ -215,7 +519,7 @@ class RelayServer(BaseHTTPRequestHandler):
             response_content_type = 'image/gif'
         elif path.endswith('.png'):
             response_content_type = 'image/png'
-        elif path.endswith('.jpg'):
+        elif path.endswith('.jpg') or path.endswith('.jpeg'):
             response_content_type = 'image/jpeg'
         elif path.endswith('.map'):
             response_content_type = 'application/json'
@@ -224,22 +528,66 @@ class RelayServer(BaseHTTPRequestHandler):
 
         file_path = '/app' + path
 
-
         try:
-            with open(file_path, 'rb') as data_file:
-                data = data_file.read()
-                self.log_message(file_path + ' file read successfully')
-                self.send_response(200)
-                self.send_header('Content-Type', response_content_type)
+            stat = os.stat(file_path)
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            if path.startswith('/library/') and 'drag_and_drop_images' not in path:
+                cache_control = IMMUTABLE_CACHE_CONTROL
+            else:
+                cache_control = REVALIDATE_CACHE_CONTROL
+
+            if self.is_not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Cache-Control', cache_control)
                 self.end_headers()
+                return
+
+            # the cache is for the UI's own files - library images are many, rarely read twice by the same browser
+            # and would push the UI out of it
+            if stat.st_size <= static_file_cache.max_file_size and not path.startswith('/library/'):
+                data = static_file_cache.get(file_path, stat)
+                self.send_file_headers(response_content_type, len(data), etag, last_modified, cache_control)
                 self.wfile.write(data)
+            else:
+                # library and large files go straight from the file to the socket without passing through python
+                with open(file_path, 'rb') as data_file:
+                    self.send_file_headers(response_content_type, stat.st_size, etag, last_modified, cache_control)
+                    self.connection.sendfile(data_file, 0, stat.st_size)
 
-        except FileNotFoundError:
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             print(file_path + ' file not found')
             self.log_message(file_path + ' file not found')
             self.send_response(404)
+            self.send_header('Content-Length', '0')
             self.end_headers()
 
+    def is_not_modified(self, etag, mtime):
+        # If-None-Match takes precedence over If-Modified-Since when both are sent
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def send_file_headers(self, content_type, content_length, etag, last_modified, cache_control):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(content_length))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
 
 def exit_signal_handler(self, sig):
     sys.stderr.write('Shutting down...\n')
@@ -250,7 +598,9 @@ def exit_signal_handler(self, sig):
 if __name__ == "__main__":
     signal.signal(signal.SIGTERM, exit_signal_handler)
     signal.signal(signal.SIGINT, exit_signal_handler)
-    relayServerRef = HTTPServer(("", 3000), RelayServer)
+    # each request is handled on its own thread so slow image reads and queue polls don't hold each other up
+    relayServerRef = ThreadingHTTPServer(("", 3000), RelayServer)
+    relayServerRef.daemon_threads = True
     sys.stderr.write('Frontend Web Server\n\n')
     sys.stderr.flush()
 
@@ -3,41 +3,133 @@ import sys
 import json
 import copy
 import time
+import zlib
+import struct
+import threading
 from json import JSONDecodeError
 
 import redis
 import signal
 import requests
 
-METADATA_START = b'##STARTMETADATA##'
-METADATA_END = b'##ENDMETADATA##'
-ADD_METADATA_TO_FILES = True
+METADATA_START = b'##STARTMETADATA##'  # legacy metadata appended to the end of image files, now replaced by a PNG
+# iTXt chunk - see migrate_library_metadata()
+IMAGE_METADATA_KEY = b'sd-metadata'  # keyword of the PNG iTXt chunk the backend writes each image's metadata to
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+ADD_METADATA_TO_FILES = True  # report library images without a metadata chunk when the catalogue is rebuilt
+QUEUE_KEY = 'queue'  # the frontend LPUSHes new requests, so the oldest request is at the right hand end
+PROCESSING_KEY = 'processing'  # requests taken off the queue but not yet finished, kept for crash recovery
+QUEUE_BLOCK_TIMEOUT = 5  # seconds to block waiting for a request before looping round again
+QUEUE_EVENTS_CHANNEL = 'queue_events'  # published to whenever the queue changes, so the frontend can push it out
+# comma separated sd-backend endpoints to share the work between, e.g. "http://sd-backend:8080,http://sd-backend-2:8080"
+SD_BACKENDS = [url.strip() for url in os.environ.get('SD_BACKENDS', 'http://sd-backend:8080').split(',') if url.strip()]
+# requests sent to each backend at once - more than 1 lets a backend batch images from several requests together
+BACKEND_CONCURRENCY = int(os.environ.get('BACKEND_CONCURRENCY', '2'))
+BACKEND_CONNECT_TIMEOUT = 10  # seconds to wait to connect to a backend...
+# ...and for it to answer - a request can take a long time, but a backend silent for this long has hung
+BACKEND_READ_TIMEOUT = int(os.environ.get('BACKEND_READ_TIMEOUT', '1800'))
+BACKEND_RETRY_DELAY = 5  # seconds before a failed backend is tried again, doubling with each further failure...
+BACKEND_MAX_RETRY_DELAY = 120  # ...up to this
+MAX_DISPATCH_ATTEMPTS = 3  # backends a request is tried on before it is given up on
+LIBRARY_SNAPSHOT_PATH = '/app/library/library.json'  # the library catalogue, read by the frontend...
+LIBRARY_LOG_PATH = '/app/library/library.jsonl'  # ...with the entries added since it was last written
+LIBRARY_COMPACT_EVERY = 200  # entries appended to the log before it is folded into library.json
+
+# one pool of connections to redis for the life of the scheduler
+redis_pool = redis.ConnectionPool(host='scheduler', port=6379, db=0, password='hellothere')
+library_lock = threading.Lock()  # requests finish on their own threads but only one may write library.json at a time
+requeue_lock = threading.Lock()
+requeue_counts = {}  # queue_id -> times the request has been re-queued after a backend stopped answering
+
+
+def get_redis():
+    return redis.Redis(connection_pool=redis_pool)
+
+
+def is_request_cancelled(queue_id):
+    # the frontend sets 'cancel:<queue_id>' when the user cancels a request
+    try:
+        return get_redis().exists('cancel:' + queue_id) > 0
+    except redis.exceptions.RedisError as re:
+        print("SCHEDULER: is_request_cancelled Error:", re)
+        return False
+
+
+def publish_queue_changed():
+    try:
+        get_redis().publish(QUEUE_EVENTS_CHANNEL, 'changed')
+    except redis.exceptions.RedisError as re:
+        print("SCHEDULER: publish_queue_changed Error:", re)
+
+
+def recover_in_flight_requests():
+    # Requests still in the processing list were in flight when the scheduler last stopped,
+    # so put them back at the front of the queue (oldest first) to be processed again
+    recovered = 0
+    while True:
+        try:
+            r = get_redis()
+            while r.lmove(PROCESSING_KEY, QUEUE_KEY, 'LEFT', 'RIGHT') is not None:
+                recovered += 1
+            break
+        except redis.exceptions.ConnectionError as ce:
+            # redis is started alongside the scheduler so may not be up yet
+            print("SCHEDULER: recover_in_flight_requests waiting for redis:", ce)
+            time.sleep(1)
+    if recovered > 0:
+        print('SCHEDULER: Re-queued', recovered, 'request(s) that were in flight when the scheduler stopped')
 
 
 def get_next_queue_request():
+    # Blocks until a request arrives (or QUEUE_BLOCK_TIMEOUT passes), atomically moving the oldest request
+    # onto the processing list. Returns the decoded request and the raw item needed to delete it when done.
+    # An 'empty' queue item ({'queue_id': 'X'}) is returned if there is nothing to process.
     try:
-        r = redis.Redis(host='scheduler', port=6379, db=0, password='hellothere')
-        queue_list = []
-        queue_data = r.lrange('queue', 0, -1)
-        if len(queue_data) > 0:
-            for current_queue_item in queue_data:
-                queue_list.append(json.loads(current_queue_item.decode()))
-            queue_list.reverse()
-            return queue_list[0]
-        else:
-            # Return an 'empty' queue item which will be used to stop the scheduler trying to delete a non-existent queue item
-            return {'queue_id': 'X'}
+        raw_queue_item = get_redis().blmove(QUEUE_KEY, PROCESSING_KEY, QUEUE_BLOCK_TIMEOUT, 'RIGHT', 'LEFT')
+        if raw_queue_item is None:
+            return {'queue_id': 'X'}, None
+        publish_queue_changed()
+        try:
+            return json.loads(raw_queue_item.decode()), raw_queue_item
+        except JSONDecodeError as jde:
+            print("SCHEDULER: get_next_queue_request dropping unreadable queue item:", jde)
+            delete_request_from_redis_queue(raw_queue_item)
+            return {'queue_id': 'X'}, None
 
+    except redis.exceptions.ConnectionError as ce:
+        print("SCHEDULER: get_next_queue_request Connection Error:", ce)
+        time.sleep(1)  # don't spin while redis is unavailable
+        return {'queue_id': 'X'}, None
     except Exception as e:
         print("SCHEDULER: get_next_queue_request Error:", e)
-        return {'queue_id': 'X'}
+        time.sleep(1)
+        return {'queue_id': 'X'}, None
+
+
+def requeue_request(raw_queue_item):
+    # move a request from the processing list back to the front of the queue (the right hand end) to be run again
+    try:
+        print('\nSCHEDULER: Re-queueing queue item:', raw_queue_item.decode())
+        pipeline = get_redis().pipeline()  # a MULTI/EXEC transaction, so the request can't be lost in between
+        pipeline.lrem(PROCESSING_KEY, 1, raw_queue_item)
+        pipeline.rpush(QUEUE_KEY, raw_queue_item)
+        pipeline.execute()
+        publish_queue_changed()
+        return True
+    except redis.exceptions.ConnectionError as ce:
+        print("SCHEDULER: requeue_request Connection Error:", ce)
+        return False
+    except Exception as e:
+        print("SCHEDULER: requeue_request Error:", e)
+        return False
 
 
-def delete_request_from_redis_queue(queue_data):
+def delete_request_from_redis_queue(raw_queue_item):
+    # remove a finished request from the processing list
     try:
-        r = redis.Redis(host='scheduler', port=6379, db=0, password='hellothere')
-        print('\nSCHEDULER: Deleting queue item:', queue_data)
-        r.lrem('queue', 0, json.dumps(queue_data))
+        print('\nSCHEDULER: Deleting queue item:', raw_queue_item.decode())
+        get_redis().lrem(PROCESSING_KEY, 1, raw_queue_item)
+        publish_queue_changed()
         return True
     except redis.exceptions.ConnectionError as ce:
         print("SCHEDULER: delete_request_from_redis_queue Connection Error:", ce)
@@ -47,31 +139,225 @@ def delete_request_from_redis_queue(queue_data):
         return False
 
 
-def send_request_to_sd_engine(prompt_info):
+class BackendWorker(object):
+    """
+    One sd-backend endpoint: the requests it is running and whether it is healthy.
+    """
+    def __init__(self, url, max_in_flight):
+        self.url = url
+        self.max_in_flight = max_in_flight
+        self.reserved = 0  # slots handed out by BackendPool.acquire(), whether or not a request is assigned yet
+        self.in_flight = set()  # queue_ids of the requests running on this backend
+        self.failures = 0  # consecutive failures
+        self.retry_after = 0.0
+
+    def is_healthy(self):
+        return self.failures == 0 or time.time() >= self.retry_after
+
+    def is_available(self):
+        return self.is_healthy() and self.reserved < self.max_in_flight
+
+
+class BackendPool(object):
+    """
+    Hands out slots on the least busy healthy backend, blocking until one is free. A backend that fails is
+    rested for an increasing time before it is given more work.
+    """
+    def __init__(self, urls, max_in_flight):
+        self.workers = [BackendWorker(url, max_in_flight) for url in urls]
+        self.condition = threading.Condition()
+
+    def acquire(self, exclude=()):
+        # prefer backends not in exclude (those a request has already failed on), but don't wait on them
+        # if they are all that's available
+        with self.condition:
+            while True:
+                available = [worker for worker in self.workers if worker.is_available()]
+                candidates = [worker for worker in available if worker.url not in exclude] or available
+                if candidates:
+                    worker = min(candidates, key=lambda w: w.reserved)
+                    worker.reserved += 1
+                    return worker
+                # wake up now and again as rested backends become healthy again without a notify
+                self.condition.wait(timeout=1)
+
+    def assign(self, worker, queue_id):
+        with self.condition:
+            worker.in_flight.add(queue_id)
+
+    def unreserve(self, worker):
+        # give back a slot that was never used to send a request, leaving the backend's health as it was
+        with self.condition:
+            worker.reserved -= 1
+            self.condition.notify_all()
+
+    def release(self, worker, queue_id=None, succeeded=True):
+        with self.condition:
+            worker.reserved -= 1
+            worker.in_flight.discard(queue_id)
+            if succeeded:
+                worker.failures = 0
+            else:
+                worker.failures += 1
+                delay = min(BACKEND_RETRY_DELAY * 2 ** (worker.failures - 1), BACKEND_MAX_RETRY_DELAY)
+                worker.retry_after = time.time() + delay
+                print('SCHEDULER: Backend', worker.url, 'failed', worker.failures, 'time(s) in a row - resting it for',
+                      delay, 'seconds')
+            self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return [{'url': worker.url, 'healthy': worker.is_healthy(), 'in_flight': sorted(worker.in_flight)}
+                    for worker in self.workers]
+
+
+def send_request_to_sd_engine(prompt_info, backend_url):
+    # Returns the backend's response and whether the backend itself worked. A backend that can't be reached
+    # or errors (5xx) has failed and the request can be retried elsewhere; a 4xx means the request was bad.
+    r = None
     try:
         prompt_json = json.dumps(prompt_info)
-        print('\nSCHEDULER: Sending json request to SD Engine:', prompt_json)
-        r = requests.post('http://sd-backend:8080/prompt', json=prompt_json)
+        print('\nSCHEDULER: Sending json request to SD Engine', backend_url, ':', prompt_json)
+        r = requests.post(backend_url + '/prompt', json=prompt_json,
+                          timeout=(BACKEND_CONNECT_TIMEOUT, BACKEND_READ_TIMEOUT))
+        if r.status_code >= 500:
+            print("SCHEDULER: send_request_to_sd_engine - SD Engine", backend_url, "returned", r.status_code)
+            return {'queue_id': 'X', 'success': False}, False
         response = r.json()
         print('\nSCHEDULER: send_request_to_sd_engine - Response from SD Engine:', response)
-        return response
+        return response, True
+    except requests.exceptions.ReadTimeout as rt:
+        # the backend took the request and then hung - it may still finish it, so the request is requeued
+        # rather than sent straight to another backend
+        print("SCHEDULER: send_request_to_sd_engine -", backend_url, "did not answer in", BACKEND_READ_TIMEOUT,
+              "seconds:", rt)
+        return {'queue_id': 'X', 'success': False, 'timed_out': True}, False
+    except requests.exceptions.RequestException as re:
+        # a malformed backend URL (MissingSchema, InvalidURL...) fails before there is a response, and an
+        # unreadable response body from a backend that did answer doesn't mean the backend is down
+        print("SCHEDULER: send_request_to_sd_engine - Request to", backend_url, "failed:", re)
+        return {'queue_id': 'X', 'success': False}, r is not None and r.status_code < 500
+    except ValueError as ve:
+        print("SCHEDULER: send_request_to_sd_engine - Bad response from", backend_url, ":", ve)
+        return {'queue_id': 'X', 'success': False}, r is not None and r.status_code < 500
     except Exception as e:
         print("SCHEDULER: send_request_to_sd_engine - Error:", e)
-        return {'queue_id': 'X', 'success': False}
+        return {'queue_id': 'X', 'success': False}, False
+
+
+def dispatch_request(backend_pool, worker, queue_item, raw_queue_item):
+    # Runs a request on the backend already reserved in worker, retrying on other backends if it fails,
+    # then removes it from the processing list and updates the library
+    queue_id = queue_item['queue_id']
+    tried_backends = []
+    request_data = {'queue_id': 'X', 'success': False}
+    for attempt in range(MAX_DISPATCH_ATTEMPTS):
+        if worker is None:
+            worker = backend_pool.acquire(exclude=tried_backends)
+        backend_pool.assign(worker, queue_id)
+        request_data, backend_ok = send_request_to_sd_engine(queue_item, worker.url)
+        backend_pool.release(worker, queue_id, succeeded=backend_ok)
+        if backend_ok or request_data.get('timed_out'):
+            break
+        tried_backends.append(worker.url)
+        worker = None
+        print('SCHEDULER: Request', queue_id, 'failed on', tried_backends[-1], '- attempt', attempt + 1, 'of',
+              MAX_DISPATCH_ATTEMPTS)
+
+    if request_data.get('timed_out'):
+        with requeue_lock:
+            requeue_counts[queue_id] = requeue_counts.get(queue_id, 0) + 1
+            requeue = requeue_counts[queue_id] <= MAX_DISPATCH_ATTEMPTS
+            if not requeue:
+                del requeue_counts[queue_id]
+        if requeue and requeue_request(raw_queue_item):
+            print('SCHEDULER: Request', queue_id, 'timed out on', worker.url, '- re-queued')
+            return
+        print('SCHEDULER: Request', queue_id, 'timed out too many times - giving up on it')
+    else:
+        with requeue_lock:
+            requeue_counts.pop(queue_id, None)
+
+    delete_request_from_redis_queue(raw_queue_item)
+    if request_data.get('queue_id') == queue_id:
+        with library_lock:
+            update_library_catalogue(queue_id)
+
+    if request_data.get('success'):
+        print("SCHEDULER: Processing complete - library updated\n\n")
+    else:
+        print("SCHEDULER: Request failed")
+    print("SCHEDULER: Backends:", backend_pool.status())
+
+
+class LibraryCatalogue(object):
+    """
+    The library catalogue, kept as a snapshot (library.json, a JSON list of library entries) plus an append-only
+    log (library.jsonl, one library entry per line) so adding an entry is a single appended line rather than a
+    rewrite of the whole catalogue. The log is folded into the snapshot every compact_every entries. Readers
+    merge the two with later entries replacing earlier ones with the same queue_id.
+    """
+    def __init__(self, snapshot_path, log_path, compact_every):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.log_length = 0
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf8") as log_file:
+                self.log_length = sum(1 for _ in log_file)
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path)
+
+    def read(self):
+        entries = {}
+        try:
+            with open(self.snapshot_path, "r", encoding="utf8") as snapshot_file:
+                for library_entry in json.load(snapshot_file):
+                    entries[library_entry['queue_id']] = library_entry
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.log_path, "r", encoding="utf8") as log_file:
+                for line in log_file:
+                    try:
+                        library_entry = json.loads(line)
+                    except JSONDecodeError:
+                        continue  # a line cut short by a crash
+                    entries[library_entry['queue_id']] = library_entry
+        except FileNotFoundError:
+            pass
+        return list(entries.values())
+
+    def append(self, library_entry):
+        with open(self.log_path, "a", encoding="utf8") as log_file:
+            log_file.write(json.dumps(library_entry) + '\n')
+        self.log_length += 1
+        if self.log_length >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        self.replace(self.read())
+
+    def replace(self, library):
+        # write the snapshot alongside and swap it in so readers never see a half written file, then empty the
+        # log - a reader that catches both old log and new snapshot just sees the same entries twice
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, "w", encoding="utf8") as outfile:
+            outfile.write(json.dumps(library))
+        os.replace(temp_path, self.snapshot_path)
+        open(self.log_path, "w", encoding="utf8").close()
+        self.log_length = 0
+
+
+library_catalogue = LibraryCatalogue(LIBRARY_SNAPSHOT_PATH, LIBRARY_LOG_PATH, LIBRARY_COMPACT_EVERY)
 
 
 def update_library_catalogue(queue_id):
     print('\nSCHEDULER: Updating library catalogue')
     library_entry = {}
 
-    # load the current library catalogue
-    try:
-        with open("/app/library/library.json", "r", encoding="utf8") as library_json_file:
-            library = json.load(library_json_file)
-    except FileNotFoundError:
-        rebuild_library_catalogue()
-        return
-    except JSONDecodeError as jde:
+    if not library_catalogue.exists():
         rebuild_library_catalogue()
         return
 
@@ -91,11 +377,7 @@ def update_library_catalogue(queue_id):
             add_image_list_entries_to_library_entry(files, library_entry, root)
 
         # add the library entry to the library catalogue
-        library.append(json.loads(json.dumps(library_entry)))
-
-        # write the library catalogue
-        with open("/app/library/library.json", "w", encoding="utf8") as outfile:
-            outfile.write(json.dumps(library, indent=4, sort_keys=True))
+        library_catalogue.append(library_entry)
 
         print('\nSCHEDULER: Update of library catalogue completed')
 
@@ -108,74 +390,57 @@ def update_library_catalogue(queue_id):
 
 def rebuild_library_catalogue():
     print('\nSCHEDULER: Rebuilding library catalogue')
-    library = []
-    library_entry = {}
+    library = {}
+    untagged_images = 0
 
     try:
-        # read the library catalogue
-        for root, dirs, files in os.walk("/app/library", topdown=False):
-            # for each file in the library catalogue
-            for idx_name in files:
-                # get the file name
-                if idx_name == 'index.json':
-                    idx_file_name = os.path.join(root, idx_name)
-                    unix_time = os.path.getmtime(idx_file_name)
-                    try:
-                        # read the file
-                        with open(idx_file_name, "r", encoding="utf8") as infile:
-                            metadata = json.loads(infile.read())
-
-                            # copy the metadata to the library entry
-                            if type(metadata) is dict:
-                                library_entry = copy.deepcopy(metadata)
-                                library_entry["creation_unixtime"] = unix_time
-                                library_entry["generated_images"] = []
-
-                                # add the library entry to the library catalogue
-                                library.append(json.loads(json.dumps(library_entry)))
-
-                    except json.decoder.JSONDecodeError as jde:
-                        print("SCHEDULER: rebuild_library_catalogue JSONDecodeError:", jde)
-
-        # add the images file paths to the library catalogue
+        # a single walk of the library: each queue_id folder holds its index.json and its images
         for root, dirs, files in os.walk("/app/library", topdown=False):
-            for image_name in files:
-                image_path = os.path.join(root, image_name)
-                if 'drag_and_drop_images' not in image_path and (image_name.endswith('.jpeg') or image_name.endswith('.jpg') or image_name.endswith('.png')):
+            if 'index.json' not in files or 'drag_and_drop_images' in root:
+                continue
 
-                    # if the image has a metadata section then add it to the
-                    # end of the image file if ADD_METADATA_TO_FILES is enabled
-                    if ADD_METADATA_TO_FILES:
-                        update_file_metadata(image_path, library_entry)
+            idx_file_name = os.path.join(root, 'index.json')
+            try:
+                with open(idx_file_name, "r", encoding="utf8") as infile:
+                    metadata = json.loads(infile.read())
+            except json.decoder.JSONDecodeError as jde:
+                print("SCHEDULER: rebuild_library_catalogue JSONDecodeError:", jde)
+                continue
 
-                    # add the image file path to the library entry
-                    for library_entry in library:
-                        if library_entry["queue_id"] in root:
-                            image_file_path = image_path.replace('/app/', '')
+            # copy the metadata to the library entry
+            if type(metadata) is not dict:
+                continue
+            library_entry = copy.deepcopy(metadata)
+            library_entry["creation_unixtime"] = os.path.getmtime(idx_file_name)
+            library_entry["generated_images"] = []
 
-                            if image_file_path not in library_entry["generated_images"]:
-                                library_entry["generated_images"].append(image_file_path)
+            # add the images file paths to the library entry
+            untagged_images += add_image_list_entries_to_library_entry(files, library_entry, root)
+            library[library_entry["queue_id"]] = library_entry
 
         # write the library catalogue
-        with open("/app/library/library.json", "w", encoding="utf8") as outfile:
-            outfile.write(json.dumps(library, indent=4, sort_keys=True))
+        library_catalogue.replace(list(library.values()))
 
         print('\nSCHEDULER: Rebuild of library catalogue completed')
+        if untagged_images > 0:
+            print('SCHEDULER:', untagged_images, 'library image(s) have no embedded metadata - run',
+                  '"python3 scheduler.py --migrate-metadata" once to add it')
 
     except Exception as e:
         print('\nSCHEDULER: Rebuild of library catalogue failed, or there is no library until first images are created', e)
 
 
 def add_image_list_entries_to_library_entry(files, library_entry, root):
-    # Used by update_library_catalogue() and rebuild_library_catalogue() to add the generated images to library entry
+    # Used by update_library_catalogue() and rebuild_library_catalogue() to add the generated images to library entry.
+    # Returns how many of the images have no metadata chunk (legacy images, see migrate_library_metadata())
+    untagged_images = 0
     for image_name in files:
         if image_name.endswith('.jpeg') or image_name.endswith('.jpg') or image_name.endswith('.png'):
             image_file_path = os.path.join(root, image_name)
 
-            # if the image has a metadata section then add it to the
-            # end of the image file if ADD_METADATA_TO_FILES is enabled
-            if ADD_METADATA_TO_FILES:
-                update_file_metadata(image_file_path, library_entry)
+            # only the chunk headers are read, the image is never rewritten
+            if ADD_METADATA_TO_FILES and image_name.endswith('.png') and read_png_metadata(image_file_path) is None:
+                untagged_images += 1
 
             # add the image file path to the library entry
             if library_entry["queue_id"] in root:
@@ -183,63 +448,112 @@ def add_image_list_entries_to_library_entry(files, library_entry, root):
 
                 if image_file_path not in library_entry["generated_images"]:
                     library_entry["generated_images"].append(image_file_path)
+    return untagged_images
 
 
-def update_file_metadata(img_path, library_entry):
-    # if library_entry is an empty object, it means that an image file found in the library folder is
-    # not to do with the library - for example images placed there by the user for
-    # local processing of input images in the advanced.html page. In which case just return False
-    if library_entry == {}:
-        return False
-
-    # make a copy of the library entry so we don't modify the original
+def read_png_metadata(img_path):
+    # Returns the text of the image's IMAGE_METADATA_KEY chunk, or None if it has none. Only the chunks ahead
+    # of the image data are read - PIL writes text chunks there - and only the headers of those that aren't text.
+    try:
+        with open(img_path, 'rb') as image_file:
+            if image_file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return None
+            while True:
+                chunk_header = image_file.read(8)
+                if len(chunk_header) < 8:
+                    return None
+                length, chunk_type = struct.unpack('>I4s', chunk_header)
+                if chunk_type in (b'IDAT', b'IEND'):
+                    return None
+                if chunk_type not in (b'tEXt', b'iTXt'):
+                    image_file.seek(length + 4, os.SEEK_CUR)  # skip the chunk data and its CRC
+                    continue
+
+                chunk_data = image_file.read(length)
+                image_file.seek(4, os.SEEK_CUR)
+                keyword, _, text = chunk_data.partition(b'\0')
+                if keyword != IMAGE_METADATA_KEY:
+                    continue
+                if chunk_type == b'tEXt':
+                    return text.decode('latin-1')
+                # iTXt: compression flag, compression method, language tag, translated keyword, then the text
+                compressed = text[0] == 1
+                _, _, text = text[2:].partition(b'\0')
+                _, _, text = text.partition(b'\0')
+                return (zlib.decompress(text) if compressed else text).decode('utf-8')
+    except (OSError, struct.error, zlib.error, UnicodeDecodeError) as e:
+        print("SCHEDULER: read_png_metadata Error:", img_path, e)
+        return None
+
+
+def add_png_metadata(img_path, library_entry):
+    # Writes the library entry (less its image list) into the image as an iTXt chunk after the IHDR chunk,
+    # dropping any legacy metadata appended to the end of the file
     library_metadata = copy.deepcopy(library_entry)
-
-    # remove the generated_images list from the library metadata
     del library_metadata['generated_images']
+    text = json.dumps(library_metadata, ensure_ascii=False)
 
-    # prepare the metadata to be added to the image file
-    text = json.dumps(library_metadata)
-    binary_text = METADATA_START + text.encode('utf-8') + METADATA_END
-
-    # read the image file ready to insert the metadata
     with open(img_path, 'rb') as image_file:
         image_binary = image_file.read()
+    if not image_binary.startswith(PNG_SIGNATURE):
+        return False
 
-    # see if an existing metadata section exists
-    prompt_location_start = image_binary.find(METADATA_START)
+    legacy_metadata_start = image_binary.find(METADATA_START)
+    if legacy_metadata_start > -1:
+        image_binary = image_binary[:legacy_metadata_start]
 
-    if prompt_location_start > -1:
-        # replace an existing metadata entry with new metadata entry
-        image_binary = image_binary[:prompt_location_start] + binary_text
-    else:
-        # add new metadata entry to end of image file
-        image_binary = image_binary + binary_text
+    chunk_data = IMAGE_METADATA_KEY + b'\0\0\0\0\0' + text.encode('utf-8')
+    chunk = struct.pack('>I', len(chunk_data)) + b'iTXt' + chunk_data + \
+        struct.pack('>I', zlib.crc32(b'iTXt' + chunk_data) & 0xffffffff)
+    ihdr_length = struct.unpack('>I', image_binary[8:12])[0]
+    insert_at = len(PNG_SIGNATURE) + 8 + ihdr_length + 4  # the end of the IHDR chunk
+    image_binary = image_binary[:insert_at] + chunk + image_binary[insert_at:]
 
-    # write the image file with the new metadata
-    with open(img_path, 'wb') as new_image_file:
+    # write alongside and swap in so the image is never left half written
+    temp_path = img_path + '.tmp'
+    with open(temp_path, 'wb') as new_image_file:
         new_image_file.write(image_binary)
+    os.replace(temp_path, img_path)
 
     # confirm the metadata was added to the image file
-    return read_file_prompt(img_path) == text
-
-
-def read_file_prompt(img_path):
-    # read the image file ready to extract the metadata
-    with open(img_path, 'rb') as image_file:
-        image_binary = image_file.read()
-
-    # see if an existing metadata section exists
-    prompt_location_start = image_binary.find(METADATA_START)
-    if prompt_location_start > 0:
-        prompt_location_end = image_binary.find(METADATA_END)
-        if prompt_location_end > 0:
-            # extract the metadata from the image file
-            prompt_section = image_binary[prompt_location_start + len(METADATA_START):prompt_location_end]
-            return prompt_section.decode('utf-8')
+    return read_png_metadata(img_path) == text
+
+
+def migrate_library_metadata():
+    # One-time migration of images created before the backend wrote a metadata chunk: each library PNG without
+    # one gets its library entry as an iTXt chunk, replacing any metadata previously appended to the file
+    print('\nSCHEDULER: Migrating library image metadata')
+    migrated = 0
+    already_tagged = 0
+    for root, dirs, files in os.walk("/app/library"):
+        if 'index.json' not in files or 'drag_and_drop_images' in root:
+            continue
+        idx_file_name = os.path.join(root, 'index.json')
+        try:
+            with open(idx_file_name, "r", encoding="utf8") as infile:
+                metadata = json.load(infile)
+        except json.decoder.JSONDecodeError as jde:
+            print("SCHEDULER: migrate_library_metadata JSONDecodeError:", jde)
+            continue
+        if type(metadata) is not dict:
+            continue
+        library_entry = copy.deepcopy(metadata)
+        library_entry["creation_unixtime"] = os.path.getmtime(idx_file_name)
+        library_entry["generated_images"] = []
+
+        for image_name in files:
+            if not image_name.endswith('.png'):
+                continue
+            image_file_path = os.path.join(root, image_name)
+            if read_png_metadata(image_file_path) is not None:
+                already_tagged += 1
+            elif add_png_metadata(image_file_path, library_entry):
+                migrated += 1
+            else:
+                print('SCHEDULER: Could not add metadata to', image_file_path)
 
-    # no metadata found
-    return ''
+    print('SCHEDULER: Metadata migration completed -', migrated, 'image(s) migrated,', already_tagged,
+          'already had metadata')
 
 
 def exit_signal_handler(self, sig):
@@ -249,21 +563,30 @@ def exit_signal_handler(self, sig):
 
 
 if __name__ == "__main__":
+    if '--migrate-metadata' in sys.argv:
+        migrate_library_metadata()
+        sys.exit(0)
+
     print("SCHEDULER: Started")
     signal.signal(signal.SIGTERM, exit_signal_handler)
     signal.signal(signal.SIGINT, exit_signal_handler)
     rebuild_library_catalogue()
+    recover_in_flight_requests()
+    backend_pool = BackendPool(SD_BACKENDS, BACKEND_CONCURRENCY)
+    print("SCHEDULER: Dispatching to backends:", ', '.join(SD_BACKENDS), "with up to", BACKEND_CONCURRENCY,
+          "request(s) each")
     print("SCHEDULER: Listening for requests...")
     while True:
-        time.sleep(1)
-        queue_item = get_next_queue_request()
-        if queue_item['queue_id'] != 'X':
-            request_data = send_request_to_sd_engine(queue_item)
-            delete_request_from_redis_queue(queue_item)
-            if request_data['queue_id'] == queue_item['queue_id']:
-                update_library_catalogue(queue_item['queue_id'])
-
-            if request_data['success']:
-                print("SCHEDULER: Processing complete - library updated\n\n")
-            else:
-                print("SCHEDULER: Request failed")
+        # only take a request off the queue once there is a backend free to run it
+        worker = backend_pool.acquire()
+        queue_item, raw_queue_item = get_next_queue_request()
+        if queue_item['queue_id'] != 'X' and is_request_cancelled(queue_item['queue_id']):
+            # cancelled before it started, so there's nothing to do but drop it
+            print("SCHEDULER: Request", queue_item['queue_id'], "was cancelled before it started")
+            delete_request_from_redis_queue(raw_queue_item)
+            backend_pool.unreserve(worker)
+        elif queue_item['queue_id'] != 'X':
+            threading.Thread(target=dispatch_request, args=(backend_pool, worker, queue_item, raw_queue_item),
+                             daemon=True).start()
+        else:
+            backend_pool.unreserve(worker)